@@ -0,0 +1,448 @@
+""" ICAP load generator, a local stand-in for a proxy such as Squid.
+
+    $ python benchmarks/loadgen.py --server pooling --connections 64 --duration 10
+    $ python benchmarks/loadgen.py --connect 127.0.0.1:1344 --service /adapt
+
+Opens persistent connections and sends a mix of OPTIONS, REQMOD and
+RESPMOD requests over them, reporting requests/s and latency
+percentiles.  Bodies are drawn from a size distribution, optionally
+compressed, and sent with a preview (ending in `ieof` when the whole
+body fits in it) as Squid does for services advertising `Preview`.
+Requests for URIs under `/nomod/` are answered with 204 by the bundled
+`Adapt` service, the others with a copy of the decoded message.
+
+Without `--connect` the `Adapt` service is started in this process
+with the chosen server class; the clients then compete with the server
+for the interpreter, so for absolute numbers run the server on its
+own:
+
+    $ cd benchmarks && python -m icapservice loadgen --server pooling
+"""
+from __future__ import print_function, division
+import sys
+import json
+import math
+import zlib
+import time
+import random
+import socket
+import argparse
+import threading
+from collections import Counter
+import brotli
+from icapservice import ICAPService, OK, NoModificationsNeeded
+
+
+clock = getattr(time, 'monotonic', time.time)
+
+CRLF = b'\r\n'
+
+#: Size of the body chunks sent to the server.
+CHUNK_SIZE = 16384
+
+SIZE_SUFFIXES = {'k': 1024, 'm': 1024 * 1024}
+
+
+class Adapt(ICAPService):
+    """ Answers 204 for URIs under `/nomod/`, otherwise decodes and
+    returns a copy of the encapsulated message. """
+
+    abs_path = '/adapt'
+
+    def REQMOD(self, icap_request):
+        if icap_request.http_request.uri.startswith('/nomod/'):
+            return NoModificationsNeeded()
+        http_request, chunks = icap_request.modify_http_request()
+        if icap_request.null_body:
+            return OK(http_request=http_request)
+        del http_request['content-length']
+        return OK(http_request=http_request, chunks=chunks)
+
+    def RESPMOD(self, icap_request):
+        if icap_request.http_request.uri.startswith('/nomod/'):
+            return NoModificationsNeeded()
+        http_response, chunks = icap_request.modify_http_response()
+        if icap_request.null_body:
+            return OK(http_response=http_response)
+        return OK(http_response=http_response, chunks=chunks)
+
+
+def parse_size(value):
+    value = value.strip().lower()
+    if value[-1:] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(value)
+
+
+def parse_weights(value, parse=str):
+    """ Parse `a:3,b:1` into `[(a, 3.0), (b, 1.0)]`, weights default to 1. """
+    weights = []
+    for item in value.split(','):
+        key, _, weight = item.partition(':')
+        weights.append((parse(key), float(weight or 1)))
+    return weights
+
+
+def parse_preview(value):
+    return None if value == 'none' else parse_size(value)
+
+
+def choose(rng, weights):
+    total = sum(weight for _, weight in weights)
+    point = rng.uniform(0, total)
+    for key, weight in weights:
+        point -= weight
+        if point <= 0:
+            return key
+    return weights[-1][0]
+
+
+def text(rng, size):
+    """ Return `size` bytes of compressible text. """
+    words = [b'lorem', b'ipsum', b'dolor', b'sit', b'amet', b'adipiscing',
+             b'elit', b'sed', b'do', b'eiusmod', b'tempor', b'incididunt']
+    block = b' '.join(rng.choice(words) for _ in range(4096))
+    return (block * (size // len(block) + 1))[:size]
+
+
+def compress(body, encoding):
+    if encoding == 'gzip':
+        z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return z.compress(body) + z.flush()
+    if encoding == 'br':
+        return brotli.compress(body)
+    return body
+
+
+def chunked(body):
+    parts = []
+    for start in range(0, len(body), CHUNK_SIZE):
+        chunk = body[start:start + CHUNK_SIZE]
+        parts.append(b'%x\r\n' % len(chunk) + chunk + CRLF)
+    return b''.join(parts)
+
+
+def build_request(host, service, method, size, encoding, preview, nomod,
+                  rng):
+    """ Return the request as `(head, rest)`.
+
+    `head` is sent first and `rest`, if not None, once the server has
+    answered the preview with 100 Continue.
+    """
+    uri = 'icap://{}{}'.format(host, service).encode('ascii')
+    icap_head = (method.encode('ascii') + b' ' + uri + b' ICAP/1.0\r\n'
+                 b'Host: ' + host.encode('ascii') + b'\r\n'
+                 b'Allow: 204\r\n')
+    if method == 'OPTIONS':
+        return icap_head + CRLF, None
+
+    path = '/{}/{}'.format('nomod' if nomod else 'copy',
+                           rng.randint(0, 1 << 30)).encode('ascii')
+    body = compress(text(rng, size), encoding) if size else b''
+    entity = b'Content-Type: text/html\r\n'
+    if body:
+        if encoding != 'identity':
+            entity += b'Content-Encoding: ' + encoding.encode('ascii') + CRLF
+        entity += b'Content-Length: %d\r\n' % len(body)
+
+    if method == 'REQMOD':
+        verb = b'POST ' if body else b'GET '
+        req_hdr = (verb + path + b' HTTP/1.1\r\n'
+                   b'Host: origin.example.net\r\n' +
+                   (entity if body else b'') + CRLF)
+        sections = [(b'req-hdr', req_hdr)]
+        body_name = b'req-body'
+    else:
+        req_hdr = (b'GET ' + path + b' HTTP/1.1\r\n'
+                   b'Host: origin.example.net\r\n\r\n')
+        res_hdr = b'HTTP/1.1 200 OK\r\n' + entity + CRLF
+        sections = [(b'req-hdr', req_hdr), (b'res-hdr', res_hdr)]
+        body_name = b'res-body'
+
+    offsets = []
+    offset = 0
+    for name, section in sections:
+        offsets.append(name + b'=%d' % offset)
+        offset += len(section)
+    offsets.append((body_name if body else b'null-body') + b'=%d' % offset)
+    icap_head += b'Encapsulated: ' + b', '.join(offsets) + CRLF
+    encapsulated = b''.join(section for _, section in sections)
+
+    if not body:
+        return icap_head + CRLF + encapsulated, None
+    if preview is None:
+        return (icap_head + CRLF + encapsulated +
+                chunked(body) + b'0\r\n\r\n'), None
+
+    icap_head += b'Preview: %d\r\n' % preview
+    head = icap_head + CRLF + encapsulated + chunked(body[:preview])
+    if len(body) <= preview:
+        return head + b'0; ieof\r\n\r\n', None
+    return head + b'0\r\n\r\n', chunked(body[preview:]) + b'0\r\n\r\n'
+
+
+class ConnectionClosed(Exception):
+    """ The server closed the connection. """
+
+
+def read_response(rfile):
+    """ Read one ICAP response, return `(status, close_connection)`. """
+    status_line = rfile.readline()
+    if not status_line:
+        raise ConnectionClosed()
+    status = int(status_line.split()[1])
+    encapsulated = None
+    close = False
+    while True:
+        line = rfile.readline()
+        if not line:
+            raise ConnectionClosed()
+        if line == CRLF:
+            break
+        name, _, value = line.partition(b':')
+        name = name.strip().lower()
+        if name == b'encapsulated':
+            encapsulated = value.strip()
+        elif name == b'connection':
+            close = value.strip().lower() == b'close'
+    if encapsulated:
+        body_name, _, offset = encapsulated.split(b',')[-1].partition(b'=')
+        rfile.read(int(offset))
+        if body_name.strip() != b'null-body':
+            read_chunks(rfile)
+    return status, close
+
+
+def read_chunks(rfile):
+    while True:
+        line = rfile.readline()
+        if not line:
+            raise ConnectionClosed()
+        size = int(line.split(b';')[0], 16)
+        if not size:
+            rfile.readline()
+            return
+        rfile.read(size + 2)
+
+
+class Client(threading.Thread):
+    """ Sends requests over one persistent connection. """
+
+    def __init__(self, address, requests, seed, deadline, remaining):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.address = address
+        self.requests = requests
+        self.rng = random.Random(seed)
+        self.deadline = deadline
+        self.remaining = remaining
+        self.latencies = {}
+        self.statuses = Counter()
+        self.errors = 0
+        self.connects = 0
+        self.sock = None
+
+    def connect(self):
+        self.sock = socket.create_connection(self.address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.sock.makefile('rb')
+        self.connects += 1
+
+    def disconnect(self):
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+            self.sock = None
+
+    def run(self):
+        while clock() < self.deadline and self.remaining():
+            method, head, rest = self.rng.choice(self.requests)
+            try:
+                if self.sock is None:
+                    self.connect()
+                started = clock()
+                status, close = self.exchange(head, rest)
+                elapsed = clock() - started
+            except (socket.error, ConnectionClosed, ValueError, IndexError):
+                self.errors += 1
+                self.disconnect()
+                continue
+            self.latencies.setdefault(method, []).append(elapsed)
+            self.statuses[status] += 1
+            if close:
+                self.disconnect()
+        self.disconnect()
+
+    def exchange(self, head, rest):
+        self.sock.sendall(head)
+        status, close = read_response(self.rfile)
+        if status == 100 and rest is not None:
+            self.sock.sendall(rest)
+            status, close = read_response(self.rfile)
+        return status, close
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return float('nan')
+    rank = int(math.ceil(fraction * len(ordered))) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+def summarize(latencies):
+    ordered = sorted(latencies)
+    return {
+        'requests': len(ordered),
+        'p50_ms': percentile(ordered, 0.50) * 1000,
+        'p99_ms': percentile(ordered, 0.99) * 1000,
+        'p999_ms': percentile(ordered, 0.999) * 1000,
+        'max_ms': (ordered[-1] if ordered else float('nan')) * 1000,
+    }
+
+
+def run(address, requests, connections, duration, max_requests, seed):
+    """ Run the clients and return the results as a dict. """
+    counter = [max_requests]
+    lock = threading.Lock()
+
+    def remaining():
+        if counter[0] is None:
+            return True
+        with lock:
+            counter[0] -= 1
+            return counter[0] >= 0
+
+    started = clock()
+    deadline = started + duration
+    clients = [Client(address, requests, seed + i, deadline, remaining)
+               for i in range(connections)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = clock() - started
+
+    by_method = {}
+    statuses = Counter()
+    for client in clients:
+        statuses.update(client.statuses)
+        for method, latencies in client.latencies.items():
+            by_method.setdefault(method, []).extend(latencies)
+    latencies = [l for values in by_method.values() for l in values]
+    results = summarize(latencies)
+    results.update({
+        'connections': connections,
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed,
+        'errors': sum(client.errors for client in clients),
+        'connects': sum(client.connects for client in clients),
+        'statuses': dict((str(k), v) for k, v in sorted(statuses.items())),
+        'methods': dict((method, summarize(values))
+                        for method, values in sorted(by_method.items())),
+    })
+    return results
+
+
+def print_results(results):
+    print('{requests} requests in {seconds:.2f}s over {connections} '
+          'connections ({connects} connects), {errors} errors'
+          .format(**results))
+    print('{:.1f} requests/s'.format(results['requests_per_second']))
+    line = ('{:<8} {requests:>8} p50 {p50_ms:8.2f}ms  p99 {p99_ms:8.2f}ms  '
+            'p999 {p999_ms:8.2f}ms  max {max_ms:8.2f}ms')
+    print(line.format('all', **results))
+    for method, summary in sorted(results['methods'].items()):
+        print(line.format(method, **summary))
+    print('statuses: ' + ', '.join('{}={}'.format(status, count)
+                                   for status, count
+                                   in sorted(results['statuses'].items())))
+
+
+def start_server(server_name, handler_class):
+    from icapservice.__main__ import server_classes
+    server_class = server_classes()[server_name]
+    server = handler_class.server(server_class, ('127.0.0.1', 0))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--connect', metavar='HOST:PORT',
+                        help='server to load, by default the bundled '
+                             'service is started in this process')
+    parser.add_argument('--server', default='threading',
+                        help='server class for the bundled service '
+                             '(default: %(default)s)')
+    parser.add_argument('--service', default=Adapt.abs_path,
+                        help='ICAP service path (default: %(default)s)')
+    parser.add_argument('--connections', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds to run for (default: %(default)s)')
+    parser.add_argument('--requests', type=int,
+                        help='stop after this many requests')
+    parser.add_argument('--mix', default='OPTIONS:1,REQMOD:4,RESPMOD:5',
+                        help='ICAP methods and their weights '
+                             '(default: %(default)s)')
+    parser.add_argument('--body-sizes', default='0:2,1k:4,16k:3,256k:1',
+                        help='body sizes and their weights '
+                             '(default: %(default)s)')
+    parser.add_argument('--encodings', default='identity:6,gzip:3,br:1',
+                        help='content encodings and their weights '
+                             '(default: %(default)s)')
+    parser.add_argument('--previews', default='0:1,4k:2',
+                        help='preview sizes and their weights, "none" '
+                             'sends no preview (default: %(default)s)')
+    parser.add_argument('--nomod', type=float, default=0.5,
+                        help='fraction of requests answered with 204 '
+                             '(default: %(default)s)')
+    parser.add_argument('--variants', type=int, default=500,
+                        help='number of distinct requests generated '
+                             '(default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    mix = parse_weights(args.mix, str.upper)
+    sizes = parse_weights(args.body_sizes, parse_size)
+    encodings = parse_weights(args.encodings)
+    previews = parse_weights(args.previews, parse_preview)
+
+    server = None
+    if args.connect:
+        host, _, port = args.connect.rpartition(':')
+        address = (host or '127.0.0.1', int(port))
+    else:
+        server = start_server(args.server, Adapt().icap_handler_class())
+        address = server.server_address[:2]
+    host = '{}:{}'.format(*address)
+
+    requests = []
+    for _ in range(args.variants):
+        method = choose(rng, mix)
+        head, rest = build_request(host, args.service, method,
+                                   choose(rng, sizes), choose(rng, encodings),
+                                   choose(rng, previews),
+                                   rng.random() < args.nomod, rng)
+        requests.append((method, head, rest))
+
+    results = run(address, requests, args.connections, args.duration,
+                  args.requests, args.seed)
+    if server is not None:
+        results['server'] = args.server
+        server.shutdown()
+        server.server_close()
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    main()
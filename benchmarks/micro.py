@@ -0,0 +1,378 @@
+""" Microbenchmarks for the protocol hot paths.
+
+    $ python benchmarks/micro.py run --save benchmarks/baselines/local.json
+    $ python benchmarks/micro.py run --compare benchmarks/baselines/local.json
+    $ python benchmarks/micro.py compare old.json new.json --threshold 0.1
+
+Each benchmark is run across header counts or chunk sizes and the best
+time per call of several repeats is reported.  Results are saved as
+JSON; `compare` (or `run --compare`) lists the benchmarks that got
+slower than the baseline by more than the threshold and exits with
+status 1 if there are any.  Timings are only comparable on the same
+machine and Python version; `benchmarks/baselines/` holds the baselines
+the numbers in commit messages are measured against.
+"""
+from __future__ import print_function, division
+import sys
+import json
+import zlib
+import timeit
+import argparse
+import platform
+from io import BytesIO
+import brotli
+from icapservice.request import ICAPRequest, ChunkReader, read_chunks
+from icapservice.protocol import RequestParser
+from icapservice.encapsulated import encapsulated_offsets
+from icapservice.messages import HTTPRequest, HTTPResponse
+from icapservice.response import ICAPResponse, OK
+from icapservice.content import decoders, encoders
+
+
+HEADER_COUNTS = (4, 16, 64)
+CHUNK_SIZES = (64, 1024, 16384)
+
+#: Size of the bodies read and decoded.
+BODY_SIZE = 256 * 1024
+
+#: Minimum time of one timing run in seconds.
+MIN_TIME = 0.05
+
+#: Relative slowdown reported as a regression by default.
+THRESHOLD = 0.10
+
+benchmarks = []
+
+
+def benchmark(name, params):
+    """ Register a benchmark setup function for each of `params`.
+
+    The setup function returns the callable that is timed.
+    """
+    def register(setup):
+        for param in params:
+            benchmarks.append(('{}[{}]'.format(name, param), setup, param))
+        return setup
+    return register
+
+
+def http_headers(count):
+    lines = [b'Content-Type: text/html\r\n', b'Content-Length: 65536\r\n']
+    for i in range(count - len(lines)):
+        lines.append(b'X-Header-%d: value-%d\r\n' % (i, i))
+    return b''.join(lines[:count])
+
+
+def http_request_bytes(headers):
+    return (b'GET /path/to/resource?query=1 HTTP/1.1\r\n'
+            b'Host: origin.example.net\r\n' + http_headers(headers) + b'\r\n')
+
+
+def http_response_bytes(headers):
+    return b'HTTP/1.1 200 OK\r\n' + http_headers(headers) + b'\r\n'
+
+
+def chunked(body, chunk_size):
+    parts = []
+    for start in range(0, len(body), chunk_size):
+        chunk = body[start:start + chunk_size]
+        parts.append(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+    return b''.join(parts) + b'0\r\n\r\n'
+
+
+def body(size=BODY_SIZE):
+    line = b'<p>The quick brown fox jumps over the lazy dog %d</p>\n'
+    lines = []
+    total = 0
+    while total < size:
+        lines.append(line % len(lines))
+        total += len(lines[-1])
+    return b''.join(lines)[:size]
+
+
+def respmod_bytes(headers, preview=None):
+    req_hdr = http_request_bytes(4)
+    res_hdr = http_response_bytes(headers)
+    preview_header = b''
+    preview_body = b''
+    if preview is not None:
+        preview_header = b'Preview: %d\r\n' % preview
+        preview_body = chunked(b'x' * preview, 1024)
+    return (b'RESPMOD icap://icap.example.net/respmod ICAP/1.0\r\n'
+            b'Host: icap.example.net\r\n'
+            b'Allow: 204\r\n' + preview_header +
+            b'Encapsulated: req-hdr=0, res-hdr=%d, res-body=%d\r\n'
+            % (len(req_hdr), len(req_hdr) + len(res_hdr)) +
+            b'\r\n' + req_hdr + res_hdr + preview_body)
+
+
+@benchmark('ICAPRequest.parse', HEADER_COUNTS)
+def bench_icap_request_parse(headers):
+    data = respmod_bytes(headers, preview=1024)
+    return lambda: ICAPRequest.parse(BytesIO(data))
+
+
+@benchmark('encapsulated_offsets', ('req-hdr', 'req-hdr,res-hdr'))
+def bench_encapsulated_offsets(sections):
+    header = {
+        'req-hdr': 'req-hdr=0, req-body=412',
+        'req-hdr,res-hdr': 'req-hdr=0, res-hdr=137, res-body=296',
+    }[sections]
+    return lambda: encapsulated_offsets(header)
+
+
+@benchmark('read_chunks', CHUNK_SIZES)
+def bench_read_chunks(chunk_size):
+    data = chunked(body(), chunk_size)
+
+    def run():
+        for _ in read_chunks(BytesIO(data)):
+            pass
+    return run
+
+
+@benchmark('ChunkReader', CHUNK_SIZES)
+def bench_chunk_reader(chunk_size):
+    data = chunked(body(), chunk_size)
+
+    def run():
+        for _ in ChunkReader(BytesIO(data)):
+            pass
+    return run
+
+
+@benchmark('ChunkReader.copy', CHUNK_SIZES)
+def bench_chunk_reader_copy(chunk_size):
+    data = chunked(body(), chunk_size)
+
+    def run():
+        for _ in ChunkReader(BytesIO(data), copy=True):
+            pass
+    return run
+
+
+@benchmark('RequestParser.feed', CHUNK_SIZES)
+def bench_request_parser(chunk_size):
+    data = respmod_bytes(4) + chunked(body(), chunk_size)
+    segments = [data[i:i + 4096] for i in range(0, len(data), 4096)]
+
+    def run():
+        parser = RequestParser()
+        for segment in segments:
+            parser.feed(segment)
+    return run
+
+
+@benchmark('HTTPRequest.parse', HEADER_COUNTS)
+def bench_http_request_parse(headers):
+    data = http_request_bytes(headers)
+    return lambda: HTTPRequest.parse(BytesIO(data))
+
+
+@benchmark('HTTPResponse.parse', HEADER_COUNTS)
+def bench_http_response_parse(headers):
+    data = http_response_bytes(headers)
+    return lambda: HTTPResponse.parse(BytesIO(data))
+
+
+@benchmark('ICAPResponse.header_bytes', HEADER_COUNTS)
+def bench_header_bytes(headers):
+    http_response = HTTPResponse.parse(BytesIO(http_response_bytes(headers)))
+
+    def run():
+        icap_response = ICAPResponse(200, http_response=http_response)
+        icap_response.header_bytes([b'x'])
+    return run
+
+
+@benchmark('unmodified.header_bytes', HEADER_COUNTS)
+def bench_unmodified_header_bytes(headers):
+    data = respmod_bytes(headers)
+
+    def run():
+        icap_request = ICAPRequest.parse(BytesIO(data))
+        icap_response = OK(http_response=icap_request.http_response)
+        icap_response.header_bytes([b'x'])
+    return run
+
+
+@benchmark('modify_http_response', HEADER_COUNTS)
+def bench_modify_http_response(headers):
+    icap_request = ICAPRequest.parse(BytesIO(respmod_bytes(headers)))
+    return lambda: icap_request.modify_http_response(decode=False)
+
+
+@benchmark('modify_http_response.bytes', HEADER_COUNTS)
+def bench_modify_http_response_bytes(headers):
+    icap_request = ICAPRequest.parse(BytesIO(respmod_bytes(headers)))
+
+    def run():
+        http_response, _ = icap_request.modify_http_response(decode=False)
+        http_response['Via'] = '1.1 icap.example.net'
+        bytes(http_response)
+    return run
+
+
+def compress(data, encoding):
+    if encoding == 'gzip':
+        z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return z.compress(data) + z.flush()
+    if encoding == 'deflate':
+        return zlib.compress(data)
+    if encoding == 'br':
+        return brotli.compress(data)
+    if encoding == 'zstd':
+        return b''.join(encoders['zstd']([data]))
+    return data
+
+
+def decoder_benchmark(encoding):
+
+    @benchmark('decode_' + encoding, CHUNK_SIZES)
+    def bench_decoder(chunk_size):
+        data = compress(body(), encoding)
+        chunks = [data[i:i + chunk_size]
+                  for i in range(0, len(data), chunk_size)]
+        decoder = decoders[encoding]
+
+        def run():
+            for _ in decoder(iter(chunks)):
+                pass
+        return run
+
+
+for encoding in sorted(decoders):
+    decoder_benchmark(encoding)
+
+
+def encoder_benchmark(encoding):
+
+    @benchmark('encode_' + encoding, CHUNK_SIZES)
+    def bench_encoder(chunk_size):
+        data = body()
+        chunks = [data[i:i + chunk_size]
+                  for i in range(0, len(data), chunk_size)]
+        encoder = encoders[encoding]
+
+        def run():
+            for _ in encoder(iter(chunks)):
+                pass
+        return run
+
+
+for encoding in sorted(encoders):
+    encoder_benchmark(encoding)
+
+
+def measure(func, repeat):
+    """ Return the best time per call in seconds. """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= MIN_TIME:
+            break
+        number *= 2 if elapsed * 10 >= MIN_TIME else 10
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        best = min(best, timer.timeit(number) / number)
+    return best
+
+
+def run(selected=None, repeat=5):
+    results = {}
+    for name, setup, param in benchmarks:
+        if selected and not any(s in name for s in selected):
+            continue
+        results[name] = measure(setup(param), repeat)
+        print('{:<44} {}'.format(name, format_time(results[name])))
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds * scale >= 1:
+            return '{:8.2f}{}'.format(seconds * scale, unit)
+    return '{:8.2f}ns'.format(seconds * 1e9)
+
+
+def compare(baseline, current, threshold=THRESHOLD):
+    """ Print a comparison, return the names that regressed. """
+    if baseline.get('python') != current.get('python'):
+        print('warning: baseline is Python {}, current is Python {}'
+              .format(baseline.get('python'), current.get('python')))
+    regressions = []
+    for name in sorted(current['results']):
+        new = current['results'][name]
+        old = baseline['results'].get(name)
+        if old is None:
+            print('{:<44} {}  (new)'.format(name, format_time(new)))
+            continue
+        change = new / old - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('{:<44} {} -> {}  {:+7.1%}{}'.format(
+            name, format_time(old), format_time(new), change, flag))
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('names', nargs='*',
+                            help='only run benchmarks containing these')
+    run_parser.add_argument('--repeat', type=int, default=5)
+    run_parser.add_argument('--save', metavar='FILE',
+                            help='save the results as JSON')
+    run_parser.add_argument('--compare', metavar='BASELINE',
+                            help='compare the results to a baseline')
+    run_parser.add_argument('--threshold', type=float, default=THRESHOLD)
+
+    compare_parser = commands.add_parser('compare',
+                                         help='compare saved results')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=THRESHOLD)
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        results = run(args.names, args.repeat)
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True,
+                          separators=(',', ': '))
+                f.write('\n')
+        if not args.compare:
+            return 0
+        baseline = load(args.compare)
+        print()
+    elif args.command == 'compare':
+        baseline = load(args.baseline)
+        results = load(args.current)
+    else:
+        parser.error('a command is required')
+
+    regressions = compare(baseline, results, args.threshold)
+    if regressions:
+        print('{} regression(s) above {:.0%}'.format(len(regressions),
+                                                     args.threshold))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+""" Count the socket writes made per ICAP response.
+
+    $ python benchmarks/respond_syscalls.py --chunks 100 --chunk-size 512
+
+Runs a RESPMOD service that returns the body as many small chunks and
+reports the number of write syscalls (send/sendall/sendmsg) per
+response, with and without chunk coalescing and batched writes.
+"""
+from __future__ import print_function
+import sys
+import socket
+import argparse
+import threading
+from icapservice import ICAPService, OK
+from icapservice.writer import WRITE_BUFFER_SIZE, COALESCE_SIZE
+
+
+class CountingSocket(object):
+    """ Wraps a socket, counting the calls that write to it. """
+
+    def __init__(self, sock):
+        self._sock = sock
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._sock, name)
+        if name in ('send', 'sendall', 'sendmsg'):
+            def counted(*args, **kwargs):
+                self.calls += 1
+                return attr(*args, **kwargs)
+            return counted
+        return attr
+
+    def makefile(self, mode, bufsize=-1):
+        # socket._fileobject (Python 2) writes via the socket we give it
+        if sys.version_info[0] == 2:
+            return socket._fileobject(self, mode, bufsize)
+        return self._sock.makefile(mode, bufsize)
+
+
+class Chunked(ICAPService):
+
+    abs_path = '/chunked'
+    chunks = 100
+    chunk_size = 512
+
+    def RESPMOD(self, icap_request):
+        http_response, _ = icap_request.modify_http_response(decode=False)
+        chunk = b'x' * self.chunk_size
+        return OK(http_response=http_response,
+                  chunks=(chunk for _ in range(self.chunks)))
+
+
+def respmod_request():
+    res_hdr = b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n'
+    return (b'RESPMOD icap://127.0.0.1/chunked ICAP/1.0\r\n'
+            b'Host: 127.0.0.1\r\n'
+            b'Connection: close\r\n'
+            b'Encapsulated: res-hdr=0, res-body=' +
+            str(len(res_hdr)).encode('ascii') + b'\r\n'
+            b'\r\n' + res_hdr + b'0\r\n\r\n')
+
+
+def count_writes(handler_class, requests):
+    total = 0
+    request = respmod_request()
+    for _ in range(requests):
+        server_sock, client_sock = socket.socketpair()
+        counting = CountingSocket(server_sock)
+        reader = threading.Thread(target=drain, args=(client_sock,))
+        reader.start()
+        client_sock.sendall(request)
+        handler_class(counting, ('127.0.0.1', 0))
+        server_sock.close()
+        reader.join()
+        client_sock.close()
+        total += counting.calls
+    return total / float(requests)
+
+
+def drain(sock):
+    while sock.recv(65536):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--chunks', type=int, default=100)
+    parser.add_argument('--chunk-size', type=int, default=512)
+    parser.add_argument('--requests', type=int, default=20)
+    args = parser.parse_args()
+
+    service = Chunked()
+    service.chunks = args.chunks
+    service.chunk_size = args.chunk_size
+
+    print('{} chunks of {} bytes per response'.format(args.chunks,
+                                                      args.chunk_size))
+    for buffer_size, coalesce_size in ((0, 0),
+                                       (0, COALESCE_SIZE),
+                                       (WRITE_BUFFER_SIZE, COALESCE_SIZE)):
+        handler_class = service.icap_handler_class(
+            write_buffer_size=buffer_size,
+            coalesce_size=coalesce_size)
+        writes = count_writes(handler_class, args.requests)
+        print('write_buffer_size={:<6} coalesce_size={:<6} '
+              '{:8.1f} writes/response'.format(buffer_size, coalesce_size,
+                                               writes))
+
+
+if __name__ == '__main__':
+    main()
@@ -19,7 +19,9 @@ class Modify(ICAPService):
 
     def RESPMOD(self, icap_request):
         http_response, chunks = icap_request.modify_http_response()
-        return OK(http_response=http_response, chunks=self.modify_chunks(chunks))
+        chunks = icap_request.encode_body(http_response,
+                                          self.modify_chunks(chunks))
+        return OK(http_response=http_response, chunks=chunks)
 
     def modify_chunks(self, chunks):
         before  = 'Example Domain'
@@ -1,3 +1,8 @@
+import sys
 from .service import ICAPService
 from .handler import ThreadingICAPServer, ForkingICAPServer
+from .pooling import PoolingICAPServer
 from .response import (OK, NoModificationsNeeded)
+
+if sys.version_info >= (3, 6):
+    from .aio import AsyncICAPServer
@@ -0,0 +1,97 @@
+""" Run ICAP services from the command line.
+
+    $ python -m icapservice examples.respmod_copy --bind 0.0.0.0:1344 --workers 8
+
+The services are taken from a `services` list in the module if it has
+one, otherwise one instance of each `ICAPService` subclass defined in
+the module is created.
+"""
+from __future__ import print_function
+import sys
+import inspect
+import logging
+import argparse
+from importlib import import_module
+from .service import ICAPService
+from .handler import ICAPRequestHandler, ThreadingICAPServer
+from .pooling import PoolingICAPServer
+from .prefork import PreforkICAPServer
+
+
+def load_services(module_name):
+    """ Return the ICAP services defined in the named module. """
+    module = import_module(module_name)
+    services = getattr(module, 'services', None)
+    if services is not None:
+        return list(services)
+    return [obj() for name, obj in sorted(vars(module).items())
+            if inspect.isclass(obj)
+            and issubclass(obj, ICAPService)
+            and obj.__module__ == module.__name__]
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or '0.0.0.0', int(port)
+
+
+def server_classes():
+    classes = {
+        'threading': ThreadingICAPServer,
+        'pooling': PoolingICAPServer,
+    }
+    if sys.version_info >= (3, 6):
+        from .aio import AsyncICAPServer
+        classes['async'] = AsyncICAPServer
+    return classes
+
+
+def main(argv=None):
+    classes = server_classes()
+    parser = argparse.ArgumentParser(prog='python -m icapservice',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('module',
+                        help='module defining the ICAP services')
+    parser.add_argument('--bind', default='127.0.0.1:1344',
+                        help='address to listen on (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes, '
+                             '0 for one per CPU (default: %(default)s)')
+    parser.add_argument('--reuse-port', action='store_true',
+                        help='bind a socket per worker using SO_REUSEPORT')
+    parser.add_argument('--server', choices=sorted(classes),
+                        default='threading',
+                        help='server used by each worker '
+                             '(default: %(default)s)')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper())
+    sys.path.insert(0, '')
+    services = load_services(args.module)
+    if not services:
+        parser.error('no ICAP services found in %r' % args.module)
+
+    handler_class = ICAPRequestHandler.for_services(services)
+    server_address = parse_address(args.bind)
+    server_class = classes[args.server]
+    if args.workers == 1 and not args.reuse_port:
+        server = handler_class.server(server_class, server_address)
+    else:
+        # an event loop cannot be shared between processes so each
+        # asyncio worker must bind its own socket
+        reuse_port = args.reuse_port or args.server == 'async'
+        server = handler_class.server(PreforkICAPServer, server_address,
+                                      workers=args.workers,
+                                      reuse_port=reuse_port,
+                                      worker_class=server_class)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
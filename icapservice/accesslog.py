@@ -0,0 +1,143 @@
+""" Access logging off the request path.
+
+`AccessLog.record` only captures the fields of a request and puts them
+on a bounded queue; a background thread formats the records and passes
+them to a logger.  When the queue is full records are dropped (and
+counted) rather than making the request wait.  The thread is started
+by the first record written in a process, so an access log made before
+a pre-forking server forks its workers logs from each worker.
+
+    access_log = AccessLog(format='json', sample={204: 100})
+    handler_class = service.icap_handler_class(access_log=access_log)
+"""
+from __future__ import print_function, unicode_literals
+import os
+import json
+import time
+import logging
+import threading
+from itertools import count
+from datetime import datetime
+from six.moves.queue import Queue, Full
+
+
+def format_text(record):
+    (timestamp, method, abs_path, http_method, http_uri, status) = record
+    return '"{} {} {} {}" - {}'.format(method, abs_path,
+                                       http_method, http_uri, status)
+
+
+def format_json(record):
+    (timestamp, method, abs_path, http_method, http_uri, status) = record
+    return json.dumps({
+        'time': datetime.utcfromtimestamp(timestamp).isoformat() + 'Z',
+        'method': method,
+        'service': abs_path,
+        'http_method': http_method,
+        'http_uri': http_uri,
+        'status': status,
+    }, sort_keys=True)
+
+
+formatters = {
+    'text': format_text,
+    'json': format_json,
+}
+
+
+class AccessLog(object):
+    """ Queued, sampled access log.
+
+    `sample` maps status codes to N, logging one in every N responses
+    with that status; unlisted statuses and all errors (400 and above)
+    are always logged.
+    """
+
+    def __init__(self, logger=None, format='text', sample=None,
+                 queue_size=10000):
+        self.logger = logger or logging.getLogger('icapservice.access')
+        self.format = formatters[format]
+        self.sample = dict(sample or {})
+        self.counters = dict((status, count()) for status in self.sample)
+        self.queue_size = queue_size
+        self.queue = Queue(queue_size)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        #: The process `thread` runs in.
+        self.pid = None
+
+    def start(self):
+        """ Start the writer thread if it is not running in this process.
+
+        After a fork the thread of the parent is gone, the child gets a
+        new queue and thread of its own.
+        """
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        with self.lock:
+            if self.pid == pid:
+                return
+            if self.pid is not None:
+                # the records queued by the parent are its to write
+                self.queue = Queue(self.queue_size)
+            self.thread = threading.Thread(target=self.write_records,
+                                           args=(self.queue,))
+            self.thread.daemon = True
+            self.thread.start()
+            self.pid = pid
+
+    def sampled(self, status):
+        """ Return True if a response with `status` should be logged. """
+        rate = self.sample.get(status)
+        if not rate or status >= 400:
+            return True
+        return next(self.counters[status]) % rate == 0
+
+    def record(self, icap_request, icap_response):
+        status = icap_response.status_code
+        if not self.sampled(status):
+            return
+        self.start()
+        http_request = icap_request.http_request
+        if http_request is not None:
+            http_method, http_uri = http_request.method, http_request.uri
+        else:
+            http_method = http_uri = '?'
+        record = (time.time(),
+                  icap_request.method,
+                  icap_request.abs_path,
+                  http_method,
+                  http_uri,
+                  status)
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            with self.lock:
+                self.dropped += 1
+
+    def write_records(self, queue):
+        while True:
+            record = queue.get()
+            try:
+                if record is None:
+                    return
+                self.logger.info(self.format(record))
+            except Exception:
+                self.logger.exception('failed to write access log record')
+            finally:
+                queue.task_done()
+
+    def flush(self):
+        """ Wait until all queued records have been written. """
+        self.queue.join()
+
+    def close(self):
+        """ Write the queued records and stop the background thread. """
+        if self.pid != os.getpid():
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.pid = None
+        self.thread = None
@@ -0,0 +1,154 @@
+""" Tuning a service's OPTIONS response from live traffic.
+
+    service = Scanner()
+    service.adaptive_options = AdaptiveOptions()
+
+Every response of the service is recorded by the file extension of the
+HTTP request URI: whether it was a 204, and how many bytes of the body
+the service had received when it answered.  Content types are not
+tracked, the `Transfer-*` lists can only name extensions.
+When an OPTIONS request arrives, at most once every `interval` seconds,
+the `Preview` size and the `Transfer-Ignore` and `Transfer-Complete`
+lists are recomputed.  If they changed the `ISTag` is replaced, so
+clients drop cached verdicts, and a short `Options-TTL` is published so
+further changes are picked up soon; once they stop changing the
+configured TTL is restored.
+
+Extensions are only ever added to the configured lists.  A client does
+not send ignored extensions at all, so once an extension is added to
+`Transfer-Ignore` there is no more traffic to take it out again.
+"""
+from __future__ import print_function, division
+import threading
+from uuid import uuid4
+from bisect import bisect_left
+from six.moves.urllib_parse import urlparse
+from .lifecycle import clock
+
+
+#: Preview sizes that may be published, the largest is `max_preview`.
+PREVIEW_SIZES = (0, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536)
+
+TUNED_HEADERS = ('Preview', 'Transfer-Ignore', 'Transfer-Complete')
+
+
+def uri_extension(uri):
+    """ Return the lower case file extension of `uri`, or None. """
+    name = urlparse(uri).path.rsplit('/', 1)[-1]
+    _, dot, extension = name.rpartition('.')
+    if dot and 0 < len(extension) <= 8 and extension.isalnum():
+        return extension.lower()
+    return None
+
+
+class AdaptiveOptions(object):
+    """ Derives `Preview` and `Transfer-*` values from recorded responses.
+
+    An extension seen at least `min_samples` times is added to
+    `Transfer-Ignore` when at least `ignore_ratio` of its responses
+    were 204, and to `Transfer-Complete` when at most `complete_ratio`
+    were (the service needs the whole body anyway, so the preview only
+    costs a round trip).  The preview is the smallest size that covered
+    the bytes needed for `preview_quantile` of the 204 responses, capped
+    at `max_preview`.
+    """
+
+    def __init__(self, min_samples=100, ignore_ratio=0.99,
+                 complete_ratio=0.01, preview_quantile=0.9,
+                 max_preview=PREVIEW_SIZES[-1], interval=60.0,
+                 learning_ttl=300):
+        self.min_samples = min_samples
+        self.ignore_ratio = ignore_ratio
+        self.complete_ratio = complete_ratio
+        self.preview_quantile = preview_quantile
+        self.max_preview = max_preview
+        self.interval = interval
+        self.learning_ttl = learning_ttl
+        self.lock = threading.Lock()
+        #: `[responses, 204 responses]` by file extension.
+        self.extensions = {}
+        #: Number of 204 responses by the `PREVIEW_SIZES` bucket of the
+        #: body bytes received before answering (the last bucket is for
+        #: anything larger).
+        self.decided = [0] * (len(PREVIEW_SIZES) + 1)
+        self.updated = None
+        self.configured = None
+
+    def record(self, icap_request, icap_response):
+        """ Record the response to a request with a body. """
+        if icap_request.null_body:
+            return
+        unmodified = icap_response.status_code == 204
+        http_request = icap_request.http_request
+        extension = None
+        if http_request is not None:
+            extension = uri_extension(http_request.uri)
+        with self.lock:
+            if extension is not None:
+                count = self.extensions.setdefault(extension, [0, 0])
+                count[0] += 1
+                count[1] += unmodified
+            if unmodified:
+                size = icap_request.body_bytes_read
+                self.decided[bisect_left(PREVIEW_SIZES, size)] += 1
+
+    def update(self, service):
+        """ Update `service.options_headers` if `interval` has passed.
+
+        Returns True if the tuned values changed.
+        """
+        with self.lock:
+            now = clock()
+            if (self.updated is not None and
+                    now - self.updated < self.interval):
+                return False
+            self.updated = now
+
+            options = service.options_headers
+            if self.configured is None:
+                self.configured = dict(
+                    (name, options.get(name))
+                    for name in TUNED_HEADERS + ('Options-TTL',))
+            tuned = self.tune()
+            changed = any(options.get(name) != value
+                          for name, value in tuned.items())
+            options.update(tuned)
+
+        if changed:
+            service.istag = uuid4().hex
+            options['Options-TTL'] = self.learning_ttl
+        else:
+            options['Options-TTL'] = self.configured['Options-TTL']
+        return changed
+
+    def tune(self):
+        """ Return the tuned header values. """
+        ignore = list(self.configured['Transfer-Ignore'] or ())
+        complete = list(self.configured['Transfer-Complete'] or ())
+        for extension, (responses, unmodified) in sorted(
+                self.extensions.items()):
+            if responses < self.min_samples:
+                continue
+            ratio = unmodified / responses
+            if ratio >= self.ignore_ratio and extension not in ignore:
+                ignore.append(extension)
+            elif ratio <= self.complete_ratio and extension not in complete:
+                complete.append(extension)
+        return {
+            'Preview': self.tune_preview(),
+            'Transfer-Ignore': ignore,
+            'Transfer-Complete': [extension for extension in complete
+                                  if extension not in ignore],
+        }
+
+    def tune_preview(self):
+        total = sum(self.decided)
+        if total < self.min_samples:
+            return self.configured['Preview']
+        needed = self.preview_quantile * total
+        covered = 0
+        for size, count in zip(PREVIEW_SIZES, self.decided):
+            covered += count
+            if covered >= needed:
+                return min(size, self.max_preview)
+        return self.max_preview
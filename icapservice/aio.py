@@ -0,0 +1,677 @@
+""" ICAP server using asyncio streams (Python 3.6+).
+
+The server speaks the same protocol as `ICAPRequestHandler` and is
+created in the same way:
+
+    Service().icap_handler_class().server(AsyncICAPServer).serve_forever()
+
+Service methods may be plain functions or coroutines (`async def`).
+On this server `icap_request.chunks` is an asynchronous iterator so
+services read the encapsulated body with `async for`, and may return
+an asynchronous iterator as the response `chunks`.  The chunks of
+`modify_http_request`, `modify_http_response` and `encode_body` are
+asynchronous iterators too, and `spool` is a coroutine:
+
+    http_response, chunks = icap_request.modify_http_response()
+    body = await icap_request.spool(chunks)
+
+Content is decoded and encoded in the loop's default executor, a step
+at a time, so compressing a body does not hold up other connections.
+
+The handler's `idle_timeout`, `header_timeout`, `body_timeout`,
+`max_requests`, `discard_limit` and `metrics` apply as on the other
+servers, and `drain` shuts the server down gracefully.  Per-service
+concurrency limits are not applied (see `icapservice.limits`).  Each
+response chunk is handed to the transport, which does its own
+buffering, as it is produced: the handler's `write_buffer_size` and
+`coalesce_size` do not apply and changing them raises ValueError.
+"""
+import asyncio
+import inspect
+import logging
+import threading
+from io import BytesIO
+from .request import (ICAPRequest, ChunkError, IEOF, CRLF, MAX_REQUEST_LEN,
+                      CHUNK_BUFFER_SIZE, SKIP_BUFFER_SIZE)
+from .spool import SpooledBody, SPOOL_MAX_SIZE
+from .messages import split_start_line
+from .content import DecodeError
+from .encapsulated import encapsulated_offsets
+from .response import (ICAPResponse,
+                       RequestURITooLong,
+                       ServiceNotFound,
+                       MethodNotAllowed)
+from .lifecycle import clock
+from .writer import FINAL_CHUNK, WRITE_BUFFER_SIZE
+
+
+END_OF_HEADERS = b'\r\n\r\n'
+
+# `asyncio.current_task` is new in Python 3.7
+current_task = getattr(asyncio, 'current_task', None)
+if current_task is None:
+    current_task = asyncio.Task.current_task
+
+
+def with_timeout(coroutine_function, timeout):
+    """ Wrap `coroutine_function` so each call times out after `timeout`
+    seconds, raising `asyncio.TimeoutError`.
+    """
+    if timeout is None:
+        return coroutine_function
+
+    async def call(*args):
+        return await asyncio.wait_for(coroutine_function(*args), timeout)
+    return call
+
+
+async def read_chunks(reader, timeout=None):
+    """ Asynchronous version of `icapservice.request.read_chunks`.
+
+    Each read times out after `timeout` seconds.
+    """
+    readline = with_timeout(reader.readline, timeout)
+    readexactly = with_timeout(reader.readexactly, timeout)
+
+    while True:
+
+        chunk_size_line = await readline()
+        chunk_size, sep, chunk_extension = chunk_size_line.partition(b';')
+        chunk_size = int(chunk_size, 16)
+        if sep == b';':
+            if chunk_extension.strip() == b'ieof':
+                if chunk_size != 0:
+                    raise ChunkError("ieof with non-zero size")
+                yield IEOF
+
+        chunk = await readexactly(chunk_size)
+        crlf = await readexactly(2)
+        if crlf != CRLF:
+            raise ChunkError("found %r expecting CRLF" % crlf)
+
+        if not chunk:
+            break
+
+        yield chunk
+
+
+async def _chunks(icap_request, reader, timeout=None):
+
+    icap_request.chunks_started = True
+    for chunk in icap_request.preview_chunks:
+        yield chunk
+
+    if not icap_request.continue_after_preview():
+        return
+
+    async for chunk in read_chunks(reader, timeout):
+        if chunk is IEOF:
+            raise ChunkError("ieof after preview")
+        icap_request.body_bytes_read += len(chunk)
+        yield chunk
+
+    icap_request.eof = True
+
+
+async def skip_chunks(reader, max_bytes=None, timeout=None):
+    """ Asynchronous version of `icapservice.request.skip_chunks`.
+
+    Each read times out after `timeout` seconds.
+    """
+    readline = with_timeout(reader.readline, timeout)
+    readexactly = with_timeout(reader.readexactly, timeout)
+    skipped = 0
+
+    while True:
+
+        chunk_size_line = await readline()
+        if not chunk_size_line:
+            raise ChunkError("unexpected end of chunks")
+        chunk_size = int(chunk_size_line.partition(b';')[0], 16)
+
+        skipped += chunk_size
+        if max_bytes is not None and skipped > max_bytes:
+            return False
+
+        remaining = chunk_size
+        while remaining:
+            size = min(remaining, SKIP_BUFFER_SIZE)
+            await readexactly(size)
+            remaining -= size
+
+        crlf = await readexactly(2)
+        if crlf != CRLF:
+            raise ChunkError("found %r expecting CRLF" % crlf)
+
+        if not chunk_size:
+            return True
+
+
+async def _anext(chunks):
+    return await chunks.__anext__()
+
+
+class ChunkFeed(object):
+    """ An iterator over the asynchronous iterator `chunks` for code
+    running in another thread, each item is read on `loop`.
+    """
+
+    def __init__(self, chunks, loop):
+        self.chunks = chunks.__aiter__()
+        self.loop = loop
+        self.pending = None
+        self.cancelled = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.cancelled:
+            raise StopIteration
+        self.pending = asyncio.run_coroutine_threadsafe(_anext(self.chunks),
+                                                        self.loop)
+        try:
+            return self.pending.result()
+        except StopAsyncIteration:
+            raise StopIteration
+        finally:
+            self.pending = None
+
+    def cancel(self):
+        """ Stop waiting for the next item, from the thread of `loop`. """
+        self.cancelled = True
+        pending = self.pending
+        if pending is not None:
+            pending.cancel()
+
+
+def transform_chunks(function, chunks, *args):
+    """ Return an asynchronous iterator over the generator
+    `function(chunks, *args)` written for synchronous `chunks`.
+
+    Each step of the generator runs in the default executor of the
+    running loop, its reads of `chunks` are passed back to the loop.
+    The generator is created at once, so errors raised when it is
+    created (such as `UnsupportedEncoding`) are raised here.
+    """
+    loop = asyncio.get_event_loop()
+    feed = ChunkFeed(chunks, loop)
+    return _run_steps(iter(function(feed, *args)), feed, loop)
+
+
+async def _run_steps(steps, feed, loop):
+    done = object()
+    try:
+        while True:
+            chunk = await loop.run_in_executor(None, next, steps, done)
+            if chunk is done:
+                return
+            yield chunk
+    finally:
+        # a cancelled step would otherwise wait for its read forever
+        feed.cancel()
+
+
+class AsyncICAPRequest(ICAPRequest):
+    """ An `ICAPRequest` whose body is read asynchronously. """
+
+    def transform_chunks(self, function, chunks, *args):
+        if not hasattr(chunks, '__aiter__'):
+            return function(chunks, *args)
+        return transform_chunks(function, chunks, *args)
+
+    async def spool(self, chunks=None, max_size=SPOOL_MAX_SIZE, dir=None):
+        """ Asynchronous version of `ICAPRequest.spool`. """
+        if chunks is None:
+            chunks = self.chunks
+        body = SpooledBody(max_size, dir)
+        try:
+            async for chunk in chunks:
+                body.write(chunk)
+        except Exception:
+            body.close()
+            raise
+        return body
+
+    def body_views(self, buffer_size=CHUNK_BUFFER_SIZE):
+        """ Return `chunks`, the body cannot be read into a buffer from
+        an asyncio stream.
+        """
+        return self.chunks
+
+    async def discard(self, max_bytes=None):
+        """ Asynchronous version of `ICAPRequest.discard`. """
+
+        if self.eof:
+            return True
+
+        self.chunks = _aiter(())
+
+        if self.preview is not None and not self.continued:
+            # the client waits for "100 Continue" before sending the rest
+            self.eof = True
+            return True
+
+        if not await skip_chunks(self.reader, max_bytes, self.body_timeout):
+            return False
+
+        self.eof = True
+        return True
+
+
+async def parse_request(reader, send_continue_after_preview=None, first=b'',
+                        body_timeout=None):
+    """ Asynchronous version of `ICAPRequest.parse`.
+
+    The ICAP and encapsulated HTTP headers are read in full (their size
+    is known from the `Encapsulated` header) and parsed as usual, the
+    body is left on `reader` for `icap_request.chunks`, whose reads time
+    out after `body_timeout` seconds.  `first` is the start of the
+    request if it has already been read.
+    """
+
+    try:
+        head = first + await reader.readuntil(END_OF_HEADERS)
+    except asyncio.IncompleteReadError as exc:
+        if not exc.partial:
+            return None
+        raise
+    except asyncio.LimitOverrunError:
+        raise RequestURITooLong()
+
+    line, _, headers = head.partition(CRLF)
+    method, uri, protocol = split_start_line(line.decode('iso-8859-1'))
+    request = AsyncICAPRequest(BytesIO(headers), method, uri, protocol)
+    request.send_continue_after_preview = send_continue_after_preview
+
+    offsets = encapsulated_offsets(request.get('encapsulated'))
+    encapsulated = b''
+    if offsets:
+        encapsulated = await reader.readexactly(offsets[-1][1])
+    request.read_encapsulated_http(BytesIO(encapsulated))
+
+    if request.get('preview') is not None and not request.eof:
+        async for chunk in read_chunks(reader):
+            if chunk is not IEOF:
+                assert not request.eof
+                request.preview_chunks.append(chunk)
+                request.body_bytes_read += len(chunk)
+            else:
+                request.eof = True
+
+    request.reader = reader
+    request.body_timeout = body_timeout
+    request.chunks = _chunks(request, reader, body_timeout)
+    return request
+
+
+async def _aiter(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+class CountingReader(object):
+    """ Wraps a `StreamReader`, counting the bytes read for metrics like
+    `icapservice.lifecycle.RequestReader`.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        #: `clock` time the current request started.
+        self.started_at = None
+        #: Bytes read since the current request started.
+        self.bytes_read = 0
+
+    async def readline(self):
+        data = await self.reader.readline()
+        self.bytes_read += len(data)
+        return data
+
+    async def readexactly(self, n):
+        data = await self.reader.readexactly(n)
+        self.bytes_read += len(data)
+        return data
+
+    async def readuntil(self, separator):
+        data = await self.reader.readuntil(separator)
+        self.bytes_read += len(data)
+        return data
+
+
+class AsyncICAPConnection(object):
+    """ Handles the ICAP requests on a single client connection. """
+
+    def __init__(self, handler_class, reader, writer, server=None):
+        self.handler_class = handler_class
+        self.reader = CountingReader(reader)
+        self.writer = writer
+        self.server = server
+        self.close_connection = False
+        self.requests_handled = 0
+        #: True while waiting for the next request to start.
+        self.idle = False
+        self.log = handler_class.log or logging.getLogger(__name__)
+
+    async def handle(self):
+        """ Handle multiple requests if necessary. """
+        try:
+            while not self.close_connection:
+                await self.handle_one_request()
+        except asyncio.CancelledError:
+            # closed by the server, not an error (a cancelled task would
+            # be logged by asyncio, and this is an Exception before 3.8)
+            pass
+        except Exception:
+            self.log.exception("error handling request from %r",
+                               self.writer.get_extra_info('peername'))
+        finally:
+            self.writer.close()
+
+    async def handle_one_request(self):
+        """ Handle a single ICAP request. """
+
+        icap_response = None
+        icap_request = None
+        parsed = admitted = serviced = responded = None
+
+        try:
+
+            icap_request = await self.read_request()
+            if icap_request is None:
+                return
+            parsed = clock()
+            self.requests_handled += 1
+
+            try:
+                service, method = self.handler_class.service_method(icap_request)
+            except (ServiceNotFound, MethodNotAllowed) as exc:
+                icap_response = exc
+                return
+
+            icap_response = self.handler_class.classify(service, icap_request)
+            if icap_response is None:
+                admitted = clock()
+                icap_response = await self.service_response(method,
+                                                            icap_request)
+            serviced = clock()
+            icap_response.headers.merge(service.response_headers or {})
+
+            if self.handler_class.persistent_connections:
+                self.close_connection = icap_request.close_connection
+            else:
+                self.close_connection = True
+
+            max_requests = self.handler_class.max_requests
+            if max_requests and self.requests_handled >= max_requests:
+                self.close_connection = True
+            if getattr(self.server, 'draining', False):
+                self.close_connection = True
+
+        except asyncio.IncompleteReadError as exc:
+
+            self.log.error("connection closed mid-request: %r", exc)
+            self.close_connection = True
+
+        except asyncio.TimeoutError:
+
+            self.log.error("request timed out")
+            self.close_connection = True
+
+        finally:
+
+            if icap_response is not None:
+                try:
+                    bytes_written = await self.respond(icap_request,
+                                                       icap_response)
+                    responded = clock()
+                except asyncio.TimeoutError:
+                    self.log.error("response timed out")
+                    self.close_connection = True
+                except DecodeError as exc:
+                    # the response has been started, or a 204 is not
+                    # allowed
+                    self.log.error("response cut short: %s", exc)
+                    self.close_connection = True
+            else:
+                self.close_connection = True
+
+            if icap_request is not None and not self.close_connection:
+                await self.discard(icap_request)
+
+            if (self.handler_class.metrics is not None and
+                    responded is not None):
+                self.handler_class.record_metrics(
+                    icap_request, icap_response, self.reader.started_at,
+                    parsed, admitted, serviced, responded,
+                    self.reader.bytes_read, bytes_written)
+
+    async def discard(self, icap_request):
+        """ Skip the rest of the body, or close the connection if that
+        is not possible.
+        """
+        try:
+            if not await icap_request.discard(
+                    self.handler_class.discard_limit):
+                self.close_connection = True
+        except asyncio.TimeoutError:
+            self.log.error("request timed out")
+            self.close_connection = True
+        except (ChunkError, ValueError, asyncio.IncompleteReadError) as exc:
+            self.log.error("bad request body: %r", exc)
+            self.close_connection = True
+
+    async def read_request(self):
+        """ Read the next request, or return None if there is none.
+
+        The wait for the request to start is limited to the handler's
+        `idle_timeout`, reading its headers and preview from then on to
+        its `header_timeout`.
+        """
+        if getattr(self.server, 'draining', False):
+            return None
+        handler_class = self.handler_class
+        self.reader.started_at = None
+        self.reader.bytes_read = 0
+        self.idle = True
+        try:
+            first = await asyncio.wait_for(self.reader.readexactly(1),
+                                           handler_class.idle_timeout)
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.TimeoutError:
+            self.log.debug("idle connection timed out")
+            return None
+        finally:
+            self.idle = False
+        self.reader.started_at = clock()
+        return await asyncio.wait_for(
+            parse_request(self.reader, self.send_continue_after_preview,
+                          first, handler_class.body_timeout),
+            handler_class.header_timeout)
+
+    async def service_response(self, method, icap_request):
+        """ Asynchronous version of `ICAPRequestHandler.service_response`.
+        """
+        try:
+            icap_response = method(icap_request)
+            if inspect.isawaitable(icap_response):
+                icap_response = await icap_response
+        except DecodeError as exc:
+            return self.handler_class.decode_error_response(icap_request,
+                                                            exc)
+        return icap_response
+
+    async def respond(self, icap_request, icap_response):
+
+        if isinstance(icap_response, int):
+            icap_response = ICAPResponse(icap_response)
+
+        # The 100 response is generated by reading icap_request.chunks
+        assert icap_response.status_code != 100
+
+        icap_response.headers.merge(self.handler_class.response_headers or {})
+        if self.close_connection:
+            icap_response.headers['Connection'] = 'close'
+
+        if (200 <= icap_response.status_code < 300 and
+                icap_response.status_code != 204):
+            icap_request.continue_after_preview()
+
+        chunks = icap_response.chunks
+        if not hasattr(chunks, '__aiter__'):
+            chunks = _aiter(chunks)
+        chunks = chunks.__aiter__()
+        try:
+            first_chunk = [await chunks.__anext__()]
+        except StopAsyncIteration:
+            first_chunk = []
+        except DecodeError as exc:
+            # nothing has been sent yet
+            icap_response = self.handler_class.decode_error_fallback(
+                icap_request, icap_response, exc)
+            first_chunk = []
+
+        if icap_response.status_code == 204:
+            if icap_request.preview is not None and not icap_request.continued:
+                # the client does not send the rest after a preview
+                icap_request.eof = True
+
+        self.handler_class.log_response(icap_request, icap_response)
+        self.handler_class.record_outcome(icap_request, icap_response)
+
+        write = self.writer.write
+        header_bytes = icap_response.header_bytes(first_chunk)
+        write(header_bytes)
+        bytes_written = len(header_bytes)
+
+        if first_chunk:
+            chunk = first_chunk[0]
+            while True:
+                size_line = b'%x\r\n' % len(chunk)
+                write(size_line)
+                write(chunk)
+                write(CRLF)
+                bytes_written += len(size_line) + len(chunk) + len(CRLF)
+                await self.writer.drain()
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+            write(FINAL_CHUNK)
+            bytes_written += len(FINAL_CHUNK)
+
+        await self.writer.drain()
+        return bytes_written
+
+    def send_continue_after_preview(self):
+        icap_response = ICAPResponse(100)
+        self.writer.write(icap_response.header_bytes(False))
+
+
+class AsyncICAPServer(object):
+    """ ICAP Server using asyncio.
+
+    Follows the `SocketServer` protocol used by `ICAPRequestHandler.server`
+    so it can be used in place of `ThreadingICAPServer`.  Each connection
+    is a task on the event loop rather than a thread or process, so idle
+    persistent connections cost very little.
+    """
+
+    #: Set `SO_REUSEPORT` on the listening socket, see `ICAPServer`.
+    reuse_port = False
+
+    #: Set by `drain`, connections close after the current request.
+    draining = False
+
+    def __init__(self, server_address, RequestHandlerClass, loop=None):
+        if (RequestHandlerClass.write_buffer_size != WRITE_BUFFER_SIZE or
+                RequestHandlerClass.coalesce_size):
+            raise ValueError('write_buffer_size and coalesce_size do not '
+                             'apply to AsyncICAPServer')
+        self.RequestHandlerClass = RequestHandlerClass
+        self.loop = loop or asyncio.new_event_loop()
+        host, port = server_address
+        start_server = asyncio.start_server(self.handle_connection,
+                                            host, port,
+                                            limit=MAX_REQUEST_LEN,
+                                            reuse_port=self.reuse_port or None)
+        self.server = self.loop.run_until_complete(start_server)
+        self.server_address = self.server.sockets[0].getsockname()
+        #: The task handling each open connection.
+        self.connections = {}
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+
+    async def handle_connection(self, reader, writer):
+        connection = AsyncICAPConnection(self.RequestHandlerClass,
+                                         reader, writer, self)
+        self.connections[connection] = current_task()
+        try:
+            await connection.handle()
+        finally:
+            del self.connections[connection]
+
+    def serve_forever(self, poll_interval=None):
+        """ Run the event loop until `shutdown` is called.
+
+        `poll_interval` is accepted for compatibility with `SocketServer`
+        and ignored, `shutdown` wakes the loop directly.
+        """
+        self._is_shut_down.clear()
+        try:
+            self.loop.run_forever()
+        finally:
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        """ Stop `serve_forever` and wait for it to return.
+
+        Must be called from another thread, like `SocketServer.shutdown`.
+        """
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._is_shut_down.wait()
+
+    def drain(self, timeout=None):
+        """ Shut down gracefully, see `ICAPServer.drain`.
+
+        Must be called from another thread while `serve_forever` runs,
+        which keeps running until the requests have finished or
+        `timeout` has passed, and returns once it has stopped.  Returns
+        True if all connections closed.
+        """
+        drained = asyncio.run_coroutine_threadsafe(
+            self.close_connections(timeout), self.loop).result()
+        self.shutdown()
+        return drained
+
+    async def close_connections(self, timeout=None):
+        """ Stop accepting, close idle connections and wait up to
+        `timeout` seconds for the others to finish their request.
+        """
+        self.draining = True
+        self.server.close()
+        for connection, task in list(self.connections.items()):
+            if connection.idle:
+                task.cancel()
+        tasks = list(self.connections.values())
+        if not tasks:
+            return True
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        return not pending
+
+    def server_close(self):
+        """ Close the server and any connections still open.
+
+        Connections are closed first: idle persistent connections would
+        otherwise keep `wait_closed` waiting (Python 3.12+) or be left
+        as pending tasks on the closed loop.
+        """
+        self.server.close()
+        tasks = list(self.connections.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
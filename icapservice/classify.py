@@ -0,0 +1,164 @@
+""" Classifying requests from their headers and preview.
+
+A service lists classifiers in its `classifiers` attribute.  Before the
+service method is called each classifier is given the request, while
+a 204 is still allowed (see `ICAPRequest.can_respond_204`), and may
+return a response to send instead, typically `NoModificationsNeeded`.
+For a request with a preview the rest of the body is then never sent.
+
+    class Scanner(ICAPService):
+        classifiers = [MediaClassifier()]
+"""
+from __future__ import print_function
+from .response import NoModificationsNeeded
+
+
+#: `(offset, signature, kind)` of the file formats recognised by `sniff`.
+SIGNATURES = (
+    (0, b'\x89PNG\r\n\x1a\n', 'image'),
+    (0, b'\xff\xd8\xff', 'image'),
+    (0, b'GIF87a', 'image'),
+    (0, b'GIF89a', 'image'),
+    (8, b'WEBP', 'image'),
+    (0, b'\x00\x00\x01\x00', 'image'),
+    (0, b'II*\x00', 'image'),
+    (0, b'MM\x00*', 'image'),
+    (4, b'ftypavif', 'image'),
+    (4, b'ftypheic', 'image'),
+    (4, b'ftyp', 'video'),
+    (0, b'\x1aE\xdf\xa3', 'video'),
+    (0, b'FLV\x01', 'video'),
+    (0, b'\x00\x00\x01\xba', 'video'),
+    (8, b'AVI ', 'video'),
+    (0, b'ID3', 'audio'),
+    (0, b'\xff\xfb', 'audio'),
+    (0, b'OggS', 'audio'),
+    (0, b'fLaC', 'audio'),
+    (8, b'WAVE', 'audio'),
+    (0, b'PK\x03\x04', 'archive'),
+    (0, b'\x1f\x8b', 'archive'),
+    (0, b'7z\xbc\xaf\x27\x1c', 'archive'),
+    (0, b'Rar!\x1a\x07', 'archive'),
+    (0, b'BZh', 'archive'),
+    (0, b'\xfd7zXZ\x00', 'archive'),
+    (0, b'(\xb5/\xfd', 'archive'),
+    (0, b'wOFF', 'font'),
+    (0, b'wOF2', 'font'),
+    (0, b'OTTO', 'font'),
+    (0, b'\x00\x01\x00\x00\x00', 'font'),
+)
+
+#: Content types of each kind, besides the `image/`, `video/`, `audio/`
+#: and `font/` top level types.
+CONTENT_TYPES = {
+    'application/zip': 'archive',
+    'application/gzip': 'archive',
+    'application/x-gzip': 'archive',
+    'application/x-7z-compressed': 'archive',
+    'application/x-rar-compressed': 'archive',
+    'application/vnd.rar': 'archive',
+    'application/x-bzip2': 'archive',
+    'application/x-xz': 'archive',
+    'application/zstd': 'archive',
+    'application/font-woff': 'font',
+    'application/font-sfnt': 'font',
+    'application/vnd.ms-fontobject': 'font',
+    'application/ogg': 'audio',
+}
+
+#: Content types that are never classified, they can carry scripts.
+SCRIPTABLE_TYPES = ('image/svg+xml',)
+
+MEDIA_KINDS = ('image', 'video', 'audio', 'archive', 'font')
+
+
+def sniff(data):
+    """ Return the kind of file `data` starts with, or None. """
+    for offset, signature, kind in SIGNATURES:
+        if data[offset:offset + len(signature)] == signature:
+            return kind
+    return None
+
+
+def preview_head(chunks, size=16):
+    """ Return (at least) the first `size` bytes of the preview. """
+    head = []
+    length = 0
+    for chunk in chunks:
+        head.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            break
+    return b''.join(head)
+
+
+def content_type_kind(content_type):
+    """ Return the kind of file a `Content-Type` value names, or None. """
+    content_type = content_type.split(';')[0].strip().lower()
+    if not content_type or content_type in SCRIPTABLE_TYPES:
+        return None
+    kind = CONTENT_TYPES.get(content_type)
+    if kind is None:
+        kind = content_type.split('/')[0]
+    return kind if kind in MEDIA_KINDS else None
+
+
+def encapsulated_message(icap_request):
+    """ Return the HTTP message whose body the request carries. """
+    if icap_request.http_response is not None:
+        return icap_request.http_response
+    return icap_request.http_request
+
+
+class MediaClassifier(object):
+    """ Answers 204 for media the service does not need to see.
+
+    The body is recognised by the magic bytes at the start of the
+    preview, which must match the kind its `Content-Type` names: a
+    browser renders the body as its `Content-Type` says, so a `text/html`
+    or `image/svg+xml` body is inspected whatever bytes it starts with.
+    Without any preview bytes, and if `trust_content_type` is set, it is
+    recognised by its `Content-Type` alone.  `trust_content_type` is
+    off by default: with the service's default `Preview: 0` no bytes are
+    ever seen, so any body that claims to be media would skip
+    inspection.  Bodies with a `Content-Encoding` are not sniffed as the
+    preview holds encoded bytes.  Bodies with a `Content-Length` above
+    `max_length` are answered with 204 whatever their type.
+    """
+
+    def __init__(self, kinds=MEDIA_KINDS, trust_content_type=False,
+                 max_length=None):
+        self.kinds = frozenset(kinds)
+        self.trust_content_type = trust_content_type
+        self.max_length = max_length
+
+    def __call__(self, icap_request):
+        message = encapsulated_message(icap_request)
+        if message is None or icap_request.null_body:
+            return None
+        if (self.too_large(message) or
+                self.classify(icap_request) in self.kinds):
+            return NoModificationsNeeded()
+        return None
+
+    def too_large(self, message):
+        if self.max_length is None:
+            return False
+        length = message.get('content-length', '').strip()
+        return length.isdigit() and int(length) > self.max_length
+
+    def classify(self, icap_request):
+        """ Return the kind of body `icap_request` carries, or None. """
+        message = encapsulated_message(icap_request)
+        kind = content_type_kind(message.get('content-type', ''))
+        head = preview_head(icap_request.preview_chunks)
+        if head:
+            encoding = message.get('content-encoding',
+                                   'identity').strip().lower()
+            if encoding in ('identity', 'none', '') and sniff(head) == kind:
+                return kind
+            # other bytes, or encoded ones, cannot confirm the label
+            return None
+        if self.trust_content_type:
+            return kind
+        return None
@@ -1,50 +1,211 @@
-""" HTTP content decoding. """
+""" HTTP content decoding and encoding.
+
+Decoders raise `DecodeError` when a body cannot be decoded within their
+limits.  The handler answers 204 to a service that reads the body, or
+whose streamed response fails on its first chunk, while that is still
+allowed; a streamed response that fails later is cut short and the
+connection closed.
+"""
 
 from __future__ import unicode_literals
 import zlib
+from functools import partial
 import brotli
+try:
+    # brotlipy
+    from brotli._brotli import ffi as brotli_ffi, lib as brotli_lib
+except ImportError:
+    brotli_ffi = brotli_lib = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+#: Most output of one decompression step, so that a small compressed
+#: chunk never expands into one large string.
+DECODE_STEP_SIZE = 65536
+
+#: Most output of a decoded body, None for no limit.
+MAX_DECODED_SIZE = 256 * 1024 * 1024
+
+#: Most output per byte of input, None for no limit.  Only checked once
+#: more than `RATIO_MIN_SIZE` bytes were decoded, as small bodies often
+#: compress very well.
+MAX_EXPANSION_RATIO = 200
+RATIO_MIN_SIZE = 1024 * 1024
+
+INFINITY = float('inf')
+
+
+class DecodeError(Exception):
+    """ A body cannot be decoded. """
+
+
+class DecodeLimitExceeded(DecodeError):
+    """ A body decodes to more than the decoder's limits allow. """
 
-def decode_identity(chunks):
+
+class UnsupportedEncoding(DecodeError):
+    """ A body is encoded with a coding there is no decoder for. """
+
+
+def decode_identity(chunks, **limits):
 
     for chunk in chunks:
         yield chunk
 
 
-def decode_deflate(chunks, z=None):
+class BrotliDecompressor(object):
+    """ A brotli decompressor with the `max_length` and `unconsumed_tail`
+    of `zlib.decompressobj`, which brotli's own does not have.
+    """
+
+    def __init__(self):
+        if brotli_lib is not None:
+            self.decoder = brotli_ffi.gc(
+                brotli_lib.BrotliDecoderCreateInstance(
+                    brotli_ffi.NULL, brotli_ffi.NULL, brotli_ffi.NULL),
+                brotli_lib.BrotliDecoderDestroyInstance)
+        else:
+            self.decoder = brotli.Decompressor()
+        self.unconsumed_tail = b''
+
+    def decompress(self, data, max_length):
+        if brotli_lib is None:
+            # the brotli module, which keeps the input it has not used
+            # and may return somewhat more than the limit
+            return self.decoder.process(data, output_buffer_limit=max_length)
+
+        # brotlipy
+        available_in = brotli_ffi.new('size_t *', len(data))
+        next_in = brotli_ffi.new('uint8_t **',
+                                 brotli_ffi.from_buffer(data))
+        available_out = brotli_ffi.new('size_t *', max_length)
+        out_buffer = brotli_ffi.new('uint8_t[]', max_length)
+        next_out = brotli_ffi.new('uint8_t **', out_buffer)
+        result = brotli_lib.BrotliDecoderDecompressStream(
+            self.decoder, available_in, next_in, available_out, next_out,
+            brotli_ffi.NULL)
+        if result == brotli_lib.BROTLI_DECODER_RESULT_ERROR:
+            error = brotli_lib.BrotliDecoderErrorString(
+                brotli_lib.BrotliDecoderGetErrorCode(self.decoder))
+            raise brotli.Error(
+                'Decompression error: %s' % brotli_ffi.string(error))
+        self.unconsumed_tail = data[len(data) - available_in[0]:]
+        return brotli_ffi.buffer(out_buffer, max_length - available_out[0])[:]
+
+    def flush(self):
+        return b''
+
+
+def decode_deflate(chunks, z=None, max_size=MAX_DECODED_SIZE,
+                   max_ratio=MAX_EXPANSION_RATIO, step_size=DECODE_STEP_SIZE):
+    """ Decode `chunks` in steps of at most `step_size` bytes of output.
 
+    Raises `DecodeLimitExceeded` once the output is larger than
+    `max_size`, or `max_ratio` times the input.
+    """
     if z is None:
         z = zlib.decompressobj()
         retry = True
     else:
         retry = False
 
+    # check_limits raises once the output passes one of these
+    size_limit = INFINITY if max_size is None else max_size
+    ratio_floor = INFINITY if max_ratio is None else RATIO_MIN_SIZE
+
+    encoded = decoded = 0
     for chunk in chunks:
-        if hasattr(z, 'unconsumed_tail'): # zlib
-            compressed = (z.unconsumed_tail + chunk)
-        else: # brotli
-            compressed = chunk
-        try:
-            decompressed = z.decompress(compressed)
-        except zlib.error:
-            if not retry:
-                raise
-            z = zlib.decompressobj(-zlib.MAX_WBITS)
+        encoded += len(chunk)
+        compressed = chunk
+        while True:
+            try:
+                decompressed = z.decompress(compressed, step_size)
+            except zlib.error:
+                if not retry:
+                    raise
+                # raw deflate without the zlib header
+                z = zlib.decompressobj(-zlib.MAX_WBITS)
+                retry = False
+                decompressed = z.decompress(compressed, step_size)
             retry = False
-            decompressed = z.decompress(compressed)
+            compressed = z.unconsumed_tail
 
-        if decompressed:
-            yield decompressed
+            if decompressed:
+                decoded += len(decompressed)
+                if decoded > size_limit or (decoded > ratio_floor and
+                                            decoded > max_ratio * encoded):
+                    check_limits(encoded, decoded, max_size, max_ratio)
+                yield decompressed
+            # a full step may leave output behind with no input left
+            if not compressed and len(decompressed) < step_size:
+                break
+
+    decompressed = z.flush()
+    if decompressed:
+        check_limits(encoded, decoded + len(decompressed), max_size,
+                     max_ratio)
+        yield decompressed
+
+
+def check_limits(encoded, decoded, max_size, max_ratio):
+    if max_size is not None and decoded > max_size:
+        raise DecodeLimitExceeded(
+            'body decodes to more than %d bytes' % max_size)
+    if (max_ratio is not None and decoded > RATIO_MIN_SIZE and
+            decoded > max_ratio * encoded):
+        raise DecodeLimitExceeded(
+            'body expands more than %d times when decoded' % max_ratio)
 
-    yield z.flush()
 
+def decode_gzip(chunks, **limits):
+    return decode_deflate(chunks, zlib.decompressobj(16 + zlib.MAX_WBITS),
+                          **limits)
 
-def decode_gzip(chunks):
-    return decode_deflate(chunks, zlib.decompressobj(16 + zlib.MAX_WBITS))
 
+def decode_brotli(chunks, **limits):
+    return decode_deflate(chunks, BrotliDecompressor(), **limits)
 
-def decode_brotli(chunks):
-    z = brotli.Decompressor()
-    return decode_deflate(chunks, z)
+
+class ChunkFile(object):
+    """ A file reading `chunks`, for decompressors that pull their input.
+
+    `bytes_read` counts the bytes read so far.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        for chunk in self.chunks:
+            if chunk:
+                self.bytes_read += len(chunk)
+                return chunk
+        return b''
+
+
+def check_output(chunks, source, max_size, max_ratio):
+    """ Check the limits on `chunks` decoded from the `ChunkFile`
+    `source`.
+    """
+    decoded = 0
+    for chunk in chunks:
+        decoded += len(chunk)
+        check_limits(source.bytes_read, decoded, max_size, max_ratio)
+        yield chunk
+
+
+def decode_zstd(chunks, max_size=MAX_DECODED_SIZE,
+                max_ratio=MAX_EXPANSION_RATIO, step_size=DECODE_STEP_SIZE):
+    """ Decode the zstd frames of `chunks`, see `decode_deflate`. """
+    source = ChunkFile(chunks)
+    reader = zstandard.ZstdDecompressor().stream_reader(
+        source, read_across_frames=True)
+    decompressed = iter(partial(reader.read, step_size), b'')
+    return check_output(decompressed, source, max_size, max_ratio)
 
 
 decoders = {
@@ -54,3 +215,151 @@ decoders = {
     'identity': decode_identity,
     'none': decode_identity,
 }
+if zstandard is not None:
+    decoders['zstd'] = decode_zstd
+
+
+def content_codings(content_encoding):
+    """ Return the codings of a `Content-Encoding` value in the order
+    they were applied, without identity.
+    """
+    codings = (coding.strip().lower()
+               for coding in content_encoding.split(','))
+    return [coding for coding in codings
+            if coding and coding not in ('identity', 'none')]
+
+
+def decode_content(content_encoding, chunks, max_size=MAX_DECODED_SIZE,
+                   max_ratio=MAX_EXPANSION_RATIO, step_size=DECODE_STEP_SIZE):
+    """ Decode `chunks` encoded as given by a `Content-Encoding` value.
+
+    Stacked codings (`gzip, br`) are decoded in reverse order, with
+    `max_ratio` checked against the encoded input.  Raises
+    `UnsupportedEncoding` if there is no decoder for one of them.
+    """
+    codings = content_codings(content_encoding)
+    for coding in codings:
+        if coding not in decoders:
+            raise UnsupportedEncoding('no decoder for %r' % coding)
+    if len(codings) < 2:
+        decoder = decoders[codings[0]] if codings else decode_identity
+        return decoder(chunks, max_size=max_size, max_ratio=max_ratio,
+                       step_size=step_size)
+
+    source = ChunkFile(chunks)
+    chunks = iter(source.read, b'')
+    for coding in reversed(codings):
+        chunks = decoders[coding](chunks, max_size=max_size, max_ratio=None,
+                                  step_size=step_size)
+    return check_output(chunks, source, max_size, max_ratio)
+
+
+#: Compression level used when none is given, per encoding.
+DEFAULT_LEVELS = {
+    'br': 5,
+    'deflate': 6,
+    'gzip': 6,
+    'zstd': 3,
+}
+
+
+def encode_identity(chunks, level=None):
+
+    for chunk in chunks:
+        yield chunk
+
+
+def encode_deflate(chunks, level=None, wbits=zlib.MAX_WBITS):
+
+    if level is None:
+        level = DEFAULT_LEVELS['deflate']
+    z = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    for chunk in chunks:
+        compressed = z.compress(chunk)
+        if compressed:
+            yield compressed
+
+    yield z.flush()
+
+
+def encode_gzip(chunks, level=None):
+    if level is None:
+        level = DEFAULT_LEVELS['gzip']
+    return encode_deflate(chunks, level, 16 + zlib.MAX_WBITS)
+
+
+def encode_brotli(chunks, level=None):
+
+    if level is None:
+        level = DEFAULT_LEVELS['br']
+    z = brotli.Compressor(quality=level)
+    if brotli_lib is None:
+        # the brotli module
+        compress = z.process
+    else:
+        # brotlipy
+        compress = z.compress
+    for chunk in chunks:
+        compressed = compress(chunk)
+        if compressed:
+            yield compressed
+
+    yield z.finish()
+
+
+def encode_zstd(chunks, level=None):
+
+    if level is None:
+        level = DEFAULT_LEVELS['zstd']
+    z = zstandard.ZstdCompressor(level=level).compressobj()
+    for chunk in chunks:
+        compressed = z.compress(chunk)
+        if compressed:
+            yield compressed
+
+    yield z.flush()
+
+
+encoders = {
+    'br': encode_brotli,
+    'deflate': encode_deflate,
+    'gzip': encode_gzip,
+    'identity': encode_identity,
+    'none': encode_identity,
+}
+if zstandard is not None:
+    encoders['zstd'] = encode_zstd
+
+#: Encodings `accepted_encoding` picks from, most preferred first.
+PREFERRED_ENCODINGS = tuple(coding
+                            for coding in ('br', 'zstd', 'gzip', 'deflate')
+                            if coding in encoders)
+
+
+def accepted_encoding(accept_encoding, available=PREFERRED_ENCODINGS):
+    """ Return the encoding of `available` preferred by an
+    `Accept-Encoding` value, or 'identity'.
+
+    Of encodings with the same quality the first in `available` wins.
+    """
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding] = quality
+    best = 'identity'
+    best_quality = 0.0
+    for coding in available:
+        quality = qualities.get(coding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
@@ -7,6 +7,11 @@ import re
 from .response import BadComposition
 
 
+#: Largest offset accepted, the most bytes of encapsulated headers that
+#: are read before the body.
+MAX_ENCAPSULATED_LEN = 65536
+
+
 encapsulated_list = re.compile('''
     \s*
     (?: (req-hdr) \s* = \s* (\d+) \s* , \s*)?
@@ -17,7 +22,7 @@ encapsulated_list = re.compile('''
 ''', re.VERBOSE)
 
 
-def encapsulated_offsets(header):
+def encapsulated_offsets(header, max_offset=MAX_ENCAPSULATED_LEN):
 
     if not header:
         return []
@@ -34,6 +39,10 @@ def encapsulated_offsets(header):
         offset = int(offset)
         if offset < previous_offset:
             raise BadComposition(reason="unordered offsets in 'encapsulated' header")
+        if offset > max_offset:
+            raise BadComposition(
+                reason="offset in 'encapsulated' header beyond %d" %
+                max_offset)
         offsets.append((name, offset))
         previous_offset = offset
     return offsets
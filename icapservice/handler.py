@@ -1,16 +1,28 @@
 from __future__ import print_function
 import socket
 import logging
-from itertools import chain
+from functools import partial
 from six.moves.socketserver import (StreamRequestHandler,
                                     ThreadingMixIn,
                                     ForkingMixIn)
 from six.moves import BaseHTTPServer
-from .request import ICAPRequest
-from .response import ICAPResponse, ServiceNotFound, MethodNotAllowed
+from .request import ICAPRequest, ChunkError
+from .lifecycle import RequestReader, ConnectionTracker, clock
+from .content import DecodeError
+from .response import (ICAPResponse,
+                       NoModificationsNeeded,
+                       ServiceNotFound,
+                       MethodNotAllowed,
+                       ServiceOverloaded)
+from .limits import service_limits
+from .writer import (ResponseWriter,
+                     coalesce,
+                     WRITE_BUFFER_SIZE,
+                     FLUSH_DELAY)
 
 
-FINAL_CHUNK = b'0\r\n\r\n'
+#: ICAP methods defined by RFC 3507.
+STANDARD_METHODS = ('OPTIONS', 'REQMOD', 'RESPMOD')
 
 
 def service_abs_path(service):
@@ -20,6 +32,36 @@ def service_abs_path(service):
 class ICAPServer(BaseHTTPServer.HTTPServer):
     """ ICAP Server. """
 
+    #: Set `SO_REUSEPORT` on the listening socket so several processes
+    #: can each bind their own socket to the same address.
+    reuse_port = False
+
+    #: Set by `drain`, handlers close their connection after the
+    #: current request.
+    draining = False
+
+    def __init__(self, *args, **kwargs):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+        self.connection_tracker = ConnectionTracker()
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        BaseHTTPServer.HTTPServer.server_bind(self)
+
+    def drain(self, timeout=None):
+        """ Shut down gracefully.
+
+        Stops accepting connections, closes idle persistent connections
+        and waits up to `timeout` seconds for in-flight requests to
+        finish.  Like `shutdown` this must be called while
+        `serve_forever` is running in another thread.  Returns True if
+        all connections were closed.
+        """
+        self.draining = True
+        self.shutdown()
+        return self.connection_tracker.drain(timeout)
+
 
 class ThreadingICAPServer(ThreadingMixIn, ICAPServer):
     """ ICAP Server using threading. """
@@ -37,11 +79,58 @@ class ICAPRequestHandler(StreamRequestHandler):
     #: The easiest way to do this is using `ICAPRequestHandler.for_services`.
     service_map = None
 
+    #: Map of `Abs_Path` to the `ConcurrencyLimit` of the service, for
+    #: services with a `max_concurrency`.  Set by `for_services`.
+    service_limits = None
+
     #: Response headers.
     response_headers = None
 
     log = None
 
+    #: Response data is written in batches of at least this many bytes
+    #: (see `ResponseWriter`), 0 writes each chunk as it is produced.
+    #: Only a list or tuple of chunks is batched, chunks from an iterator
+    #: are written as they are produced.
+    write_buffer_size = WRITE_BUFFER_SIZE
+
+    #: Response chunks smaller than this are merged (see `coalesce`),
+    #: 0 sends the chunks exactly as the service produced them.  Merged
+    #: data waits for the next chunk however long that takes, so this is
+    #: off by default; `COALESCE_SIZE` suits services whose chunks are
+    #: produced without waiting.
+    coalesce_size = 0
+
+    #: Maximum number of seconds output is held back by coalescing and
+    #: batched writes.
+    flush_delay = FLUSH_DELAY
+
+    #: Seconds to wait for the next request on a persistent connection
+    #: (None waits forever).
+    idle_timeout = None
+
+    #: Seconds allowed to read the ICAP and encapsulated HTTP headers
+    #: and any preview, counted from the first byte of the request.
+    header_timeout = None
+
+    #: Seconds to wait for each read of the request body.
+    body_timeout = None
+
+    #: Close persistent connections after this many requests.
+    max_requests = None
+
+    #: A `MetricsRegistry` to record request metrics in, or None.
+    metrics = None
+
+    #: An `AccessLog` to queue access log records on, or None to log
+    #: each response to `log` directly.
+    access_log = None
+
+    #: Unread request bodies are skipped so the connection can be reused,
+    #: unless more than this many bytes remain, in which case the
+    #: connection is closed instead.  None always skips the body.
+    discard_limit = None
+
     # The server=None default is to support `gevent.server.StreamServer`
     def __init__(self, request, client_address, server=None):
         StreamRequestHandler.__init__(self, request, client_address, server)
@@ -55,42 +144,160 @@ class ICAPRequestHandler(StreamRequestHandler):
                        service for service in services}
         classdict = {
             'service_map': service_map,
+            'service_limits': service_limits(service_map),
             'log': logging.getLogger(__name__),
             'persistent_connections': True,
         }
         classdict.update(kwargs)
         return type(name, bases, classdict)
 
+    def setup(self):
+        StreamRequestHandler.setup(self)
+        self.rfile = RequestReader(self.rfile, self.connection)
+        self.requests_handled = 0
+
+    @classmethod
+    def for_connection(cls, request, client_address, server):
+        """ Return a handler set up for a connection, without handling it.
+
+        Used by servers that call `handle_one_request` themselves as
+        requests arrive (see `PoolingICAPServer`).
+        """
+        handler = cls.__new__(cls)
+        handler.request = request
+        handler.client_address = client_address
+        handler.server = server
+        handler.setup()
+        handler.close_connection = 0
+        return handler
+
+    @classmethod
+    def service_method(cls, icap_request):
+        """ Return the `(service, method)` pair for `icap_request`.
+
+        Raises `ServiceNotFound` or `MethodNotAllowed` if the request
+        cannot be dispatched.
+        """
+        service = cls.service_map.get(icap_request.abs_path)
+        if service is None:
+            raise ServiceNotFound()
+
+        if (icap_request.method not in service.icap_methods and
+            icap_request.method != 'OPTIONS'):
+            raise MethodNotAllowed()
+
+        method = getattr(service, icap_request.method, None)
+        if method is None:
+            raise MethodNotAllowed()
+
+        return service, method
+
+    @classmethod
+    def service_limit(cls, icap_request):
+        """ Return the `ConcurrencyLimit` that applies to `icap_request`.
+
+        OPTIONS requests are never limited.
+        """
+        if not cls.service_limits or icap_request.method == 'OPTIONS':
+            return None
+        return cls.service_limits.get(icap_request.abs_path)
+
+    @classmethod
+    def classify(cls, service, icap_request):
+        """ Return a 204 from the service's `verdict_cache`, or the first
+        response given by its classifiers.
+
+        Returns None if there is none, or a 204 is no longer allowed.
+        """
+        if (icap_request.method == 'OPTIONS' or
+                not icap_request.can_respond_204):
+            return None
+        verdict_cache = getattr(service, 'verdict_cache', None)
+        if verdict_cache is not None:
+            icap_response = verdict_cache.lookup(icap_request, service.istag)
+            if icap_response is not None:
+                return icap_response
+        for classifier in getattr(service, 'classifiers', ()):
+            icap_response = classifier(icap_request)
+            if icap_response is not None:
+                return icap_response
+        return None
+
+    @classmethod
+    def service_response(cls, method, icap_request):
+        """ Return the response of the service `method` to `icap_request`.
+
+        A service reading a body that cannot be decoded within its limits
+        (see `icapservice.content`) is answered with 204 if that is still
+        allowed, so the client sends the message on unmodified.  A body
+        decoded as the response is streamed gets the same answer if the
+        first step of decoding fails (see `respond`); once the response
+        has started it can only be cut short by closing the connection.
+        """
+        try:
+            return method(icap_request)
+        except DecodeError as exc:
+            return cls.decode_error_response(icap_request, exc)
+
+    @classmethod
+    def decode_error_response(cls, icap_request, exc):
+        """ Return a 204 for a `DecodeError`, or raise it again if a 204
+        is no longer allowed.
+        """
+        if not icap_request.can_respond_204:
+            raise exc
+        cls.log.warning("%s, not modified", exc)
+        icap_response = NoModificationsNeeded()
+        icap_response.inspected = False
+        return icap_response
+
+    @classmethod
+    def decode_error_fallback(cls, icap_request, icap_response, exc):
+        """ Return the `decode_error_response` to send instead of
+        `icap_response`, whose chunks raised `exc` before any were sent.
+        """
+        fallback = cls.decode_error_response(icap_request, exc)
+        fallback.headers.merge(icap_response.headers)
+        return fallback
 
     def handle_one_request(self):
         """ Handle a single ICAP request. """
 
         icap_response = None
         icap_request = None
+        limit = None
+        parsed = admitted = serviced = responded = None
 
         try:
 
+            self.rfile.expect_request(self.idle_timeout, self.header_timeout)
             icap_request = ICAPRequest.parse(self.rfile,
                                              self.send_continue_after_preview)
             if icap_request is None:
                 return
-
-            service = self.service_map.get(icap_request.abs_path)
-            if service is None:
-                icap_response = ServiceNotFound()
+            parsed = clock()
+            self.rfile.set_timeout(self.body_timeout)
+            self.requests_handled += 1
+
+            try:
+                service, method = self.service_method(icap_request)
+            except (ServiceNotFound, MethodNotAllowed) as exc:
+                icap_response = exc
                 return
 
-            if (icap_request.method not in service.icap_methods and
-                icap_request.method != 'OPTIONS'):
-                icap_response = MethodNotAllowed()
-                return
-
-            method = getattr(service, icap_request.method, None)
-            if method is None:
-                icap_response = MethodNotAllowed()
-                return
-
-            icap_response = method(icap_request)
+            icap_response = self.classify(service, icap_request)
+            if icap_response is None:
+                limit = self.service_limit(icap_request)
+                if limit is not None:
+                    try:
+                        limit.acquire()
+                    except ServiceOverloaded as exc:
+                        limit = None
+                        icap_response = exc
+                        return
+                admitted = clock()
+                icap_response = self.service_response(method, icap_request)
+            serviced = clock()
             icap_response.headers.merge(service.response_headers or {})
 
             if self.persistent_connections:
@@ -98,31 +305,127 @@ class ICAPRequestHandler(StreamRequestHandler):
             else:
                 self.close_connection = True
 
+            if (self.max_requests and
+                    self.requests_handled >= self.max_requests):
+                self.close_connection = True
+            if getattr(self.server, 'draining', False):
+                self.close_connection = True
 
         except socket.timeout as exc:
 
-            self.log.error("request timed out: %r", exc)
+            if self.rfile.waiting:
+                self.log.debug("idle connection timed out")
+            else:
+                self.log.error("request timed out: %r", exc)
             self.close_connection = 1
 
         finally:
 
-            if icap_response is not None:
-                self.respond(icap_request, icap_response)
-            else:
+            try:
+                if icap_response is not None:
+                    try:
+                        bytes_written = self.respond(icap_request,
+                                                     icap_response)
+                        responded = clock()
+                    except socket.timeout as exc:
+                        self.log.error("response timed out: %r", exc)
+                        self.close_connection = 1
+                    except DecodeError as exc:
+                        # the response has been started, or a 204 is
+                        # not allowed
+                        self.log.error("response cut short: %s", exc)
+                        self.close_connection = 1
+                else:
+                    self.close_connection = 1
+            finally:
+                # streamed responses are produced while they are written
+                if limit is not None:
+                    limit.release()
+
+            # a connection being closed (perhaps because it stalled) is
+            # not read from again
+            if icap_request is not None and not self.close_connection:
+                self.discard(icap_request)
+
+            if self.metrics is not None and responded is not None:
+                self.record_metrics(icap_request, icap_response,
+                                    self.rfile.started_at, parsed, admitted,
+                                    serviced, responded,
+                                    self.rfile.bytes_read, bytes_written)
+
+    def discard(self, icap_request):
+        """ Skip the rest of the request body, or close the connection if
+        that is not possible.
+        """
+        try:
+            if not icap_request.discard(self.discard_limit):
                 self.close_connection = 1
+        except socket.timeout as exc:
+            self.log.error("request timed out: %r", exc)
+            self.close_connection = 1
+        except (ChunkError, ValueError) as exc:
+            self.log.error("bad request body: %r", exc)
+            self.close_connection = 1
 
-            if icap_request:
-                # consume any remaining chunks
-                for chunk in icap_request.chunks:
-                    pass
+    @classmethod
+    def record_metrics(cls, icap_request, icap_response, started, parsed,
+                       admitted, serviced, responded, bytes_read,
+                       bytes_written):
+        """ Record the metrics of a request in `cls.metrics`.
+
+        `started` to `responded` are `clock` times: when the first byte
+        of the request arrived, when its headers had been parsed, when
+        the service was admitted (past any `service_limits`), when it
+        returned and when the response was written.
+        """
+        metrics = cls.metrics
+        service = cls.service_map.get(icap_request.abs_path)
+        if service is not None:
+            icap_methods = service.icap_methods
+            service_label = icap_request.abs_path
+        else:
+            icap_methods = STANDARD_METHODS
+            service_label = '-'
+        method = icap_request.method
+        if method != 'OPTIONS' and method not in icap_methods:
+            method = 'other'
+        labels = (('service', service_label), ('method', method))
+
+        status = str(getattr(icap_response, 'status_code', icap_response))
+        metrics.inc('icap_requests_total', labels + (('status', status),))
+        if started is not None:
+            metrics.observe('icap_parse_seconds', labels, parsed - started)
+        if (admitted is not None and
+                cls.service_limit(icap_request) is not None):
+            metrics.observe('icap_queue_seconds', labels, admitted - parsed)
+        if serviced is not None:
+            metrics.observe('icap_service_seconds', labels,
+                            serviced - (admitted or parsed))
+            metrics.observe('icap_write_seconds', labels,
+                            responded - serviced)
+        metrics.inc('icap_request_bytes_total', labels, bytes_read)
+        metrics.inc('icap_response_bytes_total', labels, bytes_written)
+        if icap_request.preview is not None:
+            metrics.inc('icap_preview_requests_total', labels)
+            if icap_request.continued:
+                metrics.inc('icap_preview_continued_total', labels)
 
     def handle(self):
-         """Handle multiple requests if necessary."""
-         self.close_connection = 0
+        """Handle multiple requests if necessary."""
+        self.close_connection = 0
 
-         self.handle_one_request()
-         while not self.close_connection:
-             self.handle_one_request()
+        tracker = getattr(self.server, 'connection_tracker', None)
+        if tracker is not None:
+            self.rfile.on_request = partial(tracker.set_busy, self)
+
+        try:
+            while not self.close_connection:
+                if tracker is not None and not tracker.set_idle(self):
+                    break
+                self.handle_one_request()
+        finally:
+            if tracker is not None:
+                tracker.remove(self)
 
     def respond(self, icap_request, icap_response):
 
@@ -136,38 +439,89 @@ class ICAPRequestHandler(StreamRequestHandler):
         if self.close_connection:
             icap_response.headers['Connection'] = 'close'
 
-        http_request = icap_request.http_request
-        http_request_method = http_request and http_request.method or '?'
-        http_request_uri = http_request and http_request.uri or '?'
-
-        self.log.info('"%s %s %s %s" - %s',
-                      icap_request.method,
-                      icap_request.abs_path,
-                      http_request_method,
-                      http_request_uri,
-                      icap_response.status_code)
-
-        if icap_response.status_code == 204:
-            icap_request.eof = True
-        elif 200 <= icap_response.status_code < 300:
+        # after a 204 the rest of the body is skipped (see `discard`)
+        if (200 <= icap_response.status_code < 300 and
+                icap_response.status_code != 204):
             icap_request.continue_after_preview()
 
-        chunks = iter(icap_response.chunks)
+        chunks = icap_response.chunks
+        if self.coalesce_size:
+            chunks = coalesce(chunks, self.coalesce_size, self.flush_delay)
+        chunks = iter(chunks)
         try:
             first_chunk = [next(chunks)]
         except StopIteration:
             first_chunk = []
+        except DecodeError as exc:
+            # nothing has been sent yet
+            icap_response = self.decode_error_fallback(icap_request,
+                                                       icap_response, exc)
+            chunks = iter(())
+            first_chunk = []
+
+        self.log_response(icap_request, icap_response)
+        self.record_outcome(icap_request, icap_response)
 
         header_bytes = icap_response.header_bytes(first_chunk)
 
-        self.wfile.write(header_bytes)
+        writer = ResponseWriter(self.connection, self.wfile,
+                                self.write_buffer_size,
+                                self.flush_delay)
+        writer.write(header_bytes)
 
-        for chunk in chain(first_chunk, chunks):
-            formatted = b'{:x}\r\n{}\r\n'.format(len(chunk), chunk)
-            self.wfile.write(formatted)
+        # the next chunk from an iterator may be slow to come, what has
+        # been produced so far is not held back waiting for it
+        streamed = not isinstance(icap_response.chunks, (list, tuple))
+        if first_chunk:
+            writer.write_chunk(first_chunk[0])
+        if streamed:
+            writer.flush()
+        for chunk in chunks:
+            writer.write_chunk(chunk)
+            if streamed:
+                writer.flush()
 
         if first_chunk:
-            self.wfile.write(FINAL_CHUNK)
+            writer.write_final_chunk()
+
+        writer.flush()
+        return writer.bytes_written
+
+    @classmethod
+    def log_response(cls, icap_request, icap_response):
+        """ Write the access log line for a response. """
+        if cls.access_log is not None:
+            cls.access_log.record(icap_request, icap_response)
+            return
+
+        http_request = icap_request.http_request
+        if http_request is not None:
+            http_request_method = http_request.method
+            http_request_uri = http_request.uri
+        else:
+            http_request_method = http_request_uri = '?'
+
+        cls.log.info('"%s %s %s %s" - %s',
+                     icap_request.method,
+                     icap_request.abs_path,
+                     http_request_method,
+                     http_request_uri,
+                     icap_response.status_code)
+
+    @classmethod
+    def record_outcome(cls, icap_request, icap_response):
+        """ Pass the response to the service's `adaptive_options` and
+        `verdict_cache`.
+        """
+        if icap_request.method == 'OPTIONS':
+            return
+        service = cls.service_map.get(icap_request.abs_path)
+        adaptive_options = getattr(service, 'adaptive_options', None)
+        if adaptive_options is not None:
+            adaptive_options.record(icap_request, icap_response)
+        verdict_cache = getattr(service, 'verdict_cache', None)
+        if verdict_cache is not None:
+            verdict_cache.store(icap_request, icap_response, service.istag)
 
     def send_continue_after_preview(self):
         icap_response = ICAPResponse(100)
@@ -0,0 +1,217 @@
+""" A compact header multimap for ICAP and encapsulated HTTP messages.
+
+`Headers` keeps the fields of a header block in order, with lookups
+ignoring case, and has the mapping API services used on the
+`HTTPMessage` it replaces: `get`, `[]`, `del`, `in`.  As there, `get`
+joins the values of a repeated header with ", ", setting a header
+replaces all its values and deleting a missing header is not an error.
+
+The block a message was parsed from is kept and written back unchanged
+until a header is set or deleted.  A message made with `from_bytes`
+only parses its block when a header is looked up.  The list of fields
+is never changed in place once parsed, a change replaces it, so `copy`
+is cheap: the copy shares the fields and the raw block of the original
+until one of them is modified.
+"""
+from __future__ import print_function
+from six import PY2
+
+
+BLANK_LINES = (b'\r\n', b'\n', b'')
+
+
+_slot_names = {}
+
+
+def slot_names(cls):
+    """ Return the names of the slots of `cls` and its bases. """
+    names = _slot_names.get(cls)
+    if names is None:
+        names = []
+        for base in cls.__mro__:
+            slots = base.__dict__.get('__slots__', ())
+            if isinstance(slots, str):
+                slots = (slots,)
+            names.extend(name for name in slots if name != '__dict__')
+        _slot_names[cls] = names
+    return names
+
+
+class Headers(object):
+
+    __slots__ = ('fp', '_fields', '_raw')
+
+    def __init__(self, rfile=None):
+        self.fp = rfile
+        #: `(lower case name, name, value)` of each field.
+        self._fields = []
+        self._raw = b''
+        if rfile is not None:
+            self.read_fields(rfile)
+
+    @classmethod
+    def from_bytes(cls, block):
+        """ Return a message with the header lines in `block`.
+
+        The block is only parsed when a header is first looked up, a
+        message that is passed on unchanged writes `block` as it is.
+        """
+        message = cls.__new__(cls)
+        message.fp = None
+        message._raw = block
+        return message
+
+    def __getattr__(self, name):
+        # `_fields` is not set until needed by a message from `from_bytes`
+        if name != '_fields':
+            raise AttributeError(name)
+        self._fields = []
+        self.parse_fields(self._raw)
+        return self._fields
+
+    def read_fields(self, rfile):
+        """ Read and parse header lines up to and including a blank line. """
+        lines = []
+        readline = rfile.readline
+        while True:
+            line = readline()
+            if line in BLANK_LINES:
+                break
+            lines.append(line)
+        self.parse_fields(b''.join(lines))
+
+    def parse_fields(self, block):
+        """ Parse a block of header lines, without the blank line ending it.
+
+        Folded continuation lines are joined to the previous value, lines
+        that are not headers are ignored.
+        """
+        self._raw = block
+        if not PY2:
+            block = block.decode('iso-8859-1')
+        fields = self._fields
+        for line in block.split('\n'):
+            if line[:1] in (' ', '\t'):
+                if fields:
+                    lname, name, value = fields[-1]
+                    fields[-1] = (lname, name, value + ' ' + line.strip())
+                continue
+            name, sep, value = line.partition(':')
+            if sep:
+                name = name.rstrip()
+                fields.append((name.lower(), name, value.strip()))
+
+    def header_bytes(self):
+        """ Return the header lines, without the blank line ending them. """
+        if self._raw is None:
+            lines = ''.join(['{}: {}\r\n'.format(name, value)
+                             for _, name, value in self._fields])
+            self._raw = lines if PY2 else lines.encode('iso-8859-1')
+        return self._raw
+
+    def copy(self):
+        """ Return a copy of the message, without `fp`. """
+        cls = type(self)
+        message = cls.__new__(cls)
+        for name in slot_names(cls):
+            try:
+                # not getattr, that would parse an unparsed block
+                value = object.__getattribute__(self, name)
+            except AttributeError:
+                continue
+            setattr(message, name, value)
+        if hasattr(self, '__dict__'):
+            message.__dict__.update(self.__dict__)
+        message.fp = None
+        return message
+
+    def __deepcopy__(self, memo):
+        # names and values are strings and the fields are not changed
+        # in place
+        return self.copy()
+
+    @property
+    def headers(self):
+        """ The header lines, as `HTTPMessage.headers`. """
+        return self.header_bytes().splitlines(True)
+
+    def get(self, name, default=None):
+        name = name.lower()
+        values = [value for lname, _, value in self._fields if lname == name]
+        if not values:
+            return default
+        if len(values) == 1:
+            return values[0]
+        return ', '.join(values)
+
+    getheader = get
+
+    def get_all(self, name, default=None):
+        """ Return the list of values of header `name`. """
+        name = name.lower()
+        values = [value for lname, _, value in self._fields if lname == name]
+        return values or default
+
+    def getheaders(self, name):
+        return self.get_all(name, [])
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        lname = name.lower()
+        fields = [field for field in self._fields if field[0] != lname]
+        fields.append((lname, name, value))
+        self._fields = fields
+        self._raw = None
+
+    def __delitem__(self, name):
+        name = name.lower()
+        fields = [field for field in self._fields if field[0] != name]
+        if len(fields) != len(self._fields):
+            self._fields = fields
+            self._raw = None
+
+    def setdefault(self, name, value):
+        current = self.get(name)
+        if current is None:
+            self[name] = value
+            return value
+        return current
+
+    def __contains__(self, name):
+        name = name.lower()
+        return any(lname == name for lname, _, _ in self._fields)
+
+    def keys(self):
+        """ Return the lower case header names, without repeats. """
+        keys = []
+        seen = set()
+        for lname, _, _ in self._fields:
+            if lname not in seen:
+                seen.add(lname)
+                keys.append(lname)
+        return keys
+
+    def values(self):
+        return [self[name] for name in self.keys()]
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(set(lname for lname, _, _ in self._fields))
+
+    def __bool__(self):
+        if self._raw:
+            # there are headers, no need to parse the block
+            return True
+        return bool(self._fields)
+
+    __nonzero__ = __bool__
@@ -0,0 +1,277 @@
+""" Connection lifecycle: read timeouts and graceful draining. """
+
+from __future__ import print_function
+import time
+import select
+import socket
+import threading
+from .request import MAX_REQUEST_LEN
+from .response import RequestURITooLong
+
+
+clock = getattr(time, 'monotonic', time.time)
+
+
+def has_buffered_input(rfile, connection):
+    """ Return True if data can be read from `rfile` without waiting. """
+    rbuf = getattr(rfile, '_rbuf', None)
+    if rbuf is not None:
+        # Python 2 `socket._fileobject`
+        return rbuf.tell() > 0
+    # Python 3 `io.BufferedReader`, peek without blocking
+    timeout = connection.gettimeout()
+    connection.setblocking(False)
+    try:
+        return bool(rfile.peek(1))
+    except (IOError, OSError):
+        return False
+    finally:
+        connection.settimeout(timeout)
+
+
+class RequestReader(object):
+    """ Wraps a handler's `rfile`, applying its read timeouts.
+
+    `expect_request` arms the idle timeout for the wait before the next
+    request; as soon as the request starts to arrive the header
+    deadline starts.  Until the body, reads are split so that each
+    receives from the socket at most once, with the socket timeout set
+    to the time left before the deadline, so a client trickling bytes
+    cannot hold the connection past the deadline.  Header lines are
+    limited to `MAX_REQUEST_LEN` bytes then.  `set_timeout` applies a
+    timeout to each read of the request body.
+
+    Socket timeouts are only changed when they differ from the current
+    one, so with no timeouts configured the socket is never touched.
+    """
+
+    def __init__(self, rfile, connection):
+        self.rfile = rfile
+        self.connection = connection
+        self.timeout = None
+        self.deadline = None
+        self.header_timeout = None
+        self.waiting = False
+        #: Called when the first bytes of a request arrive.
+        self.on_request = None
+        #: When the current request started to arrive.
+        self.started_at = None
+        #: Bytes read since `expect_request`.
+        self.bytes_read = 0
+        if not hasattr(rfile, 'readinto'):
+            # Python 2 socket files, readers check for readinto with getattr
+            self.readinto = None
+            if (getattr(rfile, '_rbuf', None) is not None and
+                    hasattr(connection, 'recv_into')):
+                self.readinto = self.readinto_socket
+
+    def __getattr__(self, name):
+        return getattr(self.rfile, name)
+
+    def expect_request(self, idle_timeout, header_timeout):
+        self.waiting = True
+        self.bytes_read = 0
+        self.deadline = None
+        self.header_timeout = header_timeout
+        self.settimeout(idle_timeout)
+
+    def set_timeout(self, timeout):
+        self.waiting = False
+        self.deadline = None
+        self.settimeout(timeout)
+
+    def settimeout(self, timeout):
+        if timeout != self.timeout:
+            self.connection.settimeout(timeout)
+            self.timeout = timeout
+
+    def readline(self, size=-1):
+        self.before_read()
+        if self.deadline is None:
+            line = self.rfile.readline(size)
+        else:
+            line = self.readline_before_deadline(size)
+        self.after_read(line)
+        return line
+
+    def read(self, size=-1):
+        self.before_read()
+        if self.deadline is None or size is None or size < 0:
+            data = self.rfile.read(size)
+        else:
+            data = self.read_before_deadline(size)
+        self.after_read(data)
+        return data
+
+    def readline_before_deadline(self, size):
+        limit = size
+        if size is None or size < 0:
+            limit = MAX_REQUEST_LEN + 1
+        pieces = []
+        length = 0
+        while length < limit:
+            if pieces:
+                self.settimeout_until_deadline()
+            piece = self.rfile.readline(min(self.next_read_size(),
+                                            limit - length))
+            if not piece:
+                break
+            pieces.append(piece)
+            length += len(piece)
+            if piece.endswith(b'\n'):
+                break
+        if limit != size and length > MAX_REQUEST_LEN:
+            raise RequestURITooLong()
+        return b''.join(pieces)
+
+    def read_before_deadline(self, size):
+        pieces = []
+        length = 0
+        while length < size:
+            if pieces:
+                self.settimeout_until_deadline()
+            piece = self.rfile.read(min(self.next_read_size(),
+                                        size - length))
+            if not piece:
+                break
+            pieces.append(piece)
+            length += len(piece)
+        return b''.join(pieces)
+
+    def next_read_size(self):
+        """ Return a size `rfile` can read with at most one receive. """
+        rbuf = getattr(self.rfile, '_rbuf', None)
+        if rbuf is not None:
+            # Python 2 socket file, one byte more than is buffered
+            rbuf.seek(0, 2)
+            return rbuf.tell() + 1
+        peek = getattr(self.rfile, 'peek', None)
+        if peek is not None:
+            # Python 3 `io.BufferedReader`, peek receives at most once
+            return max(len(peek(1)), 1)
+        return MAX_REQUEST_LEN + 1
+
+    def readinto(self, buf):
+        self.before_read()
+        size = self.rfile.readinto(buf)
+        self.bytes_read += size or 0
+        return size
+
+    def readinto_socket(self, buf):
+        """ `readinto` for Python 2 socket files.
+
+        Data already buffered by the file is copied out first, after
+        that data is received straight into `buf`.
+        """
+        self.before_read()
+        rbuf = self.rfile._rbuf
+        rbuf.seek(0, 2)
+        buffered = rbuf.tell()
+        if buffered:
+            data = self.rfile.read(min(buffered, len(buf)))
+            size = len(data)
+            buf[:size] = data
+        else:
+            size = self.connection.recv_into(buf)
+        self.bytes_read += size
+        return size
+
+    def before_read(self):
+        if self.waiting and self.header_timeout is not None:
+            self.wait_for_request()
+        if self.deadline is not None:
+            self.settimeout_until_deadline()
+
+    def settimeout_until_deadline(self):
+        remaining = self.deadline - clock()
+        if remaining <= 0:
+            raise socket.timeout('header deadline exceeded')
+        self.settimeout(remaining)
+
+    def after_read(self, data):
+        self.bytes_read += len(data)
+        if self.waiting and data:
+            self.request_started()
+
+    def wait_for_request(self):
+        """ Wait (up to the idle timeout) until the request starts.
+
+        This lets the header deadline cover the request line too, which
+        would otherwise be read under the idle timeout.
+        """
+        if not has_buffered_input(self.rfile, self.connection):
+            # poll rather than select, which fails for fds >= FD_SETSIZE
+            poller = select.poll()
+            poller.register(self.connection, select.POLLIN | select.POLLPRI)
+            timeout = self.timeout
+            if not poller.poll(None if timeout is None else timeout * 1000):
+                raise socket.timeout('idle timeout')
+        self.request_started()
+
+    def request_started(self):
+        self.waiting = False
+        self.started_at = clock()
+        if self.header_timeout is not None:
+            self.deadline = clock() + self.header_timeout
+        self.settimeout(self.header_timeout)
+        if self.on_request is not None:
+            self.on_request()
+
+
+class ConnectionTracker(object):
+    """ Keeps track of a server's idle and busy connections.
+
+    Draining closes the idle connections (by shutting down their read
+    side, which the handler sees as the client closing) and waits for
+    the busy ones to finish their current request.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.idle = set()
+        self.busy = set()
+        self.draining = False
+
+    def set_idle(self, handler):
+        """ Mark `handler` idle, returns False if it should close instead. """
+        with self.condition:
+            self.busy.discard(handler)
+            if self.draining:
+                self.condition.notify_all()
+                return False
+            self.idle.add(handler)
+            return True
+
+    def set_busy(self, handler):
+        with self.condition:
+            self.idle.discard(handler)
+            self.busy.add(handler)
+
+    def remove(self, handler):
+        with self.condition:
+            self.idle.discard(handler)
+            self.busy.discard(handler)
+            self.condition.notify_all()
+
+    def drain(self, timeout=None):
+        """ Close idle connections and wait for busy ones.
+
+        Returns True if all connections closed within `timeout` seconds.
+        """
+        deadline = None if timeout is None else clock() + timeout
+        with self.condition:
+            self.draining = True
+            for handler in self.idle:
+                try:
+                    handler.connection.shutdown(socket.SHUT_RD)
+                except socket.error:
+                    pass
+            while self.idle or self.busy:
+                if deadline is None:
+                    self.condition.wait()
+                    continue
+                remaining = deadline - clock()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
@@ -0,0 +1,78 @@
+""" Per-service concurrency limits.
+
+A service with `max_concurrency` set handles at most that many requests
+at once; further requests wait in the service's own queue, so a slow
+service cannot hold up the other services on the same handler.
+
+With `PoolingICAPServer` a waiting request occupies one of the pool's
+threads, keep `pool_size` above the sum of the services' concurrency
+and queue limits.  `AsyncICAPServer` does not apply the limits.
+"""
+from __future__ import print_function
+import threading
+from .lifecycle import clock
+from .response import ServiceOverloaded
+
+
+class ConcurrencyLimit(object):
+    """ Admits up to `limit` requests at once.
+
+    Requests above the limit wait, first come first served, in a queue
+    of at most `queue_size` requests (None for no bound) for up to
+    `timeout` seconds (None waits forever).  `ServiceOverloaded` is
+    raised when the queue is full or the wait times out.
+    """
+
+    def __init__(self, limit, queue_size=None, timeout=None):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+
+    def acquire(self):
+        """ Wait for capacity, returns the number of seconds waited. """
+        with self.condition:
+            # queue behind earlier waiters even if a slot is free, the
+            # slot was released for them
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                return 0.0
+            if self.queue_size is not None and self.waiting >= self.queue_size:
+                raise ServiceOverloaded()
+            started = clock()
+            self.waiting += 1
+            try:
+                while self.active >= self.limit:
+                    if self.timeout is None:
+                        self.condition.wait()
+                        continue
+                    remaining = started + self.timeout - clock()
+                    if remaining <= 0:
+                        # pass on a notification this waiter may have taken
+                        self.condition.notify()
+                        raise ServiceOverloaded()
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            return clock() - started
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+
+def service_limits(service_map):
+    """ Return a `ConcurrencyLimit` for each service with a limit. """
+    limits = {}
+    for abs_path, service in service_map.items():
+        max_concurrency = getattr(service, 'max_concurrency', None)
+        if max_concurrency is not None:
+            limits[abs_path] = ConcurrencyLimit(
+                max_concurrency,
+                getattr(service, 'max_queued', None),
+                getattr(service, 'queue_timeout', None))
+    return limits
@@ -1,18 +1,55 @@
 from __future__ import print_function, unicode_literals
-from six.moves.http_client import HTTPMessage
-from six import PY2
+from six import PY2, text_type
+from .headers import Headers
 
 
-START_LINE = b'{} {} {}\r\n'
 CRLF = b'\r\n'
 
 
 def split_start_line(start_line):
-    """ Split the start line (see RFC2616 section 4). """
+    """ Split the start line (see RFC2616 section 4) into native strings.
+    """
+    if not PY2 and isinstance(start_line, bytes):
+        start_line = start_line.decode('iso-8859-1')
     return start_line.rstrip().split(None, 2)
 
 
-class HTTPRequest(HTTPMessage):
+def start_line_bytes(*parts):
+    """ Return the start line made of `parts`, which may be text, bytes
+    or numbers.
+    """
+    return b' '.join(
+        part if isinstance(part, bytes) else
+        text_type(part).encode('iso-8859-1') for part in parts) + CRLF
+
+
+def split_header_section(section):
+    """ Split an encapsulated header section into start line and headers.
+
+    Returns None unless the section ends with the blank line ending its
+    headers, and has no blank line before it.
+    """
+    line_end = section.find(b'\n') + 1
+    if not line_end:
+        return None
+    start_line, rest = section[:line_end], section[line_end:]
+    if rest in (b'\r\n', b'\n'):
+        return start_line, b''
+    if rest.endswith(b'\n\r\n'):
+        block = rest[:-2]
+    elif rest.endswith(b'\n\n'):
+        block = rest[:-1]
+    else:
+        return None
+    lines = b'\n' + block
+    if b'\n\r\n' in lines or b'\n\n' in lines:
+        return None
+    return start_line, block
+
+
+class HTTPRequest(Headers):
+
+    __slots__ = ('method', 'uri', 'protocol')
 
     @classmethod
     def parse(cls, rfile):
@@ -23,17 +60,27 @@ class HTTPRequest(HTTPMessage):
         message.protocol = protocol
         return message
 
+    @classmethod
+    def from_section(cls, start_line, block):
+        """ Return the request, its headers are parsed on first use. """
+        message = cls.from_bytes(block)
+        method, uri, protocol = split_start_line(start_line)
+        message.method = method
+        message.uri = uri
+        message.protocol = protocol
+        return message
+
     def __bytes__(self):
-        start_line = START_LINE.format(self.method,
-                                       self.uri,
-                                       self.protocol)
-        return start_line + b''.join(self.headers) + CRLF
+        start_line = start_line_bytes(self.method, self.uri, self.protocol)
+        return start_line + self.header_bytes() + CRLF
 
     if PY2:
         __str__ = __bytes__
 
 
-class HTTPResponse(HTTPMessage):
+class HTTPResponse(Headers):
+
+    __slots__ = ('protocol', 'status_code', 'reason')
 
     @classmethod
     def parse(cls, rfile):
@@ -44,11 +91,20 @@ class HTTPResponse(HTTPMessage):
         message.reason = reason
         return message
 
+    @classmethod
+    def from_section(cls, start_line, block):
+        """ Return the response, its headers are parsed on first use. """
+        message = cls.from_bytes(block)
+        protocol, status_code, reason = split_start_line(start_line)
+        message.protocol = protocol
+        message.status_code = int(status_code)
+        message.reason = reason
+        return message
+
     def __bytes__(self):
-        start_line = START_LINE.format(self.protocol,
-                                       self.status_code,
-                                       self.reason)
-        return start_line + b''.join(self.headers) + CRLF
+        start_line = start_line_bytes(self.protocol, self.status_code,
+                                      self.reason)
+        return start_line + self.header_bytes() + CRLF
 
     if PY2:
         __str__ = __bytes__
@@ -0,0 +1,225 @@
+""" Request metrics in the Prometheus text format.
+
+Pass a `MetricsRegistry` to the request handler to enable them:
+
+    metrics = MetricsRegistry()
+    handler_class = service.icap_handler_class(metrics=metrics)
+    serve_metrics(metrics, ('127.0.0.1', 9344))
+
+Each thread records into its own shard of the registry so recording a
+value takes no lock; the shards are merged when the metrics are read.
+Metrics are per process, each worker of a `PreforkICAPServer` has its
+own registry.
+"""
+from __future__ import print_function, unicode_literals
+import threading
+from bisect import bisect_left
+from six.moves import BaseHTTPServer
+from .service import ICAPService
+from .response import OK
+
+
+#: Histogram bucket upper bounds in seconds.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+METRICS = {
+    'icap_requests_total': (
+        'counter', 'ICAP requests by service, method and status.'),
+    'icap_parse_seconds': (
+        'histogram', 'Time reading the ICAP and HTTP headers and preview.'),
+    'icap_queue_seconds': (
+        'histogram', 'Time waiting for the service concurrency limit.'),
+    'icap_service_seconds': (
+        'histogram', 'Time spent in the service method.'),
+    'icap_write_seconds': (
+        'histogram', 'Time producing and writing the response.'),
+    'icap_request_bytes_total': (
+        'counter', 'Bytes read from ICAP clients.'),
+    'icap_response_bytes_total': (
+        'counter', 'Bytes written to ICAP clients.'),
+    'icap_preview_requests_total': (
+        'counter', 'Requests sent with a preview.'),
+    'icap_preview_continued_total': (
+        'counter', 'Preview requests that needed the rest of the body.'),
+}
+
+
+def merge(totals, items):
+    for key, value in items:
+        if isinstance(value, list):
+            total = totals.get(key)
+            if total is None:
+                totals[key] = list(value)
+            else:
+                for i, v in enumerate(value):
+                    total[i] += v
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+
+def format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(k, v.replace('\\', '\\\\')
+                                     .replace('"', '\\"')
+                                     .replace('\n', '\\n'))
+               for k, v in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class MetricsRegistry(object):
+    """ Counters and histograms keyed by metric name and labels.
+
+    `labels` are tuples of `(name, value)` pairs.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+        self.retired = {}
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+            return shard
+
+    def inc(self, name, labels=(), value=1):
+        shard = self.shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        shard = self.shard()
+        key = (name, labels)
+        counts = shard.get(key)
+        if counts is None:
+            # one count per bucket, then +Inf, then the sum
+            counts = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def collect(self):
+        """ Return the merged values of all threads.
+
+        Shards of threads that have finished are folded into a single
+        retired shard, so a server using a thread per connection does
+        not accumulate them.
+        """
+        with self.lock:
+            totals = {}
+            merge(totals, self.retired.items())
+            live = []
+            for thread, shard in self.shards:
+                items = list(shard.items())
+                merge(totals, items)
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    merge(self.retired, items)
+            self.shards = live
+        return totals
+
+    def exposition(self):
+        """ Return the metrics in the Prometheus text format. """
+        values = self.collect()
+        lines = []
+        for name in sorted(set(name for name, labels in values)):
+            kind, description = METRICS.get(name, ('untyped', name))
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            series = sorted((labels, value)
+                            for (n, labels), value in values.items()
+                            if n == name)
+            for labels, value in series:
+                if kind == 'histogram':
+                    lines.extend(self.histogram_lines(name, labels, value))
+                else:
+                    lines.append('{}{} {}'.format(name,
+                                                  format_labels(labels),
+                                                  format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def histogram_lines(self, name, labels, counts):
+        cumulative = 0
+        bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, counts):
+            cumulative += count
+            yield '{}_bucket{} {}'.format(name,
+                                          format_labels(labels,
+                                                        [('le', bound)]),
+                                          cumulative)
+        yield '{}_sum{} {}'.format(name, format_labels(labels),
+                                   format_value(counts[-1]))
+        yield '{}_count{} {}'.format(name, format_labels(labels), cumulative)
+
+
+class MetricsService(ICAPService):
+    """ Serves the metrics at an ICAP service path.
+
+    Any REQMOD request to `abs_path` is answered with an HTTP response
+    holding the metrics, so they can be fetched through an ICAP client.
+    """
+
+    abs_path = '/metrics'
+
+    def __init__(self, registry):
+        super(MetricsService, self).__init__()
+        self.registry = registry
+
+    def REQMOD(self, icap_request):
+        body = self.registry.exposition().encode('utf-8')
+        http_response = self.new_http_response(200)
+        http_response['Content-Type'] = CONTENT_TYPE
+        http_response['Content-Length'] = str(len(body))
+        return OK(http_response=http_response, chunks=[body])
+
+
+class MetricsHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves `GET /metrics` over plain HTTP. """
+
+    registry = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(registry, server_address=('127.0.0.1', 9344)):
+    """ Serve `registry` over HTTP from a daemon thread.
+
+    Returns the HTTP server, call `shutdown` on it to stop.
+    """
+    handler_class = type(str('MetricsHandler'),
+                         (MetricsHTTPRequestHandler, object),
+                         {'registry': registry})
+    server = BaseHTTPServer.HTTPServer(server_address, handler_class)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
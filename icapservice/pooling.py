@@ -0,0 +1,274 @@
+""" ICAP server with a bounded pool of worker threads.
+
+`ThreadingICAPServer` dedicates a thread to each connection, and that
+thread sits in `rfile.readline()` for as long as the client keeps an
+idle persistent connection open.  `PoolingICAPServer` instead parks
+idle connections in a `poll` set and only hands a connection to one of
+a fixed number of worker threads when a request arrives on it.
+"""
+from __future__ import print_function
+import os
+import errno
+import select
+import socket
+import threading
+from six.moves.queue import Queue
+from .handler import ICAPServer
+from .lifecycle import clock, has_buffered_input
+
+
+POLL_IN = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+
+
+class PoolingICAPServer(ICAPServer):
+    """ ICAP Server using a fixed pool of threads.
+
+    At most `max_connections` connections are accepted at once; above
+    that the server stops accepting until a connection closes.  If
+    `max_connections` is None the lowest `Max-Connections` advertised
+    by the handler's services is used.
+    """
+
+    #: Number of worker threads handling requests.
+    pool_size = 16
+
+    #: Maximum number of open client connections.
+    max_connections = None
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 bind_and_activate=True):
+        ICAPServer.__init__(self, server_address, RequestHandlerClass,
+                            bind_and_activate)
+        self.connection_limit = self.max_connections
+        if self.connection_limit is None:
+            self.connection_limit = advertised_max_connections(
+                RequestHandlerClass)
+        self.tasks = Queue()
+        self.returned = Queue()
+        self.connections = {}
+        self.parked = {}
+        self.poller = None
+        self.accepting = False
+        self.idle_checked = 0
+        self.wakeup_r = self.wakeup_w = None
+        self.pid = None
+        self.workers = []
+        self.drain_timeout = None
+        self.drained = True
+        self._shutdown_request = False
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+
+    def serve_forever(self, poll_interval=0.5):
+        """ Handle requests until `shutdown` is called. """
+
+        self._is_shut_down.clear()
+        if self.pid != os.getpid():
+            # made here, not in __init__, so that each process forked by
+            # `PreforkICAPServer` polls and wakes up on its own pipe
+            self.pid = os.getpid()
+            self.wakeup_r, self.wakeup_w = os.pipe()
+        self.poller = select.poll()
+        self.accepting = False
+        # a process sharing the listening socket may take the connection
+        # between poll and accept, which must then not block
+        self.socket.setblocking(False)
+        self.start_workers()
+        self.poller.register(self.wakeup_r, select.POLLIN)
+        self.start_accepting()
+        try:
+            while not self._shutdown_request:
+                try:
+                    events = self.poller.poll(poll_interval * 1000)
+                except (OSError, select.error) as exc:
+                    if exc.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for fd, event in events:
+                    if fd == self.wakeup_r:
+                        self.reclaim_connections()
+                    elif fd == self.fileno():
+                        self.accept_connection()
+                    else:
+                        self.dispatch(fd)
+                self.close_idle_connections()
+        finally:
+            self._shutdown_request = False
+            self.drained = self.stop_workers(self.drain_timeout)
+            while not self.returned.empty():
+                self.close(self.returned.get())
+            for fd in list(self.connections):
+                handler = self.connections[fd]
+                if self.drained or fd in self.parked:
+                    self.close(handler)
+                else:
+                    self.abort(handler)
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        """ Stop `serve_forever`, must be called from another thread.
+
+        Requests already being handled are finished before the
+        connections are closed.
+        """
+        self._shutdown_request = True
+        self.wakeup()
+        self._is_shut_down.wait()
+
+    def drain(self, timeout=None):
+        """ Shut down gracefully, see `ICAPServer.drain`.
+
+        In-flight requests are given `timeout` seconds to finish, after
+        that their connections are shut down under the workers still
+        handling them.  Returns True if all requests finished in time.
+        """
+        self.draining = True
+        self.drain_timeout = timeout
+        try:
+            self.shutdown()
+        finally:
+            self.drain_timeout = None
+        return self.drained
+
+    def server_close(self):
+        ICAPServer.server_close(self)
+        if self.pid == os.getpid():
+            os.close(self.wakeup_r)
+            os.close(self.wakeup_w)
+            self.pid = None
+
+    def start_workers(self):
+        for _ in range(self.pool_size):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def stop_workers(self, timeout=None):
+        """ Stop the workers once they finish their current requests.
+
+        Returns False if some were still busy after `timeout` seconds.
+        """
+        for _ in self.workers:
+            self.tasks.put(None)
+        deadline = None if timeout is None else clock() + timeout
+        for worker in self.workers:
+            if deadline is None:
+                worker.join()
+            else:
+                worker.join(max(deadline - clock(), 0))
+        stopped = not any(worker.is_alive() for worker in self.workers)
+        self.workers = []
+        return stopped
+
+    def start_accepting(self):
+        if not self.accepting:
+            self.poller.register(self.fileno(), select.POLLIN)
+            self.accepting = True
+
+    def stop_accepting(self):
+        if self.accepting:
+            self.poller.unregister(self.fileno())
+            self.accepting = False
+
+    def accept_connection(self):
+        try:
+            request, client_address = self.get_request()
+        except socket.error:
+            return
+        if not self.verify_request(request, client_address):
+            self.shutdown_request(request)
+            return
+        handler = self.RequestHandlerClass.for_connection(request,
+                                                          client_address,
+                                                          self)
+        self.connections[request.fileno()] = handler
+        if len(self.connections) >= self.connection_limit:
+            self.stop_accepting()
+        self.park(handler)
+
+    def park(self, handler):
+        fd = handler.connection.fileno()
+        self.parked[fd] = handler
+        handler.parked_at = clock()
+        self.poller.register(fd, POLL_IN)
+
+    def dispatch(self, fd):
+        self.poller.unregister(fd)
+        self.tasks.put(self.parked.pop(fd))
+
+    def close_idle_connections(self):
+        """ Close connections parked for longer than `idle_timeout`. """
+        idle_timeout = self.RequestHandlerClass.idle_timeout
+        if idle_timeout is None:
+            return
+        now = clock()
+        if now - self.idle_checked < min(idle_timeout, 1.0):
+            return
+        self.idle_checked = now
+        for handler in list(self.parked.values()):
+            if now - handler.parked_at >= idle_timeout:
+                self.close(handler)
+
+    def wakeup(self):
+        if self.workers:
+            # not after `stop_workers`, the pipe may be closed by then
+            os.write(self.wakeup_w, b'x')
+
+    def reclaim_connections(self):
+        """ Park or close the connections returned by the workers. """
+        os.read(self.wakeup_r, 4096)
+        while not self.returned.empty():
+            handler = self.returned.get()
+            if handler.close_connection:
+                self.close(handler)
+            else:
+                self.park(handler)
+
+    def close(self, handler):
+        fd = handler.connection.fileno()
+        if fd in self.parked:
+            self.poller.unregister(fd)
+            del self.parked[fd]
+        self.connections.pop(fd, None)
+        try:
+            handler.finish()
+        except socket.error:
+            pass
+        self.shutdown_request(handler.connection)
+        if len(self.connections) < self.connection_limit:
+            self.start_accepting()
+
+    def abort(self, handler):
+        """ Cut off a connection a worker is still handling. """
+        self.connections.pop(handler.connection.fileno(), None)
+        try:
+            handler.connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def work(self):
+        """ Worker thread, handles requests on ready connections. """
+        while True:
+            handler = self.tasks.get()
+            if handler is None:
+                return
+            try:
+                handler.handle_one_request()
+                while (not handler.close_connection and
+                       has_buffered_input(handler.rfile,
+                                          handler.connection)):
+                    handler.handle_one_request()
+            except Exception:
+                self.handle_error(handler.connection, handler.client_address)
+                handler.close_connection = 1
+            self.returned.put(handler)
+            self.wakeup()
+
+
+def advertised_max_connections(handler_class):
+    """ Return the lowest `Max-Connections` of the handler's services. """
+    limits = [service.options_headers['Max-Connections']
+              for service in handler_class.service_map.values()
+              if 'Max-Connections' in getattr(service, 'options_headers', {})]
+    return min(limits) if limits else float('inf')
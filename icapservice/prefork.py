@@ -0,0 +1,183 @@
+""" Pre-forked multi-process ICAP server.
+
+A supervisor process starts a fixed number of long-lived worker
+processes, each running its own server (by default a
+`ThreadingICAPServer`), and restarts any worker that exits.
+
+Workers either share the listening socket created by the supervisor or,
+with `reuse_port=True`, each bind their own socket to the same address
+using `SO_REUSEPORT` so the kernel spreads connections between them.
+"""
+from __future__ import print_function
+import os
+import time
+import signal
+import logging
+import threading
+from multiprocessing import cpu_count
+from .handler import ThreadingICAPServer
+
+
+log = logging.getLogger(__name__)
+
+
+class StopServing(Exception):
+    """ Raised in the supervisor when asked to stop. """
+
+
+class PreforkICAPServer(object):
+    """ ICAP Server using a pool of pre-forked worker processes.
+
+    Follows the `SocketServer` protocol used by `ICAPRequestHandler.server`:
+
+        handler_class.server(PreforkICAPServer, workers=8).serve_forever()
+    """
+
+    #: Minimum number of seconds between starting workers in the same
+    #: slot, so a worker that crashes on start-up does not spin.
+    restart_delay = 1.0
+
+    #: Seconds a stopping worker waits for in-flight requests.
+    drain_timeout = 30.0
+
+    #: Seconds between repeating SIGTERM to workers that have not
+    #: exited, as a signal arriving while a worker starts is lost.
+    #: Longer than the workers' poll interval, which each signal
+    #: restarts on Python 2.
+    stop_interval = 1.0
+
+    def __init__(self, server_address, RequestHandlerClass, workers=None,
+                 reuse_port=False, worker_class=ThreadingICAPServer):
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.num_workers = workers or cpu_count()
+        self.workers = {}
+        self.running = False
+        #: True while a worker is forked and recorded, see `_stop`.
+        self.spawning = False
+        if reuse_port:
+            self.worker_class = type(worker_class.__name__,
+                                     (worker_class, object),
+                                     {'reuse_port': True})
+            self.shared_server = None
+        else:
+            self.worker_class = worker_class
+            self.shared_server = worker_class(server_address,
+                                              RequestHandlerClass)
+            self.server_address = self.shared_server.server_address
+
+    def serve_forever(self):
+        """ Start the workers and restart them as they exit. """
+
+        self.running = True
+        previous_handlers = [(signum, signal.signal(signum, self._stop))
+                             for signum in (signal.SIGTERM, signal.SIGINT)]
+        try:
+            while self.running:
+                while len(self.workers) < self.num_workers:
+                    self.spawn_worker()
+                self.reap_worker()
+        except StopServing:
+            pass
+        finally:
+            for signum, handler in previous_handlers:
+                signal.signal(signum, handler)
+            self.stop_workers()
+
+    def _stop(self, signum, frame):
+        # raised to interrupt `os.wait`, but not between forking a
+        # worker and recording it, which would leave the worker running
+        self.running = False
+        if not self.spawning:
+            raise StopServing()
+
+    def shutdown(self):
+        """ Stop `serve_forever` (only from within the supervisor). """
+        self.running = False
+
+    def server_close(self):
+        if self.shared_server is not None:
+            self.shared_server.server_close()
+
+    def spawn_worker(self):
+        self.spawning = True
+        try:
+            pid = os.fork()
+        except OSError:
+            self.spawning = False
+            raise
+        if pid:
+            self.workers[pid] = time.time()
+            self.spawning = False
+            if not self.running:
+                raise StopServing()
+            log.info("started worker %d", pid)
+            return pid
+
+        # in the worker process
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            if not self.running:
+                # stopped before the signals were reset
+                status = 0
+                return
+            self.serve_worker()
+            status = 0
+        except Exception:
+            log.exception("worker %d failed", os.getpid())
+        finally:
+            os._exit(status)
+
+    def serve_worker(self):
+        server = self.shared_server
+        if server is None:
+            server = self.worker_class(self.server_address,
+                                       self.RequestHandlerClass)
+
+        draining = []
+        if hasattr(server, 'drain'):
+            # SIGTERM drains the worker's connections before it exits
+            def drain(signum, frame):
+                if draining:
+                    return
+                thread = threading.Thread(target=server.drain,
+                                          args=(self.drain_timeout,))
+                thread.start()
+                draining.append(thread)
+            signal.signal(signal.SIGTERM, drain)
+
+        server.serve_forever()
+        for thread in draining:
+            thread.join()
+
+    def reap_worker(self):
+        pid, status = os.wait()
+        started = self.workers.pop(pid, None)
+        if started is None:
+            return
+        log.warning("worker %d exited with status %d", pid, status)
+        elapsed = time.time() - started
+        if self.running and elapsed < self.restart_delay:
+            time.sleep(self.restart_delay - elapsed)
+
+    def stop_workers(self):
+        signalled = 0
+        while self.workers:
+            if time.time() - signalled >= self.stop_interval:
+                self.signal_workers(signal.SIGTERM)
+                signalled = time.time()
+                continue
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid:
+                self.workers.pop(pid, None)
+            else:
+                time.sleep(0.05)
+
+    def signal_workers(self, signum):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                self.workers.pop(pid)
@@ -0,0 +1,300 @@
+""" Sans-IO ICAP request parser.
+
+`RequestParser` does no I/O: bytes received from a client are passed
+to `feed`, which returns the protocol events they complete.  This lets
+the parser sit behind any kind of socket handling, blocking or not.
+
+    parser = RequestParser()
+    for event in parser.feed(data):
+        if isinstance(event, RequestHead):
+            ...
+
+The events of one request are `RequestHead`, `EncapsulatedHeaders`,
+for a preview any `PreviewChunk`s followed by `PreviewEnd`, then any
+`BodyChunk`s and finally `EndOfMessage`.  After a `PreviewEnd` that is
+not `ieof` the parser waits for the caller's decision: call
+`continue_after_preview` when sending "100 Continue", or `next_request`
+after answering from the preview (the client then sends no more of the
+body).
+"""
+from __future__ import print_function
+from io import BytesIO
+from six import PY2
+from .request import ICAPRequest, ChunkError, MAX_REQUEST_LEN
+from .messages import split_start_line
+from .encapsulated import encapsulated_offsets
+from .response import BadComposition, RequestURITooLong
+
+
+END_OF_HEADERS = b'\r\n\r\n'
+CRLF = b'\r\n'
+
+#: Longest chunk size line accepted, including any extensions.
+MAX_CHUNK_SIZE_LINE = 1024
+
+# Parser states
+REQUEST_HEAD = 'request-head'
+ENCAPSULATED = 'encapsulated'
+PREVIEW = 'preview'
+PREVIEW_END = 'preview-end'
+BODY = 'body'
+DONE = 'done'
+
+
+class IncompleteRequest(Exception):
+    """ The connection ended in the middle of a request. """
+
+
+class Event(object):
+
+    __slots__ = ()
+    fields = ()
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                all(getattr(self, name) == getattr(other, name)
+                    for name in self.fields))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__,
+                               ', '.join(repr(getattr(self, name))
+                                         for name in self.fields))
+
+
+class RequestHead(Event):
+    """ The ICAP request line and headers were parsed into `icap_request`.
+
+    The request's `chunks` cannot be read, the body arrives as events.
+    """
+    __slots__ = fields = ('icap_request',)
+
+    def __init__(self, icap_request):
+        self.icap_request = icap_request
+
+
+class EncapsulatedHeaders(Event):
+    """ The encapsulated HTTP headers, set on the request as well. """
+    __slots__ = fields = ('http_request', 'http_response')
+
+    def __init__(self, http_request, http_response):
+        self.http_request = http_request
+        self.http_response = http_response
+
+
+class PreviewChunk(Event):
+    """ Data of the preview, a chunk may arrive in several pieces. """
+    __slots__ = fields = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+
+class PreviewEnd(Event):
+    """ The end of the preview, `ieof` if it held the whole body. """
+    __slots__ = fields = ('ieof',)
+
+    def __init__(self, ieof):
+        self.ieof = ieof
+
+
+class BodyChunk(Event):
+    """ Data of the body after the preview (or without one). """
+    __slots__ = fields = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+
+class EndOfMessage(Event):
+    """ The request is complete. """
+    __slots__ = ()
+
+
+class RequestParser(object):
+    """ Incremental parser for the ICAP requests on one connection. """
+
+    def __init__(self):
+        self.buffer = b''
+        self.pos = 0
+        self.state = REQUEST_HEAD
+        self.icap_request = None
+        self.sections = []
+        self.encapsulated_size = 0
+        self.chunk_remaining = None
+        self.last_chunk = False
+        self.ieof = False
+
+    def feed(self, data):
+        """ Add received bytes, return the list of events completed. """
+        if self.pos:
+            self.buffer = self.buffer[self.pos:] + data
+            self.pos = 0
+        else:
+            self.buffer += data
+        events = []
+        next_event = self.next_event
+        while True:
+            event = next_event()
+            if event is None:
+                return events
+            events.append(event)
+
+    def close(self):
+        """ The client closed the connection, check nothing is missing. """
+        if self.state != REQUEST_HEAD or self.pos < len(self.buffer):
+            raise IncompleteRequest()
+
+    def continue_after_preview(self):
+        """ The client was sent "100 Continue", read the rest of the body. """
+        assert self.state == PREVIEW_END
+        self.state = BODY
+        self.icap_request.continued = True
+
+    def next_request(self):
+        """ The request was answered from its preview. """
+        assert self.state == PREVIEW_END
+        self.state = REQUEST_HEAD
+
+    def next_event(self):
+        if self.state == REQUEST_HEAD:
+            return self.parse_request_head()
+        if self.state == ENCAPSULATED:
+            return self.parse_encapsulated()
+        if self.state in (PREVIEW, BODY):
+            return self.parse_chunk()
+        if self.state == DONE:
+            self.state = REQUEST_HEAD
+            return EndOfMessage()
+        return None
+
+    def parse_request_head(self):
+        end = self.buffer.find(END_OF_HEADERS, self.pos)
+        if end < 0:
+            if len(self.buffer) - self.pos > MAX_REQUEST_LEN:
+                raise RequestURITooLong()
+            return None
+        head = self.buffer[self.pos:end + len(END_OF_HEADERS)]
+        self.pos = end + len(END_OF_HEADERS)
+
+        line, _, headers = head.partition(CRLF)
+        if not PY2:
+            line = line.decode('iso-8859-1')
+        method, uri, protocol = split_start_line(line)
+        icap_request = ICAPRequest(BytesIO(headers), method, uri, protocol)
+        self.icap_request = icap_request
+
+        offsets = encapsulated_offsets(icap_request.get('encapsulated'))
+        self.sections = [(name, start, end) for (name, start), (_, end)
+                         in zip(offsets, offsets[1:])]
+        self.encapsulated_size = offsets[-1][1] if offsets else 0
+        self.state = ENCAPSULATED
+        return RequestHead(icap_request)
+
+    def parse_encapsulated(self):
+        available = len(self.buffer) - self.pos
+        self.check_sections(available)
+        if available < self.encapsulated_size:
+            return None
+        size = self.encapsulated_size
+        encapsulated = self.buffer[self.pos:self.pos + size]
+        self.pos += size
+
+        icap_request = self.icap_request
+        icap_request.read_encapsulated_http(BytesIO(encapsulated))
+        if icap_request.eof:
+            self.state = DONE
+        elif icap_request.get('preview') is not None:
+            self.state = PREVIEW
+        else:
+            self.state = BODY
+        self.chunk_remaining = None
+        return EncapsulatedHeaders(icap_request.http_request,
+                                   icap_request.http_response)
+
+    def check_sections(self, available):
+        """ Check the header sections received end at the next offset.
+
+        A section that ends early fails before the rest arrives.
+        """
+        for name, start, end in self.sections:
+            if start >= available:
+                break
+            stop = self.pos + min(end, available)
+            found = self.buffer.find(END_OF_HEADERS, self.pos + start, stop)
+            if found < 0 and end > available:
+                continue
+            offset = found + len(END_OF_HEADERS) - self.pos
+            if found < 0 or offset != end:
+                reason = "offset of section after '%s' (%d != %d)" % (
+                    name, end, offset)
+                raise BadComposition(reason=reason)
+
+    def parse_chunk(self):
+        buffer = self.buffer
+        while True:
+            pos = self.pos
+            if self.chunk_remaining is None:
+                end = buffer.find(CRLF, pos)
+                if end < 0:
+                    if len(buffer) - pos > MAX_CHUNK_SIZE_LINE:
+                        raise ChunkError("chunk size line too long")
+                    return None
+                self.chunk_size_line(buffer[pos:end])
+                self.pos = pos = end + len(CRLF)
+
+            remaining = self.chunk_remaining
+            if remaining:
+                available = len(buffer) - pos
+                if not available:
+                    return None
+                if available > remaining:
+                    available = remaining
+                data = buffer[pos:pos + available]
+                self.pos = pos + available
+                self.chunk_remaining = remaining - available
+                self.icap_request.body_bytes_read += available
+                if self.state == PREVIEW:
+                    self.icap_request.preview_chunks.append(data)
+                    return PreviewChunk(data)
+                return BodyChunk(data)
+
+            if len(buffer) - pos < len(CRLF):
+                return None
+            crlf = buffer[pos:pos + len(CRLF)]
+            if crlf != CRLF:
+                raise ChunkError("found %r expecting CRLF" % crlf)
+            self.pos = pos + len(CRLF)
+            self.chunk_remaining = None
+            if self.last_chunk:
+                return self.end_of_chunks()
+
+    def chunk_size_line(self, line):
+        chunk_size, sep, chunk_extension = line.partition(b';')
+        try:
+            chunk_size = int(chunk_size, 16)
+        except ValueError:
+            raise ChunkError("invalid chunk size %r" % line)
+        self.ieof = sep == b';' and chunk_extension.strip() == b'ieof'
+        if self.ieof:
+            if chunk_size != 0:
+                raise ChunkError("ieof with non-zero size")
+            if self.state == BODY:
+                raise ChunkError("ieof after preview")
+        self.chunk_remaining = chunk_size
+        self.last_chunk = chunk_size == 0
+
+    def end_of_chunks(self):
+        if self.state == PREVIEW:
+            if self.ieof:
+                # the whole body was in the preview
+                self.icap_request.eof = True
+                self.state = DONE
+            else:
+                self.state = PREVIEW_END
+            return PreviewEnd(self.ieof)
+        self.icap_request.eof = True
+        self.state = REQUEST_HEAD
+        return EndOfMessage()
@@ -1,13 +1,17 @@
 from __future__ import print_function, unicode_literals
-from six.moves.http_client import HTTPMessage
+from functools import partial
 from six.moves.urllib_parse import urlparse
-from copy import deepcopy
-from .content import decoders
-from .messages import split_start_line, HTTPRequest, HTTPResponse
+from .content import (decode_content, content_codings, encoders,
+                      accepted_encoding)
+from .messages import (split_start_line, split_header_section, HTTPRequest,
+                       HTTPResponse)
+from .headers import Headers
+from .spool import SpooledBody, SPOOL_MAX_SIZE
 from .encapsulated import encapsulated_offsets
 from .response import (BadComposition,
                        RequestURITooLong,
-                       NoModificationsNeeded)
+                       NoModificationsNeeded,
+                       OK)
 
 
 IEOF = object()
@@ -16,81 +20,159 @@ CRLF = b'\r\n'
 # Maximum from BaseHTTPServer seems reasonable
 MAX_REQUEST_LEN = 65536
 
+# Size of the reads used to skip discarded body chunks
+SKIP_BUFFER_SIZE = 65536
 
-class ChunkError(Exception):
-    """ Something is wrong with the chunks """
-
-
-class LineReader(object):
-    """ Reads lines and keeps track of offset """
+# Size of the buffer `ChunkReader` reads chunk data into
+CHUNK_BUFFER_SIZE = 65536
 
-    def __init__(self, raw):
-        self.raw = raw
-        self.offset = 0
 
-    def readline(self, *args, **kwargs):
-        line = self.raw.readline(*args, **kwargs)
-        self.offset += len(line)
-        return line
+class ChunkError(Exception):
+    """ Something is wrong with the chunks """
 
 
-class ICAPRequest(HTTPMessage):
+class ICAPRequest(Headers):
 
     def __init__(self, rfile, method, uri, protocol):
-        HTTPMessage.__init__(self, rfile)
+        Headers.__init__(self, rfile)
         self.method = method
         self.uri = uri
         parsed_uri = urlparse(uri)
         self.abs_path = parsed_uri.path
         self.protocol = protocol
         self.preview = self.get('preview') and int(self.get('preview'))
+        allow = self.get('allow', '')
+        self.allow_204 = '204' in [value.strip() for value in allow.split(',')]
         self.http_request = None
         self.http_response = None
         self.preview_chunks = []
         self.send_continue_after_preview = None
         self.null_body = True
         self.eof = False
-
-    def content_decoder(self):
-        if self.http_response:
-            encoding = self.http_response.get('content-encoding', 'identity')
-        else:
-            encoding = self.http_request.get('content-encoding', 'identity')
-        return decoders[encoding]
+        self.continued = False
+        #: Bytes of the encapsulated body received so far, the preview
+        #: and any chunks read from `chunks` after it.
+        self.body_bytes_read = 0
+        #: True once reading `chunks` has begun.
+        self.chunks_started = False
+        #: The `ChunkReader` of `body_views`, if used.
+        self.chunk_reader = None
+
+    def content_decoder(self, **limits):
+        """ Return the decoder of the encapsulated body.
+
+        `limits` (`max_size`, `max_ratio`) are passed to the decoder, see
+        `icapservice.content.decode_content`.  Raises
+        `UnsupportedEncoding` if the body cannot be decoded.
+        """
+        return partial(decode_content, self.original_encoding(), **limits)
+
+    def original_encoding(self):
+        """ Return the `Content-Encoding` of the encapsulated message. """
+        message = self.http_response
+        if message is None:
+            message = self.http_request
+        return message.get('content-encoding', 'identity').strip().lower()
+
+    def body_encoding(self):
+        """ Return the encoding to send a modified body in.
+
+        This is the original `Content-Encoding`, or the last of stacked
+        codings, if there is an encoder for it.  An unencoded response is
+        encoded as preferred by the `Accept-Encoding` of the HTTP request.
+        """
+        codings = content_codings(self.original_encoding())
+        if codings and codings[-1] in encoders:
+            return codings[-1]
+        if self.http_response is not None and self.http_request is not None:
+            accept_encoding = self.http_request.get('accept-encoding')
+            if accept_encoding:
+                return accepted_encoding(accept_encoding)
+        return 'identity'
+
+    def encode_body(self, message, chunks, encoding=None, level=None):
+        """ Encode the (modified) body of `message` as it is streamed.
+
+        Returns the encoded chunks and sets `Content-Encoding` on
+        `message`, which must be a copy from `modify_http_request` or
+        `modify_http_response`.  `encoding` defaults to `body_encoding`,
+        `level` to the encoder's default compression level.
+        """
+        if encoding is None:
+            encoding = self.body_encoding()
+        if encoding in ('identity', 'none'):
+            return chunks
+        if encoding not in content_codings(self.original_encoding()):
+            # the encoding depends on the client
+            vary = message.get('vary')
+            if not vary:
+                message['Vary'] = 'Accept-Encoding'
+            elif 'accept-encoding' not in vary.lower() and vary != '*':
+                message['Vary'] = vary + ', Accept-Encoding'
+        message['Content-Encoding'] = encoding
+        del message['content-length']
+        return self.transform_chunks(encoders[encoding], chunks, level)
+
+    def transform_chunks(self, function, chunks, *args):
+        """ Return `function(chunks, *args)`, a generator transforming
+        the body `chunks` (as the content decoders and encoders do).
+
+        Overridden where `chunks` are not plain iterators (see
+        `icapservice.aio`).
+        """
+        return function(chunks, *args)
 
     @property
     def close_connection(self):
         return self.get('connection', '').lower().strip() == 'close'
 
-    def unmodified(self):
-        # XXX: check for self.preview is None and then return OK(..., chunks=self.chunks)?
-        self.eof = True
-        return NoModificationsNeeded()
+    @property
+    def can_respond_204(self):
+        """ True if the request may be answered with 204.
+
+        A 204 may be sent in response to a preview, or at any point if
+        the client sent `Allow: 204`.  In the latter case any part of the
+        body that has not been read is skipped.
+        """
+        return self.allow_204 or (self.preview is not None and
+                                  not self.continued)
 
-    def modify_http_request(self, decode=True):
-        # we cannot copy the `fp`
-        del self.http_request.fp
-        http_request = deepcopy(self.http_request)
+    def unmodified(self):
+        """ Return the response for a request that needs no changes.
+
+        This is a 204 if `can_respond_204`, otherwise the encapsulated
+        message is sent back unchanged with the rest of the body.  Raises
+        ValueError in that case if reading `chunks` has begun, as the body
+        can no longer be sent in full.
+        """
+        if self.can_respond_204:
+            return NoModificationsNeeded()
+        if self.chunks_started:
+            raise ValueError('the body has been read, it cannot be sent '
+                             'back unchanged')
+        if self.http_response is not None:
+            return OK(http_response=self.http_response, chunks=self.chunks)
+        return OK(http_request=self.http_request, chunks=self.chunks)
+
+    def modify_http_request(self, decode=True, **limits):
+        http_request = self.http_request.copy()
         if decode:
-            decoder = self.content_decoder()
+            decoder = self.content_decoder(**limits)
             http_request['content-encoding'] = 'identity'
-            chunks = decoder(self.chunks)
+            chunks = self.transform_chunks(decoder, self.chunks)
         else:
             chunks = self.chunks
         return http_request, chunks
 
-    def modify_http_response(self, decode=True):
-        # we cannot copy the `fp`
-        del self.http_response.fp
-
-        http_response = deepcopy(self.http_response)
+    def modify_http_response(self, decode=True, **limits):
+        http_response = self.http_response.copy()
         # remove content-length for modified responses
         del http_response['content-length']
 
         if decode:
-            decoder = self.content_decoder()
+            decoder = self.content_decoder(**limits)
             http_response['content-encoding'] = 'identity'
-            chunks = decoder(self.chunks)
+            chunks = self.transform_chunks(decoder, self.chunks)
         else:
             chunks = self.chunks
         return http_response, chunks
@@ -122,20 +204,26 @@ class ICAPRequest(HTTPMessage):
             self.null_body = True
             return
 
-        reader = LineReader(rfile)
-        for name, offset in encapsulated_offsets(encapsulated):
+        offsets = encapsulated_offsets(encapsulated)
+        position = 0
+        for index, (name, _) in enumerate(offsets):
             if name.endswith('-body'):
-                if reader.offset!= offset:
-                    reason = "offset '%s' (%d != %d)" % (name, offset, reader.offset)
-                    raise BadComposition(reason=reason)
                 if name == 'null-body':
                     self.eof = True
                 else:
                     self.null_body = False
-            elif name == 'req-hdr':
-                self.http_request = HTTPRequest.parse(reader)
+                continue
+            # the headers are kept as read, see `Headers.from_bytes`
+            end = offsets[index + 1][1]
+            section = split_header_section(rfile.read(end - position))
+            if section is None:
+                reason = "'%s' does not end at offset %d" % (name, end)
+                raise BadComposition(reason=reason)
+            position = end
+            if name == 'req-hdr':
+                self.http_request = HTTPRequest.from_section(*section)
             elif name == 'res-hdr':
-                self.http_response = HTTPResponse.parse(reader)
+                self.http_response = HTTPResponse.from_section(*section)
 
     def read_preview(self):
 
@@ -152,6 +240,7 @@ class ICAPRequest(HTTPMessage):
             if chunk is not IEOF:
                 assert not self.eof
                 self.preview_chunks.append(chunk)
+                self.body_bytes_read += len(chunk)
             else:
                 self.eof = True
 
@@ -164,21 +253,86 @@ class ICAPRequest(HTTPMessage):
             self.send_continue_after_preview()
             self.send_continue_after_preview = False
 
+        self.continued = True
+        return True
+
+    def discard(self, max_bytes=None):
+        """ Skip any part of the body that has not been read.
+
+        The body is skipped without creating chunk objects.  Returns
+        False, leaving the rest unread, if more than `max_bytes` would
+        have to be skipped; the connection cannot be reused after that.
+        """
+
+        if self.eof:
+            return True
+
+        self.chunks = iter(())
+
+        if self.preview is not None and not self.continued:
+            # the client waits for "100 Continue" before sending the rest
+            self.eof = True
+            return True
+
+        reader = self.chunk_reader
+        if reader is not None and reader.pending:
+            # `body_views` stopped in the middle of a chunk
+            if max_bytes is not None:
+                if reader.pending - 2 > max_bytes:
+                    return False
+                max_bytes -= reader.pending - 2
+            reader.skip_pending()
+
+        if not skip_chunks(self.fp, max_bytes):
+            return False
+
+        self.eof = True
         return True
 
-    def _chunks(self):
+    def spool(self, chunks=None, max_size=SPOOL_MAX_SIZE, dir=None):
+        """ Read the rest of the body, or `chunks`, into a `SpooledBody`.
+
+        Pass the chunks of `modify_http_request` or `modify_http_response`
+        to spool the decoded body.  The body is moved to a temporary file
+        in `dir` once larger than `max_size`.
+        """
+        if chunks is None:
+            chunks = self.chunks
+        return SpooledBody.from_chunks(chunks, max_size, dir)
+
+    def body_views(self, buffer_size=CHUNK_BUFFER_SIZE):
+        """ Return the body chunks read with a `ChunkReader`.
+
+        Use this instead of `chunks` (not as well) to read the body
+        without copying it.  Apart from the preview chunks, each item
+        is a memoryview that is only valid until the next is read, so
+        anything kept must be copied first.  The views may be returned
+        as response chunks, the handler copies those it holds back.
+        """
+        self.chunk_reader = ChunkReader(self.fp, buffer_size)
+        self.chunks = self._chunks(self.chunk_reader)
+        return self.chunks
+
+    def _chunks(self, chunk_reader=None):
 
+        self.chunks_started = True
         for chunk in self.preview_chunks:
             yield chunk
 
         if not self.continue_after_preview():
             return
 
-        for chunk in read_chunks(self.fp):
+        if chunk_reader is None:
+            chunk_reader = read_chunks(self.fp)
+
+        for chunk in chunk_reader:
             if chunk is IEOF:
                 raise ChunkError("ieof after preview")
+            self.body_bytes_read += len(chunk)
             yield chunk
 
+        self.eof = True
+
 
 def read_chunks(rfile):
 
@@ -205,3 +359,146 @@ def read_chunks(rfile):
             break
 
         yield chunk
+
+
+class ChunkReader(object):
+    """ Reads chunks into a reused buffer.
+
+    Iterating yields the chunk data as memoryviews of the buffer (or as
+    bytes if `copy` is set), and `IEOF`, like `read_chunks`.  A view is
+    only valid until the next item is read.  Chunks larger than the
+    buffer are yielded in several pieces.
+
+    Data is read with `rfile.readinto`.  Only the chunk data and its
+    CRLF are read this way, never more: bytes past the last chunk (the
+    next request) must stay in `rfile`, which has no way to take back
+    data read ahead, so chunk size lines are read with `readline`.
+    """
+
+    def __init__(self, rfile, buffer_size=CHUNK_BUFFER_SIZE, copy=False):
+        self.rfile = rfile
+        self.readinto = getattr(rfile, 'readinto', None)
+        self.buffer_size = buffer_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.copy = copy
+        #: Bytes of the current chunk, with its CRLF, not read yet
+        #: (when a large chunk is yielded in pieces).
+        self.pending = 0
+
+    def __iter__(self):
+
+        readline = self.rfile.readline
+        buffer_size = self.buffer_size
+        buf = self.buffer
+        view = self.view
+        fill = self.fill
+        copy = self.copy
+
+        while True:
+
+            chunk_size_line = readline()
+            if not chunk_size_line:
+                raise ChunkError("unexpected end of chunks")
+            chunk_size, sep, chunk_extension = chunk_size_line.partition(b';')
+            chunk_size = int(chunk_size, 16)
+            if sep == b';' and chunk_extension.strip() == b'ieof':
+                if chunk_size != 0:
+                    raise ChunkError("ieof with non-zero size")
+                yield IEOF
+
+            remaining = chunk_size
+            while remaining + 2 > buffer_size:
+                size = min(remaining, buffer_size)
+                fill(size)
+                remaining -= size
+                self.pending = remaining + 2
+                yield view[:size].tobytes() if copy else view[:size]
+
+            # the rest of the chunk and its CRLF fit in the buffer
+            fill(remaining + 2)
+            self.pending = 0
+            if buf[remaining] != 13 or buf[remaining + 1] != 10:
+                raise ChunkError("found %r expecting CRLF"
+                                 % bytes(buf[remaining:remaining + 2]))
+
+            if not chunk_size:
+                return
+
+            if remaining:
+                yield view[:remaining].tobytes() if copy else view[:remaining]
+
+    def skip_pending(self):
+        """ Skip the rest of the chunk the last piece was taken from.
+
+        After this the next chunk size line can be read, by this reader
+        or by `skip_chunks`.
+        """
+        while self.pending > 2:
+            size = min(self.pending - 2, self.buffer_size)
+            self.fill(size)
+            self.pending -= size
+        if self.pending:
+            self.fill(2)
+            self.pending = 0
+            if self.buffer[:2] != CRLF:
+                raise ChunkError("found %r expecting CRLF"
+                                 % bytes(self.buffer[:2]))
+
+    def fill(self, size):
+        """ Read exactly `size` bytes into the start of the buffer. """
+        filled = 0
+        while filled < size:
+            if self.readinto is not None:
+                count = self.readinto(self.view[filled:size])
+            else:
+                data = self.rfile.read(size - filled)
+                count = len(data)
+                self.view[filled:filled + count] = data
+            if not count:
+                raise ChunkError("unexpected end of chunks")
+            filled += count
+
+
+def skip_chunks(rfile, max_bytes=None):
+    """ Skip chunks up to and including the last chunk.
+
+    Chunk data is read in blocks of up to `SKIP_BUFFER_SIZE` into a
+    reused buffer (where `rfile` supports `readinto`) and thrown away.
+    Returns False if the chunks add up to more than `max_bytes`.
+    """
+
+    readline = rfile.readline
+    read = rfile.read
+    readinto = getattr(rfile, 'readinto', None)
+    buf = memoryview(bytearray(SKIP_BUFFER_SIZE)) if readinto else None
+    skipped = 0
+
+    while True:
+
+        chunk_size_line = readline()
+        if not chunk_size_line:
+            raise ChunkError("unexpected end of chunks")
+        chunk_size = int(chunk_size_line.partition(b';')[0], 16)
+
+        skipped += chunk_size
+        if max_bytes is not None and skipped > max_bytes:
+            return False
+
+        remaining = chunk_size
+        while remaining:
+            size = min(remaining, SKIP_BUFFER_SIZE)
+            if buf is not None:
+                size = readinto(buf[:size])
+            else:
+                size = len(read(size))
+            if not size:
+                raise ChunkError("unexpected end of chunks")
+            remaining -= size
+
+        crlf = read(2)
+        if crlf != CRLF:
+            raise ChunkError("found %r expecting CRLF" % crlf)
+
+        if not chunk_size:
+            return True
@@ -19,6 +19,7 @@ icap_reasons.update({
     408: 'Request timeout',
     418: 'Bad composition',
     500: 'Server error',
+    503: 'Service overloaded',
 })
 
 _header_case = {
@@ -50,6 +51,10 @@ def now_rfc1123():
 
 class ICAPResponse(object):
 
+    #: False for a response given without inspecting the message, such
+    #: as the 204 sent for a body that cannot be decoded.
+    inspected = True
+
     def __init__(self, status_code=200, **kw):
         self.protocol = kw.pop('protocol', 'ICAP/1.0')
         self.status_code = status_code
@@ -63,7 +68,7 @@ class ICAPResponse(object):
         self.chunks = kw.pop('chunks', ())
         if kw:
             raise ValueError('unexpected keyword arguments %r' % kw)
-        if self.http_request and self.http_response:
+        if self.http_request is not None and self.http_response is not None:
             raise ValueError('cannot encapsulate both request and response')
 
     def header_bytes(self, any_chunks):
@@ -110,11 +115,11 @@ class ICAPResponse(object):
         enc_msg = b''
         body_type = None
 
-        if self.http_response:
+        if self.http_response is not None:
             enc_msg = binary_type(self.http_response)
             enc_header.append('res-hdr=0')
             body_type = 'res-body'
-        elif self.http_request:
+        elif self.http_request is not None:
             enc_msg = binary_type(self.http_request)
             enc_header.append('req-hdr=0')
             body_type = 'req-body'
@@ -147,3 +152,4 @@ RequestURITooLong = icap_error('RequestURITooLong', 414)
 ServiceNotFound = icap_error('ServiceNotFound', 404)
 MethodNotAllowed = icap_error('MethodNotAllowed', 405)
 BadComposition = icap_error('BadComposition', 418)
+ServiceOverloaded = icap_error('ServiceOverloaded', 503)
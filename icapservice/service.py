@@ -17,6 +17,7 @@ class ICAPService(object):
         'Transfer-Complete': [],
         'Max-Connections': 1000,
         'Options-TTL': 7200,
+        'Allow': [204],
     }
 
     # List of all possible ICAP method (excluding OPTIONS).
@@ -29,6 +30,30 @@ class ICAPService(object):
     # `https://tools.ietf.org/html/rfc3507#section-4.2`.
     abs_path = None
 
+    # Maximum number of requests to this service handled at once, None
+    # for no limit.  Requests above the limit wait in a queue of at most
+    # `max_queued` requests for up to `queue_timeout` seconds, and are
+    # answered with 503 (Service overloaded) if the queue is full or the
+    # wait times out.  See `icapservice.limits`.
+    max_concurrency = None
+    max_queued = None
+    queue_timeout = None
+
+    # Callables given each request, while a 204 is allowed, before the
+    # service method.  The first to return a response (rather than None)
+    # answers the request instead.  See `icapservice.classify`.
+    classifiers = ()
+
+    # An `AdaptiveOptions` tuning the `Preview` and `Transfer-*` headers
+    # of the OPTIONS response from the responses of this service, or None
+    # to always send `options_headers` as configured.
+    adaptive_options = None
+
+    # A `VerdictCache` answering repeats of requests this service answered
+    # with 204 without calling the service method, or None.  See
+    # `icapservice.verdicts`.
+    verdict_cache = None
+
     def __init__(self):
         self.options_headers = self.default_options_headers.copy()
         self.options_headers['Methods'] = []
@@ -60,4 +85,6 @@ class ICAPService(object):
         return ICAPRequestHandler.for_services([self], **kwargs)
 
     def OPTIONS(self, request):
+        if self.adaptive_options is not None:
+            self.adaptive_options.update(self)
         return ICAPResponse(200, headers=self.options_headers)
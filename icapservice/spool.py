@@ -0,0 +1,114 @@
+""" Spooling whole bodies for services that need to see all of them.
+
+    body = icap_request.spool()
+    if body.map().find(signature) >= 0:
+        return OK(http_response=blocked_page, chunks=[...])
+    return OK(http_response=http_response, chunks=body)
+
+A `SpooledBody` is kept in memory up to `max_size` bytes and moved to
+an anonymous temporary file when it grows past that, so a large body
+is never held in the Python heap.  `map` gives random access to the
+body, memory-mapped once it is on disk, and iterating over the body
+(as often as needed) reads it back in chunks, so it can be passed as
+the `chunks` of a response.
+"""
+from __future__ import print_function
+import mmap
+import tempfile
+from io import BytesIO
+
+
+#: Bodies larger than this are spooled to disk.
+SPOOL_MAX_SIZE = 1024 * 1024
+
+#: Size of the chunks a spooled body is read back in.
+SPOOL_CHUNK_SIZE = 65536
+
+
+class SpooledBody(object):
+    """ A body in memory, or in a temporary file in `dir` once larger
+    than `max_size`.
+    """
+
+    def __init__(self, max_size=SPOOL_MAX_SIZE, dir=None):
+        self.max_size = max_size
+        self.dir = dir
+        self.file = BytesIO()
+        self.size = 0
+        self.on_disk = False
+        self.maps = []
+
+    @classmethod
+    def from_chunks(cls, chunks, *args, **kwargs):
+        body = cls(*args, **kwargs)
+        try:
+            for chunk in chunks:
+                body.write(chunk)
+        except Exception:
+            body.close()
+            raise
+        return body
+
+    def write(self, data):
+        if not self.on_disk and self.size + len(data) > self.max_size:
+            self.rollover()
+        # reading the chunks moves the position
+        self.file.seek(0, 2)
+        self.file.write(data)
+        self.size += len(data)
+
+    def rollover(self):
+        """ Move the body to a temporary file. """
+        if self.on_disk:
+            return
+        spooled = tempfile.TemporaryFile(dir=self.dir)
+        spooled.write(self.file.getvalue())
+        self.file = spooled
+        self.on_disk = True
+
+    def __len__(self):
+        return self.size
+
+    def map(self):
+        """ Return the body as a read-only bytes-like object.
+
+        On disk this is an `mmap`, valid until the body is closed; it
+        does not include anything written after it was made.
+        """
+        if not self.on_disk:
+            return self.file.getvalue()
+        if not self.size:
+            # an empty file cannot be mapped
+            return b''
+        self.file.flush()
+        mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps.append(mapped)
+        return mapped
+
+    def chunks(self, size=SPOOL_CHUNK_SIZE):
+        """ Read the body from the start in chunks of `size` bytes. """
+        position = 0
+        while position < self.size:
+            # seek every time, other readers share the file position
+            self.file.seek(position)
+            chunk = self.file.read(min(size, self.size - position))
+            if not chunk:
+                break
+            position += len(chunk)
+            yield chunk
+
+    def __iter__(self):
+        return self.chunks()
+
+    def close(self):
+        """ Release the memory or temporary file holding the body. """
+        for mapped in self.maps:
+            mapped.close()
+        self.maps = []
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
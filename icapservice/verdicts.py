@@ -0,0 +1,118 @@
+""" Caching 204 decisions for repeated requests.
+
+    class Scanner(ICAPService):
+        verdict_cache = VerdictCache(max_entries=100000, ttl=600)
+
+When a service answers a request with 204 the decision is remembered
+under a key made from the encapsulated HTTP request URI and the
+response validators (see `verdict_key`).  A later request with the same
+key is answered with 204 from its headers (and preview), before the
+service method is called and without reading the body.  Entries expire
+after `ttl` seconds, the least recently used entries are evicted beyond
+`max_entries`, and the whole cache is dropped when the service's ISTag
+changes.  The 204 sent for a body that cannot be decoded (see
+`icapservice.content`) is not a decision and is never remembered.
+"""
+from __future__ import print_function
+import threading
+from collections import OrderedDict
+from .lifecycle import clock
+from .response import NoModificationsNeeded
+
+
+def verdict_key(icap_request):
+    """ Return the cache key for `icap_request`, or None to not cache it.
+
+    RESPMOD requests are keyed on the HTTP request method, `Host` and
+    URI and the response status, `ETag`, `Last-Modified` and
+    `Content-Length`, and need at least one of `ETag` and
+    `Last-Modified`.  REQMOD requests are keyed on the HTTP request
+    method, `Host` and URI, and only cached without a body.
+    """
+    http_request = icap_request.http_request
+    if http_request is None:
+        return None
+    # an origin-form URI is only unique together with the host
+    host = http_request.get('host', '').strip().lower()
+    key = (icap_request.abs_path, icap_request.method,
+           http_request.method, host, http_request.uri)
+    if icap_request.method == 'REQMOD':
+        return key if icap_request.null_body else None
+    http_response = icap_request.http_response
+    if http_response is None:
+        return None
+    etag = http_response.get('etag')
+    last_modified = http_response.get('last-modified')
+    if etag is None and last_modified is None:
+        return None
+    return key + (http_response.status_code, etag, last_modified,
+                  http_response.get('content-length'))
+
+
+class VerdictCache(object):
+    """ Remembers which requests were answered with 204.
+
+    `key` is the function returning the key of a request, see
+    `verdict_key`.
+    """
+
+    def __init__(self, max_entries=10000, ttl=300, key=verdict_key):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.key = key
+        self.lock = threading.Lock()
+        #: Expiry time by key, least recently used first.
+        self.entries = OrderedDict()
+        self.istag = None
+        self.hits = 0
+        self.misses = 0
+
+    def check_istag(self, istag):
+        # the lock is held
+        if istag != self.istag:
+            self.entries.clear()
+            self.istag = istag
+
+    def lookup(self, icap_request, istag):
+        """ Return a 204 response if the request is cached, else None. """
+        key = self.key(icap_request)
+        if key is None:
+            return None
+        with self.lock:
+            self.check_istag(istag)
+            expires = self.entries.pop(key, None)
+            if expires is None or expires <= clock():
+                self.misses += 1
+                return None
+            # move to the most recently used end
+            self.entries[key] = expires
+            self.hits += 1
+        return NoModificationsNeeded()
+
+    def store(self, icap_request, icap_response, istag):
+        """ Remember the response if it is a 204 given after inspecting
+        the message (not the 204 for a body that cannot be decoded).
+        """
+        if icap_response.status_code != 204 or not icap_response.inspected:
+            return
+        key = self.key(icap_request)
+        if key is None:
+            return
+        now = clock()
+        with self.lock:
+            self.check_istag(istag)
+            expires = self.entries.get(key)
+            if expires is not None and expires > now:
+                # a response from the cache, it does not extend the ttl
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = now + self.ttl
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
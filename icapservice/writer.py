@@ -0,0 +1,157 @@
+""" Batched writing of chunked ICAP responses.
+
+Chunks are framed without copying the payload: the size line, the
+chunk itself and the trailing CRLF are kept as separate buffers and
+written together with a single `sendmsg` (scatter-gather) call once
+enough data is pending.  Where `sendmsg` is not available (Python 2,
+TLS sockets) the pending buffers are joined and sent with one `sendall`.
+"""
+from __future__ import print_function
+import time
+try:
+    from ssl import SSLSocket
+except ImportError:
+    SSLSocket = None
+
+
+clock = getattr(time, 'monotonic', time.time)
+
+CRLF = b'\r\n'
+FINAL_CHUNK = b'0\r\n\r\n'
+
+#: Default number of bytes collected before they are written.
+WRITE_BUFFER_SIZE = 65536
+
+#: Default size of coalesced chunks, see `coalesce`.
+COALESCE_SIZE = 16384
+
+#: Default maximum number of seconds output is held back before it is
+#: written, see `coalesce` and `ResponseWriter`.
+FLUSH_DELAY = 0.1
+
+#: Maximum number of buffers passed to one `sendmsg` call (IOV_MAX is
+#: 1024 on Linux and the BSDs).
+MAX_BUFFERS = 1024
+
+
+def chunk_size_line(chunk):
+    return b'%x\r\n' % len(chunk)
+
+
+def coalesce(chunks, min_size=COALESCE_SIZE, max_delay=FLUSH_DELAY):
+    """ Merge small chunks into chunks of at least `min_size` bytes.
+
+    The first chunk is passed on as soon as it arrives, so the start of
+    a response is never held back.  A merged chunk is also produced once
+    the oldest data in it has been held for `max_delay` seconds, so
+    interactive content is not delayed for long.  The delay is checked
+    as chunks arrive, so later data may wait longer if `chunks` itself
+    blocks.  Empty chunks are dropped (they would end the chunked body)
+    and chunks of `min_size` or more pass through without being copied.
+    Memoryviews that are held back are copied, since they may share a
+    buffer that is reused (see `ICAPRequest.body_views`).
+    """
+    chunks = iter(chunks)
+    for chunk in chunks:
+        if chunk:
+            yield chunk
+            break
+
+    pending = []
+    pending_size = 0
+    started = None
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if not pending:
+            started = clock()
+        if isinstance(chunk, memoryview):
+            chunk = chunk.tobytes()
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= min_size or clock() - started >= max_delay:
+            yield pending[0] if len(pending) == 1 else b''.join(pending)
+            pending = []
+            pending_size = 0
+    if pending:
+        yield pending[0] if len(pending) == 1 else b''.join(pending)
+
+
+class ResponseWriter(object):
+    """ Collects response data and writes it in batches.
+
+    Data is written once at least `buffer_size` bytes are pending, when
+    the oldest pending data has waited `max_delay` seconds, when `flush`
+    is called, or when `MAX_BUFFERS` buffers are pending.  A
+    `buffer_size` of 0 writes every chunk as it is added.  Memoryview
+    chunks are copied when added, their buffer may be reused before the
+    next write.
+    """
+
+    def __init__(self, connection, wfile, buffer_size=WRITE_BUFFER_SIZE,
+                 max_delay=FLUSH_DELAY):
+        self.sendmsg = getattr(connection, 'sendmsg', None)
+        if SSLSocket is not None and isinstance(connection, SSLSocket):
+            # has `sendmsg`, but it raises NotImplementedError
+            self.sendmsg = None
+        # `wfile` is unbuffered so writing to the socket directly is safe
+        self.sendall = getattr(connection, 'sendall', None)
+        if self.sendall is None:
+            self.sendall = wfile.write
+        self.buffer_size = buffer_size
+        self.max_delay = max_delay
+        self.buffers = []
+        self.pending = 0
+        self.started = None
+        self.bytes_written = 0
+
+    def write(self, data):
+        if not self.buffers:
+            self.started = clock()
+        self.buffers.append(data)
+        self.pending += len(data)
+        if (self.pending >= self.buffer_size or
+                len(self.buffers) >= MAX_BUFFERS - 2 or
+                clock() - self.started >= self.max_delay):
+            self.flush()
+
+    def write_chunk(self, chunk):
+        if isinstance(chunk, memoryview):
+            chunk = chunk.tobytes()
+        if not self.buffers:
+            self.started = clock()
+        size_line = chunk_size_line(chunk)
+        self.buffers.append(size_line)
+        self.buffers.append(chunk)
+        self.pending += len(size_line) + len(chunk)
+        self.write(CRLF)
+
+    def write_final_chunk(self):
+        self.write(FINAL_CHUNK)
+
+    def flush(self):
+        buffers = self.buffers
+        if not buffers:
+            return
+        self.bytes_written += self.pending
+        self.buffers = []
+        self.pending = 0
+        if self.sendmsg is not None:
+            try:
+                self.sendmsg_all(buffers)
+                return
+            except NotImplementedError:
+                # a socket wrapper without scatter-gather support
+                self.sendmsg = None
+        self.sendall(b''.join(buffers))
+
+    def sendmsg_all(self, buffers):
+        buffers = [memoryview(b) for b in buffers]
+        first = 0
+        while first < len(buffers):
+            sent = self.sendmsg(buffers[first:])
+            while first < len(buffers) and sent >= len(buffers[first]):
+                sent -= len(buffers[first])
+                first += 1
+            if sent:
+                buffers[first] = buffers[first][sent:]
@@ -12,6 +12,10 @@ setup(
     packages=['icapservice'],
     zip_safe=False,
     install_requires=['six', 'brotlipy'],
+    extras_require={'zstd': ['zstandard']},
+    entry_points={
+        'console_scripts': ['icapservice = icapservice.__main__:main'],
+    },
     include_package_data=True,
     package_data={'': ['LICENSE']},
     classifiers=(
@@ -0,0 +1,42 @@
+""" A service and helpers for the tests that run real servers. """
+import socket
+import threading
+from contextlib import closing
+from icapservice import ICAPService, NoModificationsNeeded
+
+options_request = (
+    b'OPTIONS icap://127.0.0.1/nomod ICAP/1.0\r\n'
+    b'Host: 127.0.0.1\r\n'
+    b'\r\n'
+)
+
+
+class NoMod(ICAPService):
+
+    abs_path = '/nomod'
+
+    def RESPMOD(self, icap_request):
+        return NoModificationsNeeded()
+
+
+def serve(server_class, service, **handler_kwargs):
+    """ Start serving `service` on a free port in a daemon thread. """
+    handler_class = service.icap_handler_class(**handler_kwargs)
+    server = handler_class.server(server_class, ('127.0.0.1', 0))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs={'poll_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def connect(server_address, timeout=5):
+    return closing(socket.create_connection(server_address, timeout))
+
+
+def read_response(rfile):
+    lines = []
+    while not lines or lines[-1] not in (b'\r\n', b''):
+        lines.append(rfile.readline())
+    return lines
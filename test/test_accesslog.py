@@ -0,0 +1,125 @@
+import os
+import json
+import logging
+import threading
+from icapservice.accesslog import AccessLog
+from mocksocket import MockSocket
+from servers import NoMod
+
+respmod_request = (
+    b'RESPMOD icap://icap.example.net/nomod ICAP/1.0\r\n'
+    b'Host: icap.example.net\r\n'
+    b'Encapsulated: req-hdr=0, null-body=33\r\n'
+    b'\r\n'
+    b'GET /origin HTTP/1.1\r\n'
+    b'Host: x\r\n'
+    b'\r\n'
+)
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def access_logger():
+    logger = logging.getLogger('test_accesslog')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = ListHandler()
+    logger.handlers = [handler]
+    return logger, handler.messages
+
+
+def handle(handler_class, times=1):
+    for _ in range(times):
+        handler_class(MockSocket(respmod_request), object())
+
+
+def test_text_format():
+    logger, messages = access_logger()
+    access_log = AccessLog(logger)
+    handle(NoMod().icap_handler_class(access_log=access_log))
+    access_log.close()
+    assert messages == ['"RESPMOD /nomod GET /origin" - 204']
+
+
+def test_json_format():
+    logger, messages = access_logger()
+    access_log = AccessLog(logger, format='json')
+    handle(NoMod().icap_handler_class(access_log=access_log))
+    access_log.close()
+    record = json.loads(messages[0])
+    assert record['status'] == 204
+    assert record['service'] == '/nomod'
+    assert record['http_uri'] == '/origin'
+
+
+def test_sampling():
+    logger, messages = access_logger()
+    access_log = AccessLog(logger, sample={204: 3})
+    handle(NoMod().icap_handler_class(access_log=access_log), times=7)
+    access_log.close()
+    assert len(messages) == 3
+
+
+class BlockingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.entered = threading.Event()
+        self.released = threading.Event()
+
+    def emit(self, record):
+        self.entered.set()
+        self.released.wait()
+
+
+def test_full_queue_drops_records():
+    logger, messages = access_logger()
+    handler = BlockingHandler()
+    logger.handlers = [handler]
+    access_log = AccessLog(logger, queue_size=1)
+    handler_class = NoMod().icap_handler_class(access_log=access_log)
+    try:
+        # the first record blocks the writer, the second fills the queue
+        handle(handler_class)
+        assert handler.entered.wait(5)
+        handle(handler_class)
+        # the queue is full so this record is dropped, not waited for
+        handle(handler_class)
+        assert access_log.dropped == 1
+    finally:
+        handler.released.set()
+        access_log.close()
+
+
+def test_thread_started_in_forked_worker():
+    logger, messages = access_logger()
+    access_log = AccessLog(logger)
+    assert access_log.thread is None
+    handler_class = NoMod().icap_handler_class(access_log=access_log)
+    handle(handler_class)
+    access_log.flush()
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if not pid:
+        try:
+            handle(handler_class)
+            access_log.close()
+            os.write(write_end, '\n'.join(messages).encode('utf-8'))
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    os.waitpid(pid, 0)
+    with os.fdopen(read_end, 'rb') as child_output:
+        child_messages = child_output.read().decode('utf-8').split('\n')
+    access_log.close()
+    # the child's list holds the parent's record and the child's own
+    assert child_messages == ['"RESPMOD /nomod GET /origin" - 204'] * 2
+    assert messages == ['"RESPMOD /nomod GET /origin" - 204']
@@ -0,0 +1,110 @@
+from icapservice import ICAPService, NoModificationsNeeded
+from icapservice.adaptive import AdaptiveOptions, uri_extension
+from icapservice.response import ICAPResponse
+from mocksocket import MockSocket
+
+
+class Message(dict):
+
+    def __init__(self, uri=None, **headers):
+        dict.__init__(self, headers)
+        self.uri = uri
+
+
+class Request(object):
+
+    null_body = False
+    http_response = None
+
+    def __init__(self, uri, body_bytes_read=0):
+        self.http_request = Message(uri)
+        self.body_bytes_read = body_bytes_read
+
+
+class Scanner(ICAPService):
+
+    abs_path = '/scan'
+
+    def RESPMOD(self, icap_request):
+        return NoModificationsNeeded()
+
+
+def record(adaptive, uri, status, times, body_bytes_read=0):
+    for _ in range(times):
+        adaptive.record(Request(uri, body_bytes_read=body_bytes_read),
+                        ICAPResponse(status))
+
+
+def test_uri_extension():
+    assert uri_extension('/a/b.JPG?x=1') == 'jpg'
+    assert uri_extension('http://example.com/video.mp4') == 'mp4'
+    assert uri_extension('http://example.com') is None
+    assert uri_extension('/archive.tar.gz') == 'gz'
+    assert uri_extension('/path/') is None
+    assert uri_extension('/a.b/c') is None
+
+
+def test_update_without_data_changes_nothing():
+    service = Scanner()
+    before = dict(service.options_headers)
+    istag = service.istag
+    assert not AdaptiveOptions().update(service)
+    assert service.options_headers == before
+    assert service.istag == istag
+
+
+def test_update_tunes_options():
+    service = Scanner()
+    adaptive = AdaptiveOptions(min_samples=10, interval=0, learning_ttl=60)
+    record(adaptive, '/movie.webm', 204, 20)
+    record(adaptive, '/page.html', 200, 20)
+    record(adaptive, '/page.php', 204, 5, body_bytes_read=900)
+    record(adaptive, '/page.php', 200, 5)
+    istag = service.istag
+
+    assert adaptive.update(service)
+    options = service.options_headers
+    assert options['Transfer-Ignore'][-1] == 'webm'
+    assert options['Transfer-Complete'] == ['html']
+    assert options['Preview'] == 1024
+    assert options['Options-TTL'] == 60
+    assert service.istag != istag
+
+    assert not adaptive.update(service)
+    assert options['Options-TTL'] == 7200
+    assert adaptive.extensions['php'] == [10, 5]
+
+
+def test_update_interval():
+    service = Scanner()
+    adaptive = AdaptiveOptions(min_samples=1, interval=3600)
+    adaptive.update(service)
+    record(adaptive, '/movie.webm', 204, 5)
+    assert not adaptive.update(service)
+    assert 'webm' not in service.options_headers['Transfer-Ignore']
+
+
+def test_handler_records_responses():
+    service = Scanner()
+    service.adaptive_options = AdaptiveOptions()
+    socket = MockSocket(
+        b'RESPMOD icap://icap.example.net/scan ICAP/1.0\r\n'
+        b'Host: icap.example.net\r\n'
+        b'Preview: 4\r\n'
+        b'Encapsulated: req-hdr=0, res-hdr=42, res-body=86\r\n'
+        b'\r\n'
+        b'GET /image.png HTTP/1.1\r\n'
+        b'Host: example\r\n'
+        b'\r\n'
+        b'HTTP/1.1 200 OK\r\n'
+        b'Content-Type: image/png\r\n'
+        b'\r\n'
+        b'4\r\n'
+        b'\x89PNG\r\n'
+        b'0\r\n'
+        b'\r\n'
+    )
+    service.icap_handler_class()(socket, object(), object())
+    assert socket.wfile.value.startswith(b'ICAP/1.0 204 ')
+    assert service.adaptive_options.extensions == {'png': [1, 1]}
+    assert service.adaptive_options.decided[1] == 1
@@ -0,0 +1,398 @@
+import time
+import zlib
+import socket
+import asyncio
+import pytest
+from icapservice import ICAPService, OK, NoModificationsNeeded
+from icapservice.aio import AsyncICAPServer
+from icapservice.metrics import MetricsRegistry
+from servers import NoMod, read_response, serve
+
+options_request = (
+    b'OPTIONS icap://icap.example.net/async ICAP/1.0\r\n'
+    b'Host: icap.example.net\r\n'
+    b'\r\n'
+)
+
+reqmod_request = (
+    b'REQMOD icap://icap.example.net/async ICAP/1.0\r\n'
+    b'Host: icap.example.net\r\n'
+    b'Encapsulated: req-hdr=0, req-body=44\r\n'
+    b'\r\n'
+    b'POST /upload HTTP/1.1\r\n'
+    b'Host: example.net\r\n'
+    b'\r\n'
+    b'5\r\n'
+    b'hello\r\n'
+    b'0\r\n'
+    b'\r\n'
+)
+
+
+class AsyncService(ICAPService):
+
+    abs_path = '/async'
+
+    async def REQMOD(self, icap_request):
+        body = b''
+        async for chunk in icap_request.chunks:
+            body += chunk
+        if body == b'hello':
+            return NoModificationsNeeded()
+        return OK()
+
+
+class ModifyService(ICAPService):
+
+    abs_path = '/async'
+
+    async def REQMOD(self, icap_request):
+        http_request, chunks = icap_request.modify_http_request(decode=False)
+        http_request['X-Scanned'] = 'yes'
+        body = b''
+        async for chunk in chunks:
+            body += chunk
+        return OK(http_request=http_request, chunks=[body.upper()])
+
+
+class DecodeService(ICAPService):
+
+    abs_path = '/async'
+
+    async def REQMOD(self, icap_request):
+        await asyncio.sleep(0)
+        http_request, chunks = icap_request.modify_http_request()
+        return OK(http_request=http_request, chunks=chunks)
+
+
+class RecodeService(ICAPService):
+
+    abs_path = '/async'
+
+    async def REQMOD(self, icap_request):
+        http_request, chunks = icap_request.modify_http_request()
+        body = await icap_request.spool(chunks)
+        with body:
+            data = bytes(body.map())
+        chunks = icap_request.encode_body(http_request, [data.upper()])
+        return OK(http_request=http_request, chunks=chunks)
+
+    async def RESPMOD(self, icap_request):
+        http_response, chunks = icap_request.modify_http_response()
+        chunks = icap_request.encode_body(http_response,
+                                          self.modify_chunks(chunks))
+        return OK(http_response=http_response, chunks=chunks)
+
+    async def modify_chunks(self, chunks):
+        async for chunk in chunks:
+            yield chunk.upper()
+
+
+def gzip_message(method, section, start_line, body):
+    z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    body = z.compress(body) + z.flush()
+    http_headers = start_line + b'Content-Encoding: gzip\r\n\r\n'
+    return (
+        method + b' icap://icap.example.net/async ICAP/1.0\r\n'
+        b'Host: icap.example.net\r\n'
+        b'Encapsulated: %s-hdr=0, %s-body=%d\r\n' % (
+            section, section, len(http_headers)) +
+        b'\r\n' + http_headers +
+        b'%x\r\n' % len(body) + body + b'\r\n0\r\n\r\n')
+
+
+def gunzip_response(response):
+    _, _, chunked = response.partition(
+        b'\r\nContent-Encoding: gzip\r\n\r\n')
+    body = b''
+    while True:
+        size, _, chunked = chunked.partition(b'\r\n')
+        size = int(size, 16)
+        if not size:
+            break
+        body += chunked[:size]
+        chunked = chunked[size + 2:]
+    return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+
+def test_decode_and_encode_modified_response():
+    body = b'hello ' * 10000
+    request = gzip_message(b'RESPMOD', b'res', b'HTTP/1.1 200 OK\r\n',
+                           body)
+    response, = exchange(RecodeService(), request, until=b'\r\n0\r\n\r\n')
+    assert response.startswith(b'ICAP/1.0 200 OK\r\n')
+    assert gunzip_response(response) == body.upper()
+
+
+def test_decode_and_spool_modified_request():
+    body = b'hello ' * 10000
+    request = gzip_message(b'REQMOD', b'req', b'POST /upload HTTP/1.1\r\n',
+                           body)
+    response, = exchange(RecodeService(), request, until=b'\r\n0\r\n\r\n')
+    assert response.startswith(b'ICAP/1.0 200 OK\r\n')
+    assert gunzip_response(response) == body.upper()
+
+
+class StreamService(ICAPService):
+
+    abs_path = '/async'
+
+    async def RESPMOD(self, icap_request):
+        http_response, chunks = icap_request.modify_http_response(max_size=4)
+        return OK(http_response=http_response, chunks=chunks)
+
+
+def test_streamed_decode_limit_answers_204():
+    request = gzip_message(b'RESPMOD', b'res', b'HTTP/1.1 200 OK\r\n',
+                           b'hello').replace(
+        b'Host: icap.example.net\r\n',
+        b'Host: icap.example.net\r\nAllow: 204\r\n')
+    first, second = exchange(StreamService(), request, request)
+    assert first.startswith(b'ICAP/1.0 204 ')
+    assert second.startswith(b'ICAP/1.0 204 ')
+
+
+def exchange(service, *requests, until=b'\r\n\r\n', **handler_kwargs):
+
+    loop = asyncio.new_event_loop()
+    handler_class = service.icap_handler_class(**handler_kwargs)
+    server = handler_class.server(AsyncICAPServer, ('127.0.0.1', 0), loop=loop)
+
+    async def client():
+        reader, writer = await asyncio.open_connection(*server.server_address)
+        responses = []
+        for request in requests:
+            writer.write(request)
+            responses.append(await reader.readuntil(until))
+        writer.close()
+        return responses
+
+    try:
+        return loop.run_until_complete(client())
+    finally:
+        server.server_close()
+
+
+def test_options():
+    response, = exchange(AsyncService(), options_request)
+    assert response.startswith(b'ICAP/1.0 200 OK\r\n')
+    assert b'\r\nMethods: REQMOD\r\n' in response
+
+
+def test_metrics():
+    registry = MetricsRegistry()
+    response, = exchange(NoMod(), nomod_request, metrics=registry)
+    text = registry.exposition()
+    labels = 'service="/nomod",method="RESPMOD"'
+    assert 'icap_requests_total{%s,status="204"} 1\n' % labels in text
+    assert ('icap_request_bytes_total{%s} %d\n' % (labels,
+                                                   len(nomod_request))
+            in text)
+    assert ('icap_response_bytes_total{%s} %d\n' % (labels, len(response))
+            in text)
+    assert 'icap_service_seconds_count{%s} 1\n' % labels in text
+
+
+@pytest.mark.parametrize('handler_kwargs', [
+    {'write_buffer_size': 0},
+    {'coalesce_size': 16384},
+])
+def test_unsupported_settings(handler_kwargs):
+    handler_class = AsyncService().icap_handler_class(**handler_kwargs)
+    with pytest.raises(ValueError):
+        handler_class.server(AsyncICAPServer, ('127.0.0.1', 0))
+
+
+def test_async_method_persistent_connection():
+    first, second = exchange(AsyncService(), reqmod_request, reqmod_request)
+    assert first.startswith(b'ICAP/1.0 204 ')
+    assert second.startswith(b'ICAP/1.0 204 ')
+
+
+def test_modified_message():
+    response, = exchange(ModifyService(), reqmod_request,
+                         until=b'\r\n0\r\n\r\n')
+    assert response.startswith(b'ICAP/1.0 200 OK\r\n')
+    assert response.endswith(
+        b'\r\n\r\n'
+        b'POST /upload HTTP/1.1\r\n'
+        b'Host: example.net\r\n'
+        b'X-Scanned: yes\r\n'
+        b'\r\n'
+        b'5\r\nHELLO\r\n0\r\n\r\n')
+
+
+def test_decode_error_answers_204():
+    request = reqmod_request.replace(
+        b'Host: icap.example.net\r\n',
+        b'Host: icap.example.net\r\nAllow: 204\r\n').replace(
+        b'req-body=44', b'req-body=72').replace(
+        b'Host: example.net\r\n',
+        b'Host: example.net\r\nContent-Encoding: compress\r\n')
+    first, second = exchange(DecodeService(), request, request)
+    assert first.startswith(b'ICAP/1.0 204 ')
+    assert second.startswith(b'ICAP/1.0 204 ')
+
+
+preview_request = (
+    b'RESPMOD icap://icap.example.net/unknown ICAP/1.0\r\n'
+    b'Host: icap.example.net\r\n'
+    b'Preview: 5\r\n'
+    b'Encapsulated: res-hdr=0, res-body=19\r\n'
+    b'\r\n'
+    b'HTTP/1.1 200 OK\r\n'
+    b'\r\n'
+    b'5\r\n'
+    b'hello\r\n'
+    b'0\r\n'
+    b'\r\n'
+)
+
+
+def test_error_after_preview_keeps_connection():
+    # the rest of the body is never sent, the next request follows
+    first, second = exchange(AsyncService(), preview_request, options_request)
+    assert first.startswith(b'ICAP/1.0 404 ')
+    assert second.startswith(b'ICAP/1.0 200 OK\r\n')
+    assert b'100 Continue' not in first + second
+
+
+nomod_request = preview_request.replace(
+    b'/unknown', b'/nomod').replace(b'Preview: 5\r\n', b'Allow: 204\r\n')
+
+
+def test_discard_rest_of_body():
+    first, second = exchange(NoMod(), nomod_request, nomod_request)
+    assert first.startswith(b'ICAP/1.0 204 ')
+    assert second.startswith(b'ICAP/1.0 204 ')
+
+
+def test_server_close_with_open_connection():
+    server = serve(AsyncICAPServer, AsyncService())
+    with socket.create_connection(server.server_address, 5) as sock:
+        sock.sendall(options_request)
+        assert sock.recv(17) == b'ICAP/1.0 200 OK\r\n'
+        # the connection is left open and idle, as a proxy keeps it
+        server.shutdown()
+        tasks = list(server.connections.values())
+        assert len(tasks) == 1
+        server.server_close()
+        assert tasks[0].done()
+        assert not server.connections
+        rest = sock.makefile('rb').read()
+        assert rest.endswith(b'\r\n\r\n')
+
+
+class SlowService(AsyncService):
+
+    async def REQMOD(self, icap_request):
+        async for chunk in icap_request.chunks:
+            pass
+        await asyncio.sleep(float(icap_request.get('x-sleep', '0')))
+        return NoModificationsNeeded()
+
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
+
+
+def test_idle_and_header_timeouts():
+    server = serve(AsyncICAPServer, AsyncService(), idle_timeout=0.1,
+                   header_timeout=0.1)
+    try:
+        with socket.create_connection(server.server_address, 5) as idle:
+            with socket.create_connection(server.server_address, 5) as slow:
+                slow.sendall(options_request[:20])
+                started = time.time()
+                assert idle.recv(1) == b''
+                assert slow.recv(1) == b''
+                assert time.time() - started < 2
+    finally:
+        stop(server)
+
+
+def test_body_timeout():
+    server = serve(AsyncICAPServer, AsyncService(), body_timeout=0.1)
+    try:
+        with socket.create_connection(server.server_address, 5) as sock:
+            sock.sendall(reqmod_request[:-15])
+            started = time.time()
+            assert sock.recv(1) == b''
+            assert time.time() - started < 2
+    finally:
+        stop(server)
+
+
+def test_body_timeout_discarding_body():
+    server = serve(AsyncICAPServer, NoMod(), body_timeout=0.1)
+    try:
+        with socket.create_connection(server.server_address, 5) as sock:
+            sock.sendall(nomod_request[:-15])
+            rfile = sock.makefile('rb')
+            started = time.time()
+            assert read_response(rfile)[0].startswith(b'ICAP/1.0 204 ')
+            assert rfile.read() == b''
+            assert time.time() - started < 2
+    finally:
+        stop(server)
+
+
+def test_max_requests():
+    server = serve(AsyncICAPServer, AsyncService(), max_requests=2)
+    try:
+        with socket.create_connection(server.server_address, 5) as sock:
+            rfile = sock.makefile('rb')
+            sock.sendall(options_request)
+            assert b'Connection: close\r\n' not in read_response(rfile)
+            sock.sendall(options_request)
+            assert b'Connection: close\r\n' in read_response(rfile)
+            assert rfile.read() == b''
+    finally:
+        stop(server)
+
+
+def test_drain():
+    slow_request = reqmod_request.replace(
+        b'Host: icap.example.net\r\n',
+        b'Host: icap.example.net\r\nX-Sleep: 0.3\r\n')
+    server = serve(AsyncICAPServer, SlowService())
+    try:
+        with socket.create_connection(server.server_address, 5) as idle:
+            with socket.create_connection(server.server_address, 5) as busy:
+                idle.sendall(options_request)
+                read_response(idle.makefile('rb'))
+                busy.sendall(slow_request)
+                time.sleep(0.1)
+                assert server.drain(timeout=5)
+                assert idle.recv(1) == b''
+                rfile = busy.makefile('rb')
+                assert read_response(rfile)[0].startswith(b'ICAP/1.0 204 ')
+                assert rfile.read() == b''
+    finally:
+        server.server_close()
+
+
+def test_drain_timeout():
+    slow_request = reqmod_request.replace(
+        b'Host: icap.example.net\r\n',
+        b'Host: icap.example.net\r\nX-Sleep: 5\r\n')
+    server = serve(AsyncICAPServer, SlowService())
+    try:
+        with socket.create_connection(server.server_address, 5) as busy:
+            busy.sendall(slow_request)
+            time.sleep(0.1)
+            started = time.time()
+            assert not server.drain(timeout=0.2)
+            assert time.time() - started < 2
+    finally:
+        server.server_close()
+
+
+def test_shutdown_waits_for_serve_forever():
+    for _ in range(10):
+        server = serve(AsyncICAPServer, AsyncService())
+        time.sleep(0.01)
+        server.shutdown()
+        assert not server.loop.is_running()
+        server.server_close()
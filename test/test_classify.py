@@ -0,0 +1,136 @@
+from six import BytesIO
+from icapservice import ICAPService, OK
+from icapservice.classify import (MediaClassifier,
+                                  sniff,
+                                  content_type_kind,
+                                  preview_head)
+from icapservice.request import ICAPRequest
+from mocksocket import MockSocket
+
+
+def respmod_request(headers, preview, rest=b'', ieof=False):
+    res_hdr = b'HTTP/1.1 200 OK\r\n' + headers + b'\r\n'
+    return (
+        b'RESPMOD icap://icap.example.net/scan ICAP/1.0\r\n'
+        b'Host: icap.example.net\r\n'
+        b'Preview: %d\r\n'
+        b'Encapsulated: res-hdr=0, res-body=%d\r\n'
+        b'\r\n' % (len(preview), len(res_hdr)) +
+        res_hdr +
+        b'%x\r\n' % len(preview) + preview + b'\r\n' +
+        (b'0; ieof\r\n\r\n' if ieof else b'0\r\n\r\n') +
+        rest
+    )
+
+
+def parse(request_bytes):
+    return ICAPRequest.parse(BytesIO(request_bytes), lambda: None)
+
+
+class Scanner(ICAPService):
+
+    abs_path = '/scan'
+    classifiers = [MediaClassifier(max_length=1000000)]
+    scanned = 0
+
+    def RESPMOD(self, icap_request):
+        Scanner.scanned += 1
+        http_response, chunks = icap_request.modify_http_response()
+        return OK(http_response=http_response, chunks=chunks)
+
+
+def test_sniff():
+    assert sniff(b'\x89PNG\r\n\x1a\n\x00\x00') == 'image'
+    assert sniff(b'\x00\x00\x00\x20ftypisom') == 'video'
+    assert sniff(b'RIFF\x00\x00\x00\x00WEBPVP8 ') == 'image'
+    assert sniff(b'PK\x03\x04') == 'archive'
+    assert sniff(b'wOF2') == 'font'
+    assert sniff(b'<!DOCTYPE html>') is None
+    assert sniff(b'') is None
+
+
+def test_preview_head_joins_small_chunks():
+    assert preview_head([b'\x89P', b'NG', b'\r\n\x1a\n' * 5, b'x']) == \
+        b'\x89PNG' + b'\r\n\x1a\n' * 5
+
+
+def test_content_type_kind():
+    assert content_type_kind('image/png') == 'image'
+    assert content_type_kind('Video/MP4; codecs="avc1"') == 'video'
+    assert content_type_kind('application/zip') == 'archive'
+    assert content_type_kind('image/svg+xml') is None
+    assert content_type_kind('text/html') is None
+    assert content_type_kind('') is None
+
+
+def test_classifier_magic_bytes():
+    request = parse(respmod_request(b'Content-Type: image/jpeg\r\n',
+                                    b'\xff\xd8\xff\xe0\x00\x10JFIF'))
+    assert MediaClassifier()(request).status_code == 204
+    assert MediaClassifier(kinds=['video'])(request) is None
+
+
+def test_classifier_media_bytes_in_scriptable_type():
+    for content_type in (b'text/html', b'application/javascript',
+                         b'image/svg+xml', b'video/mp4'):
+        for trust_content_type in (False, True):
+            request = parse(respmod_request(
+                b'Content-Type: ' + content_type + b'\r\n',
+                b'GIF89a<script>'))
+            classifier = MediaClassifier(
+                trust_content_type=trust_content_type)
+            assert classifier(request) is None
+    request = parse(respmod_request(b'', b'GIF89a<script>'))
+    assert MediaClassifier()(request) is None
+
+
+def test_classifier_content_type():
+    res_hdr = b'HTTP/1.1 200 OK\r\nContent-Type: image/gif\r\n\r\n'
+    request = parse(
+        b'RESPMOD icap://icap.example.net/scan ICAP/1.0\r\n'
+        b'Host: icap.example.net\r\n'
+        b'Preview: 0\r\n'
+        b'Encapsulated: res-hdr=0, res-body=%d\r\n'
+        b'\r\n' % len(res_hdr) + res_hdr + b'0\r\n\r\n')
+    assert MediaClassifier()(request) is None
+    assert MediaClassifier(trust_content_type=True)(request).status_code == 204
+
+
+def test_classifier_mislabelled_body():
+    for content_type in (b'image/png', b'application/zip'):
+        for preview in (b'MZ\x90\x00\x03\x00', b'<html><script>'):
+            request = parse(respmod_request(
+                b'Content-Type: ' + content_type + b'\r\n', preview))
+            assert MediaClassifier()(request) is None
+
+
+def test_classifier_ignores_encoded_preview():
+    request = parse(respmod_request(b'Content-Type: text/html\r\n'
+                                    b'Content-Encoding: gzip\r\n',
+                                    b'\x1f\x8b\x08\x00'))
+    assert MediaClassifier()(request) is None
+
+
+def test_classifier_max_length():
+    request = parse(respmod_request(b'Content-Type: text/html\r\n'
+                                    b'Content-Length: 5000\r\n',
+                                    b'<html>'))
+    assert MediaClassifier()(request) is None
+    assert MediaClassifier(max_length=4096)(request).status_code == 204
+
+
+def test_handler_answers_media_without_continue():
+    next_request = respmod_request(b'Content-Type: text/html\r\n',
+                                   b'<html>', ieof=True)
+    # the rest of the image body is never sent, the next request follows
+    request_bytes = respmod_request(b'Content-Type: image/png\r\n',
+                                    b'\x89PNG\r\n\x1a\n') + next_request
+    Scanner.scanned = 0
+    socket = MockSocket(request_bytes)
+    Scanner().icap_handler_class()(socket, object(), object())
+    response = socket.wfile.value
+    assert response.startswith(b'ICAP/1.0 204 No modifications needed\r\n')
+    assert b'ISTag: ' in response
+    assert b'100 Continue' not in response
+    assert b'ICAP/1.0 200 OK\r\n' in response
+    assert Scanner.scanned == 1
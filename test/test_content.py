@@ -10,3 +10,130 @@ def test_brotli():
     for chunk in decode_brotli(alice):
         alice_in_wonderland += chunk
     assert 'Mock Turtle' in alice_in_wonderland
+
+
+def test_encoders_round_trip():
+    from icapservice.content import encoders
+    chunks = [b'The quick brown fox %d\n' % i for i in range(1000)]
+    for encoding in ('br', 'deflate', 'gzip', 'identity'):
+        for level in (None, 1):
+            encoded = list(encoders[encoding](iter(chunks), level))
+            assert b''.join(decoders[encoding](encoded)) == b''.join(chunks)
+    # streamed, not one block at the end
+    assert len(list(encoders['gzip'](iter(chunks * 100), 1))) > 2
+
+
+def test_accepted_encoding():
+    from icapservice.content import accepted_encoding
+    assert accepted_encoding('gzip, deflate, br') == 'br'
+    assert accepted_encoding('gzip;q=1.0, br;q=0.5') == 'gzip'
+    assert accepted_encoding('br;q=0, deflate') == 'deflate'
+    assert accepted_encoding('*') == 'br'
+    assert accepted_encoding('compress') == 'identity'
+    assert accepted_encoding('') == 'identity'
+
+
+def gzip_bytes(data):
+    from icapservice.content import encoders
+    return b''.join(encoders['gzip']([data]))
+
+
+def test_decode_steps_are_bounded():
+    # a 4 MB body in a few kB of gzip
+    bomb = gzip_bytes(b'\0' * (4 * 1024 * 1024))
+    decoded = 0
+    for chunk in decoders['gzip']([bomb], max_ratio=None, step_size=1024):
+        assert len(chunk) <= 1024
+        decoded += len(chunk)
+    assert decoded == 4 * 1024 * 1024
+
+
+def test_decode_max_size():
+    import pytest
+    from icapservice.content import DecodeLimitExceeded
+    data = gzip_bytes(os.urandom(100000))
+    assert len(b''.join(decoders['gzip']([data], max_size=100000))) == 100000
+    with pytest.raises(DecodeLimitExceeded):
+        for _ in decoders['gzip']([data], max_size=99999):
+            pass
+
+
+def test_decode_max_ratio():
+    import pytest
+    import brotli
+    from icapservice.content import DecodeLimitExceeded
+    bomb = brotli.compress(b'\0' * (4 * 1024 * 1024), quality=1)
+    decoded = 0
+    with pytest.raises(DecodeLimitExceeded):
+        for chunk in decoders['br']([bomb]):
+            decoded += len(chunk)
+    assert decoded < 2 * 1024 * 1024
+
+
+def test_decode_small_input_chunks():
+    import brotli
+    import zlib
+    data = b''.join(b'line %d\n' % i for i in range(10000))
+    for encoding, compressed in (('br', brotli.compress(data)),
+                                 ('deflate', zlib.compress(data)),
+                                 ('deflate', zlib.compress(data)[2:-4]),
+                                 ('gzip', gzip_bytes(data))):
+        chunks = [compressed[i:i + 7] for i in range(0, len(compressed), 7)]
+        decoded = b''.join(decoders[encoding](chunks, step_size=100))
+        assert decoded == data
+
+
+def test_content_codings():
+    from icapservice.content import content_codings
+    assert content_codings('gzip') == ['gzip']
+    assert content_codings(' GZIP , br') == ['gzip', 'br']
+    assert content_codings('identity') == []
+    assert content_codings('') == []
+
+
+def test_decode_stacked_codings():
+    import brotli
+    from icapservice.content import decode_content
+    data = b''.join(b'line %d\n' % i for i in range(10000))
+    compressed = brotli.compress(gzip_bytes(data))
+    chunks = [compressed[i:i + 100] for i in range(0, len(compressed), 100)]
+    assert b''.join(decode_content('gzip, br', chunks)) == data
+    assert b''.join(decode_content('identity', [data])) == data
+
+
+def test_decode_stacked_ratio():
+    import pytest
+    from icapservice.content import decode_content, DecodeLimitExceeded
+    # each coding alone expands less than 200 times
+    bomb = gzip_bytes(gzip_bytes(b'\0' * (16 * 1024 * 1024)))
+    with pytest.raises(DecodeLimitExceeded):
+        for _ in decode_content('gzip, gzip', [bomb]):
+            pass
+
+
+def test_unsupported_encoding():
+    import pytest
+    from icapservice.content import decode_content, UnsupportedEncoding
+    with pytest.raises(UnsupportedEncoding):
+        decode_content('gzip, compress', [b''])
+
+
+def test_zstd():
+    import pytest
+    zstandard = pytest.importorskip('zstandard')
+    from icapservice.content import encoders, DecodeLimitExceeded
+    data = b''.join(b'line %d\n' % i for i in range(10000))
+    encoded = b''.join(encoders['zstd']([data[:1000], data[1000:]]))
+    chunks = [encoded[i:i + 7] for i in range(0, len(encoded), 7)]
+    assert b''.join(decoders['zstd'](chunks)) == data
+
+    compressor = zstandard.ZstdCompressor()
+    frames = (compressor.compress(b'a' * 10) + compressor.compress(b'') +
+              compressor.compress(b'b' * 10))
+    chunks = [frames[i:i + 5] for i in range(0, len(frames), 5)]
+    assert b''.join(decoders['zstd'](chunks)) == b'a' * 10 + b'b' * 10
+
+    bomb = zstandard.ZstdCompressor().compress(b'\0' * (4 * 1024 * 1024))
+    with pytest.raises(DecodeLimitExceeded):
+        for chunk in decoders['zstd']([bomb], step_size=1024):
+            assert len(chunk) <= 1024
@@ -52,3 +52,11 @@ def test_encapsulated_header_offsets_wrong_order():
     offsets = [('res-hdr', 2), ('res-body', 1)]
     with pytest.raises(BadComposition):
         check(offsets)
+
+
+def test_encapsulated_offset_too_large():
+    check([('res-hdr', 0), ('res-body', 65536)])
+    with pytest.raises(BadComposition):
+        check([('res-hdr', 0), ('res-body', 65537)])
+    with pytest.raises(BadComposition):
+        encapsulated_offsets('req-hdr=0, null-body=100', max_offset=99)
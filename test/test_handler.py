@@ -1,4 +1,7 @@
+import zlib
 from six import BytesIO
+import pytest
+from icapservice.request import ICAPRequest
 from icapservice.service import ICAPService
 from icapservice.handler import service_abs_path
 from icapservice.response import ICAPResponse
@@ -48,3 +51,190 @@ def test_handle_one_request_service_not_found():
     wfile = BytesIO(request.wfile.value)
     assert wfile.readline() == 'ICAP/1.0 404 ICAP Service not found\r\n'
 
+
+
+allow_204_request = (
+    b'RESPMOD icap://icap.example.net/inspect ICAP/1.0\r\n'
+    b'Host: icap.example.net\r\n'
+    b'Allow: 204\r\n'
+    b'Encapsulated: res-hdr=0, res-body=19\r\n'
+    b'\r\n'
+    b'HTTP/1.1 200 OK\r\n'
+    b'\r\n'
+    b'5\r\n'
+    b'hello\r\n'
+    b'0\r\n'
+    b'\r\n'
+)
+
+
+class Inspect(ICAPService):
+
+    abs_path = '/inspect'
+    read_body = True
+
+    def RESPMOD(self, icap_request):
+        if self.read_body:
+            assert list(icap_request.chunks) == [b'hello']
+        return icap_request.unmodified()
+
+
+def status_lines(response_bytes):
+    return [line for line in response_bytes.split(b'\r\n')
+            if line.startswith(b'ICAP/1.0 ')]
+
+
+def test_204_after_reading_body():
+    handler_class = Inspect().icap_handler_class()
+    request = MockSocket(allow_204_request * 2)
+    handler_class(request, object(), object())
+    assert status_lines(request.wfile.value) == [
+        b'ICAP/1.0 204 No modifications needed'] * 2
+
+
+def test_204_without_reading_body():
+    service = Inspect()
+    service.read_body = False
+    handler_class = service.icap_handler_class()
+    request = MockSocket(allow_204_request * 2)
+    handler_class(request, object(), object())
+    assert status_lines(request.wfile.value) == [
+        b'ICAP/1.0 204 No modifications needed'] * 2
+
+
+def test_unmodified_without_allow_204_echoes_body():
+    service = Inspect()
+    service.read_body = False
+    handler_class = service.icap_handler_class()
+    request = MockSocket(allow_204_request.replace(b'Allow: 204\r\n', b''))
+    handler_class(request, object(), object())
+    assert status_lines(request.wfile.value) == [b'ICAP/1.0 200 OK']
+    # the response has no headers but is still echoed
+    assert b'\r\nEncapsulated: res-hdr=0, res-body=19\r\n' in (
+        request.wfile.value)
+    assert request.wfile.value.endswith(
+        b'\r\n\r\nHTTP/1.1 200 OK\r\n\r\n5\r\nhello\r\n0\r\n\r\n')
+
+
+def test_unmodified_after_reading_body():
+    request = ICAPRequest.parse(
+        BytesIO(allow_204_request.replace(b'Allow: 204\r\n', b'')))
+    assert list(request.chunks) == [b'hello']
+    with pytest.raises(ValueError):
+        request.unmodified()
+
+
+class Spool(ICAPService):
+
+    abs_path = '/inspect'
+
+    def RESPMOD(self, icap_request):
+        http_response, chunks = icap_request.modify_http_response(max_size=4)
+        return ICAPResponse(200, http_response=http_response,
+                            chunks=list(chunks))
+
+
+def test_decode_limit_answers_204():
+    body = zlib.compress(b'hello')
+    gzip_request = allow_204_request.replace(
+        b'res-body=19', b'res-body=46').replace(
+        b'OK\r\n', b'OK\r\nContent-Encoding: deflate\r\n').replace(
+        b'5\r\nhello', b'%x\r\n' % len(body) + body)
+    handler_class = Spool().icap_handler_class()
+    request = MockSocket(gzip_request * 2)
+    handler_class(request, object(), object())
+    assert status_lines(request.wfile.value) == [
+        b'ICAP/1.0 204 No modifications needed'] * 2
+
+
+class Stream(ICAPService):
+
+    abs_path = '/inspect'
+    max_size = 100000
+
+    def RESPMOD(self, icap_request):
+        http_response, chunks = icap_request.modify_http_response(
+            max_size=self.max_size)
+        return ICAPResponse(200, http_response=http_response, chunks=chunks)
+
+
+def deflate_request(data):
+    body = zlib.compress(data)
+    return allow_204_request.replace(
+        b'res-body=19', b'res-body=46').replace(
+        b'OK\r\n', b'OK\r\nContent-Encoding: deflate\r\n').replace(
+        b'5\r\nhello', b'%x\r\n' % len(body) + body)
+
+
+def test_streamed_decode_limit_answers_204():
+    service = Stream()
+    service.max_size = 4
+    handler_class = service.icap_handler_class()
+    request = MockSocket(deflate_request(b'hello') * 2)
+    handler_class(request, object(), object())
+    assert status_lines(request.wfile.value) == [
+        b'ICAP/1.0 204 No modifications needed'] * 2
+
+
+def test_streamed_decode_limit_closes_connection():
+    handler_class = Stream().icap_handler_class()
+    # the first step of decoding is within the limit
+    request = MockSocket(deflate_request(b'a' * 200000) * 2)
+    handler = handler_class(request, object(), object())
+    assert handler.close_connection
+    assert status_lines(request.wfile.value) == [b'ICAP/1.0 200 OK']
+    assert not request.wfile.value.endswith(b'\r\n0\r\n\r\n')
+
+
+class Slow(ICAPService):
+
+    abs_path = '/inspect'
+    written = None
+
+    def RESPMOD(self, icap_request):
+        list(icap_request.chunks)
+        return ICAPResponse(200, http_response=icap_request.http_response,
+                            chunks=self.chunks())
+
+    def chunks(self):
+        Slow.written = []
+        for chunk in (b'a', b'b'):
+            yield chunk
+            # a slow service, what it produced so far is already sent
+            Slow.written.append(self.socket.wfile.getvalue())
+        yield b'c'
+
+
+def test_streamed_chunks_not_held_back():
+    service = Slow()
+    service.socket = MockSocket(allow_204_request.replace(b'Allow: 204\r\n',
+                                                          b''))
+    service.icap_handler_class()(service.socket, object(), object())
+    first, second = Slow.written
+    assert first.startswith(b'ICAP/1.0 200 OK\r\n')
+    assert first.endswith(b'\r\n\r\n1\r\na\r\n')
+    assert second.endswith(b'\r\n\r\n1\r\na\r\n1\r\nb\r\n')
+    assert service.socket.wfile.value.endswith(
+        b'1\r\na\r\n1\r\nb\r\n1\r\nc\r\n0\r\n\r\n')
+
+
+class EchoViews(ICAPService):
+
+    abs_path = '/inspect'
+
+    def RESPMOD(self, icap_request):
+        return ICAPResponse(200, http_response=icap_request.http_response,
+                            chunks=icap_request.body_views(buffer_size=4))
+
+
+@pytest.mark.parametrize('coalesce_size, body', [
+    (16384, b'4\r\nAAAA\r\n8\r\nBBBBCCCC\r\n0\r\n\r\n'),
+    (0, b'4\r\nAAAA\r\n4\r\nBBBB\r\n4\r\nCCCC\r\n0\r\n\r\n'),
+])
+def test_body_views_as_response_chunks(coalesce_size, body):
+    request = MockSocket(allow_204_request.replace(
+        b'5\r\nhello\r\n', b'4\r\nAAAA\r\n4\r\nBBBB\r\n4\r\nCCCC\r\n'))
+    handler_class = EchoViews().icap_handler_class(
+        coalesce_size=coalesce_size)
+    handler_class(request, object(), object())
+    assert request.wfile.value.endswith(b'\r\n\r\n' + body)
@@ -0,0 +1,115 @@
+from __future__ import print_function
+from copy import deepcopy
+from six import BytesIO
+import pytest
+from icapservice.headers import Headers
+from icapservice.messages import HTTPResponse
+
+
+block = (
+    b'Host: www.origin-server.com\r\n'
+    b'Accept: text/html\r\n'
+    b'X-Folded: first\r\n'
+    b' second\r\n'
+    b'accept: image/gif\r\n'
+)
+
+
+def parse(data=block):
+    return Headers(BytesIO(data + b'\r\nbody'))
+
+
+def test_read_stops_at_blank_line():
+    rfile = BytesIO(block + b'\r\nbody')
+    Headers(rfile)
+    assert rfile.read() == b'body'
+
+
+def test_lookup_ignores_case():
+    headers = parse()
+    assert headers['HOST'] == 'www.origin-server.com'
+    assert headers.get('host') == 'www.origin-server.com'
+    assert 'hOsT' in headers
+    assert 'Cookie' not in headers
+    assert headers.get('cookie') is None
+    assert headers.get('cookie', '') == ''
+    with pytest.raises(KeyError):
+        headers['cookie']
+
+
+def test_repeated_headers():
+    headers = parse()
+    assert headers['accept'] == 'text/html, image/gif'
+    assert headers.get_all('Accept') == ['text/html', 'image/gif']
+    assert headers.getheaders('cookie') == []
+    assert headers.keys() == ['host', 'accept', 'x-folded']
+    assert len(headers) == 3
+
+
+def test_folded_header():
+    assert parse()['x-folded'] == 'first second'
+
+
+def test_raw_round_trip():
+    data = b'Host:  example.net\nX-Odd:value \r\n'
+    headers = parse(data)
+    assert headers.header_bytes() == data
+    assert headers['x-odd'] == 'value'
+
+
+def test_set_and_delete():
+    headers = parse()
+    headers['Accept'] = 'text/plain'
+    del headers['x-folded']
+    del headers['cookie']
+    headers['Via'] = '1.0 icap.example.net'
+    assert headers.items() == [('host', 'www.origin-server.com'),
+                               ('accept', 'text/plain'),
+                               ('via', '1.0 icap.example.net')]
+    assert headers.header_bytes() == (
+        b'Host: www.origin-server.com\r\n'
+        b'Accept: text/plain\r\n'
+        b'Via: 1.0 icap.example.net\r\n')
+
+
+def test_setdefault():
+    headers = parse()
+    assert headers.setdefault('host', 'other') == 'www.origin-server.com'
+    assert headers.setdefault('Via', 'proxy') == 'proxy'
+    assert headers['via'] == 'proxy'
+
+
+def test_truth():
+    assert not Headers()
+    assert parse()
+
+
+def test_deepcopy():
+    headers = parse()
+    copied = deepcopy(headers)
+    copied['host'] = 'copy.example.net'
+    assert headers['host'] == 'www.origin-server.com'
+    assert headers.header_bytes() == block
+
+
+def test_copy_shares_until_modified():
+    headers = parse()
+    copied = headers.copy()
+    assert copied.header_bytes() is headers.header_bytes()
+    copied['Via'] = 'proxy'
+    del copied['accept']
+    assert 'via' not in headers
+    assert headers['accept'] == 'text/html, image/gif'
+    assert headers.header_bytes() == block
+    assert copied.keys() == ['host', 'x-folded', 'via']
+
+
+def test_copy_keeps_attributes():
+    response = HTTPResponse.parse(BytesIO(b'HTTP/1.1 200 OK\r\n' + block +
+                                          b'\r\nbody'))
+    copied = response.copy()
+    copied.status_code = 403
+    assert (copied.protocol, copied.reason) == ('HTTP/1.1', 'OK')
+    assert response.status_code == 200
+    assert copied.fp is None
+    assert response.fp is not None
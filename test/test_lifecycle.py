@@ -0,0 +1,252 @@
+import os
+import time
+import socket
+import threading
+import pytest
+from contextlib import closing
+from icapservice import ThreadingICAPServer, ICAPService
+from icapservice.response import ICAPResponse
+from icapservice.lifecycle import RequestReader
+from icapservice.metrics import MetricsRegistry
+from icapservice.request import MAX_REQUEST_LEN
+from servers import NoMod, connect, options_request, read_response, serve
+
+
+def test_idle_timeout():
+    server = serve(ThreadingICAPServer, NoMod(), idle_timeout=0.1)
+    try:
+        with connect(server.server_address) as sock:
+            started = time.time()
+            assert sock.recv(1) == b''
+            assert time.time() - started < 2
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_header_timeout():
+    server = serve(ThreadingICAPServer, NoMod(), idle_timeout=5,
+                   header_timeout=0.1)
+    try:
+        with connect(server.server_address) as sock:
+            sock.sendall(options_request[:20])
+            started = time.time()
+            assert sock.recv(1) == b''
+            assert time.time() - started < 2
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def trickle(sock, data, interval):
+    try:
+        for byte in range(len(data)):
+            sock.sendall(data[byte:byte + 1])
+            time.sleep(interval)
+    except socket.error:
+        pass
+
+
+def test_header_deadline_with_trickling_client():
+    server = serve(ThreadingICAPServer, NoMod(), idle_timeout=5,
+                   header_timeout=0.5)
+    try:
+        with connect(server.server_address) as sock:
+            sender = threading.Thread(target=trickle,
+                                      args=(sock, options_request * 10, 0.05))
+            sender.daemon = True
+            started = time.time()
+            sender.start()
+            try:
+                assert sock.recv(1) == b''
+            except socket.error:
+                pass
+            assert time.time() - started < 1.5
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class ReadBody(ICAPService):
+
+    abs_path = '/nomod'
+    stream = False
+
+    def RESPMOD(self, icap_request):
+        chunks = icap_request.chunks
+        if not self.stream:
+            chunks = list(chunks)
+        return ICAPResponse(200, chunks=chunks)
+
+
+class ErrorRecordingServer(ThreadingICAPServer):
+
+    def __init__(self, *args, **kwargs):
+        ThreadingICAPServer.__init__(self, *args, **kwargs)
+        self.errors = []
+
+    def handle_error(self, request, client_address):
+        self.errors.append(client_address)
+
+
+stalled_body_request = (
+    b'RESPMOD icap://127.0.0.1/nomod ICAP/1.0\r\n'
+    b'Host: 127.0.0.1\r\n'
+    b'Encapsulated: res-hdr=0, res-body=19\r\n'
+    b'\r\n'
+    b'HTTP/1.1 200 OK\r\n'
+    b'\r\n'
+    b'a\r\n'
+    b'hello'
+)
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_body_timeout_with_stalled_body(stream):
+    service = ReadBody()
+    service.stream = stream
+    server = serve(ErrorRecordingServer, service, body_timeout=0.5)
+    try:
+        with connect(server.server_address) as sock:
+            rfile = sock.makefile('rb')
+            sock.sendall(stalled_body_request)
+            started = time.time()
+            # a streamed response is started before the body stalls
+            while rfile.readline():
+                pass
+            # the stalled body is not read again before closing
+            assert time.time() - started < 0.9
+        time.sleep(0.1)
+        assert server.errors == []
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.parametrize('rest', [b'', b'world!!'])
+def test_stalled_or_bad_body_after_204(rest):
+    registry = MetricsRegistry()
+    request = stalled_body_request.replace(
+        b'Host: 127.0.0.1\r\n', b'Host: 127.0.0.1\r\nAllow: 204\r\n')
+    server = serve(ErrorRecordingServer, NoMod(), body_timeout=0.5,
+                   metrics=registry)
+    try:
+        with connect(server.server_address) as sock:
+            rfile = sock.makefile('rb')
+            sock.sendall(request + rest)
+            assert read_response(rfile)[0].startswith(b'ICAP/1.0 204 ')
+            # the rest of the body is not there to skip, the connection
+            # is closed
+            assert rfile.read() == b''
+        time.sleep(0.1)
+        assert server.errors == []
+        assert ('icap_requests_total{service="/nomod",method="RESPMOD",'
+                'status="204"} 1\n') in registry.exposition()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_header_line_too_long():
+    server = serve(ThreadingICAPServer, NoMod(), header_timeout=5)
+    try:
+        with connect(server.server_address) as sock:
+            try:
+                sock.sendall(options_request[:-2] + b'X-Long: ' +
+                             b'x' * (MAX_REQUEST_LEN + 1) + b'\r\n\r\n')
+                assert sock.recv(1) == b''
+            except socket.error:
+                pass
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_max_requests():
+    server = serve(ThreadingICAPServer, NoMod(), max_requests=2)
+    try:
+        with connect(server.server_address) as sock:
+            rfile = sock.makefile('rb')
+            sock.sendall(options_request)
+            assert b'Connection: close\r\n' not in read_response(rfile)
+            sock.sendall(options_request)
+            assert b'Connection: close\r\n' in read_response(rfile)
+            assert rfile.read() == b''
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_drain_closes_idle_connections():
+    server = serve(ThreadingICAPServer, NoMod())
+    try:
+        with connect(server.server_address) as sock:
+            rfile = sock.makefile('rb')
+            sock.sendall(options_request)
+            read_response(rfile)
+            assert server.drain(timeout=5)
+            assert rfile.read() == b''
+    finally:
+        server.server_close()
+
+
+def test_request_reader_readinto_socket_file():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client_sock = socket.create_connection(listener.getsockname(), 5)
+    server_sock, _ = listener.accept()
+    listener.close()
+    with closing(server_sock), closing(client_sock):
+        reader = RequestReader(server_sock.makefile('rb'), server_sock)
+        client_sock.sendall(b'line\r\n0123456789')
+        assert reader.readline() == b'line\r\n'
+        buf = memoryview(bytearray(10))
+        filled = 0
+        while filled < 10:
+            filled += reader.readinto(buf[filled:])
+        assert buf.tobytes() == b'0123456789'
+        client_sock.sendall(b'abc')
+        assert reader.readinto(buf[:3]) == 3
+        assert reader.bytes_read == 19
+
+
+class HighFdSocket(object):
+    """ A socket whose fileno is a duplicate above FD_SETSIZE. """
+
+    def __init__(self, sock, fd):
+        self.sock = sock
+        self.fd = os.dup2(sock.fileno(), fd) or fd
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+        self.sock.close()
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def test_request_reader_wait_for_request_high_fd():
+    import pytest
+    resource = pytest.importorskip('resource')
+    if resource.getrlimit(resource.RLIMIT_NOFILE)[0] <= 1100:
+        pytest.skip('cannot open fds above FD_SETSIZE')
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client_sock = socket.create_connection(listener.getsockname(), 5)
+    server_sock, _ = listener.accept()
+    listener.close()
+    connection = HighFdSocket(server_sock, 1100)
+    with closing(connection), closing(client_sock):
+        reader = RequestReader(server_sock.makefile('rb'), connection)
+        reader.expect_request(0.05, None)
+        with pytest.raises(socket.timeout):
+            reader.wait_for_request()
+        client_sock.sendall(options_request)
+        reader.expect_request(5, None)
+        reader.wait_for_request()
+        assert reader.readline() == options_request.split(b'\n')[0] + b'\n'
@@ -0,0 +1,94 @@
+import threading
+import pytest
+from icapservice import ICAPService, NoModificationsNeeded
+from icapservice.handler import ICAPRequestHandler
+from icapservice.limits import ConcurrencyLimit
+from icapservice.response import ServiceOverloaded
+from mocksocket import MockSocket
+
+
+def reqmod_request(abs_path):
+    return (
+        b'REQMOD icap://icap.example.net' + abs_path + b' ICAP/1.0\r\n'
+        b'Host: icap.example.net\r\n'
+        b'Encapsulated: req-hdr=0, null-body=33\r\n'
+        b'\r\n'
+        b'GET /origin HTTP/1.1\r\n'
+        b'Host: x\r\n'
+        b'\r\n'
+    )
+
+
+class Scanner(ICAPService):
+
+    abs_path = '/scan'
+    max_concurrency = 1
+    max_queued = 0
+
+    def REQMOD(self, icap_request):
+        return NoModificationsNeeded()
+
+
+class Filter(ICAPService):
+
+    abs_path = '/filter'
+
+    def REQMOD(self, icap_request):
+        return NoModificationsNeeded()
+
+
+def status_line(handler_class, request):
+    socket = MockSocket(request)
+    handler_class(socket, object())
+    return socket.wfile.value.split(b'\r\n')[0]
+
+
+def test_limit_admits_up_to_limit():
+    limit = ConcurrencyLimit(2, queue_size=0)
+    assert limit.acquire() == 0.0
+    assert limit.acquire() == 0.0
+    with pytest.raises(ServiceOverloaded):
+        limit.acquire()
+    limit.release()
+    limit.acquire()
+
+
+def test_limit_queue_timeout():
+    limit = ConcurrencyLimit(1, timeout=0.05)
+    limit.acquire()
+    with pytest.raises(ServiceOverloaded):
+        limit.acquire()
+    assert limit.waiting == 0
+
+
+def test_limit_release_admits_waiter():
+    limit = ConcurrencyLimit(1, queue_size=1)
+    limit.acquire()
+    waited = []
+    waiter = threading.Thread(target=lambda: waited.append(limit.acquire()))
+    waiter.start()
+    while not limit.waiting:
+        pass
+    with pytest.raises(ServiceOverloaded):
+        limit.acquire()
+    limit.release()
+    waiter.join()
+    assert waited[0] > 0
+    assert limit.active == 1
+
+
+def test_handler_isolates_services():
+    handler_class = ICAPRequestHandler.for_services([Scanner(), Filter()])
+    assert list(handler_class.service_limits) == ['/scan']
+    limit = handler_class.service_limits['/scan']
+
+    assert status_line(handler_class, reqmod_request(b'/scan')) == \
+        b'ICAP/1.0 204 No modifications needed'
+    assert limit.active == 0
+
+    limit.acquire()
+    assert status_line(handler_class, reqmod_request(b'/scan')) == \
+        b'ICAP/1.0 503 Service overloaded'
+    assert status_line(handler_class, reqmod_request(b'/filter')) == \
+        b'ICAP/1.0 204 No modifications needed'
+    limit.release()
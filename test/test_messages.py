@@ -1,5 +1,5 @@
 from six import BytesIO, binary_type
-from icapservice.messages import HTTPRequest, HTTPResponse
+from icapservice.messages import HTTPRequest, HTTPResponse, split_header_section
 
 request_bytes = (
     b'POST /something HTTP/1.1\r\n'
@@ -28,3 +28,23 @@ def test_response_bytes():
     response = HTTPResponse.parse(BytesIO(response_bytes))
     # bytes does not include the content!
     assert binary_type(response) == response_bytes[:-3]
+
+
+def test_split_header_section():
+    assert split_header_section(response_bytes[:-3]) == (
+        b'HTTP/1.1 200 OK\r\n',
+        b'Content-Type: something/else\r\nContent-Length: 3\r\n')
+    assert split_header_section(b'HTTP/1.1 200 OK\n\n') == (
+        b'HTTP/1.1 200 OK\n', b'')
+    # too short, too long, or no blank line
+    assert split_header_section(response_bytes[:-4]) is None
+    assert split_header_section(response_bytes[:-2]) is None
+    assert split_header_section(b'HTTP/1.1 200 OK') is None
+
+
+def test_response_from_section():
+    start_line, block = split_header_section(response_bytes[:-3])
+    response = HTTPResponse.from_section(start_line, block)
+    assert response.status_code == 200
+    assert binary_type(response) == response_bytes[:-3]
+    assert response['content-length'] == '3'
@@ -0,0 +1,94 @@
+from contextlib import closing
+from six.moves.urllib.request import urlopen
+from icapservice import ICAPService, NoModificationsNeeded
+from icapservice.metrics import MetricsRegistry, MetricsService, serve_metrics
+from mocksocket import MockSocket
+
+respmod_request = (
+    b'RESPMOD icap://icap.example.net/nomod ICAP/1.0\r\n'
+    b'Host: icap.example.net\r\n'
+    b'Preview: 0\r\n'
+    b'Encapsulated: res-hdr=0, res-body=19\r\n'
+    b'\r\n'
+    b'HTTP/1.1 200 OK\r\n'
+    b'\r\n'
+    b'0\r\n'
+    b'\r\n'
+)
+
+reqmod_metrics_request = (
+    b'REQMOD icap://icap.example.net/metrics ICAP/1.0\r\n'
+    b'Host: icap.example.net\r\n'
+    b'Encapsulated: req-hdr=0, null-body=34\r\n'
+    b'\r\n'
+    b'GET /metrics HTTP/1.1\r\n'
+    b'Host: x\r\n'
+    b'\r\n'
+)
+
+
+class NoMod(ICAPService):
+
+    abs_path = '/nomod'
+
+    def RESPMOD(self, icap_request):
+        return NoModificationsNeeded()
+
+
+def test_counter_exposition():
+    registry = MetricsRegistry()
+    registry.inc('icap_requests_total', (('service', '/a'), ('status', '204')))
+    registry.inc('icap_requests_total', (('service', '/a'), ('status', '204')))
+    text = registry.exposition()
+    assert '# TYPE icap_requests_total counter\n' in text
+    assert 'icap_requests_total{service="/a",status="204"} 2\n' in text
+
+
+def test_histogram_exposition():
+    registry = MetricsRegistry(buckets=(0.1, 1.0))
+    labels = (('service', '/a'),)
+    for value in (0.05, 0.1, 0.5, 2.0):
+        registry.observe('icap_service_seconds', labels, value)
+    text = registry.exposition()
+    assert 'icap_service_seconds_bucket{service="/a",le="0.1"} 2\n' in text
+    assert 'icap_service_seconds_bucket{service="/a",le="1.0"} 3\n' in text
+    assert 'icap_service_seconds_bucket{service="/a",le="+Inf"} 4\n' in text
+    assert 'icap_service_seconds_sum{service="/a"} 2.65\n' in text
+    assert 'icap_service_seconds_count{service="/a"} 4\n' in text
+
+
+def test_handler_records_metrics():
+    registry = MetricsRegistry()
+    handler_class = NoMod().icap_handler_class(metrics=registry)
+    handler_class(MockSocket(respmod_request), object())
+    text = registry.exposition()
+    labels = 'service="/nomod",method="RESPMOD"'
+    assert 'icap_requests_total{%s,status="204"} 1\n' % labels in text
+    assert 'icap_preview_requests_total{%s} 1\n' % labels in text
+    assert 'icap_preview_continued_total' not in text
+    assert ('icap_request_bytes_total{%s} %d\n' % (labels, len(respmod_request))
+            in text)
+    assert 'icap_service_seconds_count{%s} 1\n' % labels in text
+
+
+def test_metrics_service():
+    registry = MetricsRegistry()
+    registry.inc('icap_requests_total', (('status', '200'),))
+    handler_class = MetricsService(registry).icap_handler_class()
+    request = MockSocket(reqmod_metrics_request)
+    handler_class(request, object())
+    assert request.wfile.value.startswith(b'ICAP/1.0 200 OK\r\n')
+    assert b'icap_requests_total{status="200"} 1\n' in request.wfile.value
+
+
+def test_serve_metrics():
+    registry = MetricsRegistry()
+    registry.inc('icap_requests_total', (('status', '200'),))
+    server = serve_metrics(registry, ('127.0.0.1', 0))
+    try:
+        url = 'http://127.0.0.1:%d/metrics' % server.server_address[1]
+        with closing(urlopen(url)) as response:
+            assert b'icap_requests_total{status="200"} 1\n' in response.read()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,92 @@
+import time
+import socket
+import threading
+from icapservice import PoolingICAPServer
+from icapservice.pooling import advertised_max_connections
+from servers import NoMod, connect, options_request, read_response, serve
+
+
+class SmallPoolICAPServer(PoolingICAPServer):
+    pool_size = 2
+
+
+def test_more_connections_than_threads():
+    server = serve(SmallPoolICAPServer, NoMod())
+    try:
+        connections = [socket.create_connection(server.server_address, 5)
+                       for _ in range(6)]
+        rfiles = [c.makefile('rb') for c in connections]
+        for _ in range(2):
+            for connection, rfile in zip(connections, rfiles):
+                connection.sendall(options_request)
+                assert read_response(rfile)[0] == b'ICAP/1.0 200 OK\r\n'
+        for connection in connections:
+            connection.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_max_connections():
+    service = NoMod()
+    service.options_headers['Max-Connections'] = 1
+    server = serve(SmallPoolICAPServer, service)
+    try:
+        first = socket.create_connection(server.server_address, 5)
+        first.sendall(options_request)
+        read_response(first.makefile('rb'))
+        with connect(server.server_address, 0.3) as second:
+            second.sendall(options_request)
+            try:
+                assert not second.recv(1)
+            except socket.timeout:
+                pass
+            else:
+                raise AssertionError('second connection was served')
+            first.close()
+            second.settimeout(5)
+            assert read_response(second.makefile('rb'))[0] == b'ICAP/1.0 200 OK\r\n'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_advertised_max_connections():
+    service = NoMod()
+    assert advertised_max_connections(service.icap_handler_class()) == 1000
+
+
+def test_drain_timeout():
+    release = threading.Event()
+
+    class Blocking(NoMod):
+
+        def OPTIONS(self, icap_request):
+            release.wait(5)
+            return NoMod.OPTIONS(self, icap_request)
+
+    server = serve(SmallPoolICAPServer, Blocking())
+    try:
+        with connect(server.server_address) as sock:
+            sock.sendall(options_request)
+            time.sleep(0.1)
+            started = time.time()
+            assert not server.drain(timeout=0.2)
+            assert time.time() - started < 2
+            assert sock.recv(1) == b''
+    finally:
+        release.set()
+        server.server_close()
+
+
+def test_drain_waits_for_requests():
+    server = serve(SmallPoolICAPServer, NoMod())
+    try:
+        with connect(server.server_address) as sock:
+            rfile = sock.makefile('rb')
+            sock.sendall(options_request)
+            assert read_response(rfile)[0] == b'ICAP/1.0 200 OK\r\n'
+            assert server.drain(timeout=5)
+            assert rfile.read() == b''
+    finally:
+        server.server_close()
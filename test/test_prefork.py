@@ -0,0 +1,181 @@
+import os
+import sys
+import time
+import signal
+import socket
+from contextlib import closing
+import pytest
+from icapservice import PoolingICAPServer, ThreadingICAPServer
+from icapservice.prefork import PreforkICAPServer
+from icapservice.__main__ import load_services, parse_address
+from servers import NoMod, connect, options_request, read_response
+
+crash_request = options_request[:-2] + b'X-Crash: 1\r\n\r\n'
+
+worker_classes = [ThreadingICAPServer, PoolingICAPServer]
+if sys.version_info >= (3, 6):
+    from icapservice.aio import AsyncICAPServer
+    worker_classes.append(AsyncICAPServer)
+worker_classes = pytest.mark.parametrize('worker_class', worker_classes)
+
+
+class WorkerPid(NoMod):
+    """ Answers OPTIONS with the worker's pid, exits on `X-Crash`. """
+
+    def OPTIONS(self, icap_request):
+        if icap_request.get('x-crash'):
+            os._exit(1)
+        response = NoMod.OPTIONS(self, icap_request)
+        response.headers['X-Worker'] = str(os.getpid())
+        return response
+
+
+def options(server_address, request=options_request):
+    with connect(server_address) as sock:
+        sock.sendall(request)
+        return read_response(sock.makefile('rb'))
+
+
+def worker_pid(server_address):
+    for line in options(server_address):
+        if line.startswith(b'X-Worker: '):
+            return int(line.split()[1])
+
+
+def supervise(server):
+    """ Run `server` in a forked supervisor, return the supervisor pid. """
+    pid = os.fork()
+    if not pid:
+        try:
+            # a process group, so a hung supervisor and workers can be killed
+            os.setpgid(0, 0)
+            server.serve_forever()
+        finally:
+            os._exit(0)
+    return pid
+
+
+def stop(pid, server, timeout=10):
+    os.kill(pid, signal.SIGTERM)
+    deadline = time.time() + timeout
+    while True:
+        waited, status = os.waitpid(pid, os.WNOHANG)
+        if waited:
+            break
+        if time.time() > deadline:
+            os.killpg(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            raise AssertionError('supervisor did not stop')
+        time.sleep(0.05)
+    server.server_close()
+    return status
+
+
+def free_port():
+    with closing(socket.socket()) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@worker_classes
+def test_prefork_workers_share_socket(worker_class):
+    handler_class = NoMod().icap_handler_class()
+    server = handler_class.server(PreforkICAPServer, ('127.0.0.1', 0),
+                                  workers=2, worker_class=worker_class)
+    pid = supervise(server)
+    try:
+        for _ in range(20):
+            assert options(server.server_address)[0] == b'ICAP/1.0 200 OK\r\n'
+    finally:
+        status = stop(pid, server)
+    assert status == 0
+
+
+@worker_classes
+def test_prefork_restarts_crashed_worker(worker_class):
+    handler_class = WorkerPid().icap_handler_class()
+    server = handler_class.server(PreforkICAPServer, ('127.0.0.1', 0),
+                                  workers=1, worker_class=worker_class)
+    server.restart_delay = 0.5
+    pid = supervise(server)
+    try:
+        first = worker_pid(server.server_address)
+        assert options(server.server_address, crash_request) == [b'']
+        crashed = time.time()
+        second = worker_pid(server.server_address)
+        # the worker started less than `restart_delay` before it crashed
+        assert time.time() - crashed >= 0.2
+        assert second != first
+    finally:
+        status = stop(pid, server)
+    assert status == 0
+
+
+def test_prefork_stop_while_spawning(monkeypatch):
+    handler_class = NoMod().icap_handler_class()
+    server = handler_class.server(PreforkICAPServer, ('127.0.0.1', 0),
+                                  workers=2)
+    pids = []
+    fork = os.fork
+
+    def fork_and_stop():
+        pid = fork()
+        if pid:
+            pids.append(pid)
+            # SIGTERM arrives before the worker is recorded
+            os.kill(os.getpid(), signal.SIGTERM)
+        return pid
+
+    monkeypatch.setattr(os, 'fork', fork_and_stop)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+    assert len(pids) == 1
+    try:
+        # the worker was stopped and waited for
+        with pytest.raises(OSError):
+            os.waitpid(pids[0], os.WNOHANG)
+    finally:
+        try:
+            os.kill(pids[0], signal.SIGKILL)
+            os.waitpid(pids[0], 0)
+        except OSError:
+            pass
+
+
+@pytest.mark.skipif(not hasattr(socket, 'SO_REUSEPORT'),
+                    reason='SO_REUSEPORT is not available')
+@worker_classes
+def test_prefork_reuse_port(worker_class):
+    handler_class = WorkerPid().icap_handler_class()
+    server = handler_class.server(PreforkICAPServer,
+                                  ('127.0.0.1', free_port()),
+                                  workers=2, reuse_port=True,
+                                  worker_class=worker_class)
+    assert server.shared_server is None
+    pid = supervise(server)
+    try:
+        deadline = time.time() + 5
+        while True:
+            try:
+                assert worker_pid(server.server_address)
+                break
+            except socket.error:
+                # the workers have not bound their sockets yet
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+    finally:
+        status = stop(pid, server)
+    assert status == 0
+
+
+def test_load_services():
+    services = load_services('servers')
+    assert [type(service) for service in services] == [NoMod]
+
+
+def test_parse_address():
+    assert parse_address('127.0.0.1:1344') == ('127.0.0.1', 1344)
+    assert parse_address(':1344') == ('0.0.0.0', 1344)
@@ -0,0 +1,200 @@
+from __future__ import print_function, unicode_literals
+import pytest
+from icapservice.response import BadComposition, RequestURITooLong
+from icapservice.request import ChunkError
+from icapservice.protocol import (
+    RequestParser, RequestHead, EncapsulatedHeaders, PreviewChunk, PreviewEnd,
+    BodyChunk, EndOfMessage, IncompleteRequest)
+from test_rfc_examples import read_example
+
+
+respmod_head = (
+    b'RESPMOD icap://icap.example.org/satisf ICAP/1.0\r\n'
+    b'Host: icap.example.org\r\n'
+    b'{}'
+    b'Encapsulated: req-hdr=0, res-hdr=137, res-body=296\r\n'
+    b'\r\n'
+    b'GET /origin-resource HTTP/1.1\r\n'
+    b'Host: www.origin-server.com\r\n'
+    b'Accept: text/html, text/plain, image/gif\r\n'
+    b'Accept-Encoding: gzip, compress\r\n'
+    b'\r\n'
+    b'HTTP/1.1 200 OK\r\n'
+    b'Date: Mon, 10 Jan 2000 09:52:22 GMT\r\n'
+    b'Server: Apache/1.3.6 (Unix)\r\n'
+    b'ETag: "63840-1ab7-378d415b"\r\n'
+    b'Content-Type: text/html\r\n'
+    b'Content-Length: 51\r\n'
+    b'\r\n'
+)
+
+body = (
+    b'1e\r\n'
+    b'This is data that was returned\r\n'
+    b'15\r\n'
+    b' by an origin server.\r\n'
+    b'0\r\n'
+    b'\r\n'
+)
+
+respmod_request = respmod_head.replace(b'{}', b'') + body
+
+options_request = (
+    b'OPTIONS icap://icap.example.org/satisf ICAP/1.0\r\n'
+    b'Host: icap.example.org\r\n'
+    b'\r\n'
+)
+
+
+def bytewise(parser, data):
+    events = []
+    for i in range(len(data)):
+        events.extend(parser.feed(data[i:i + 1]))
+    return events
+
+
+def merged(events):
+    """ Join consecutive data events, as split chunks are fed. """
+    result = []
+    for event in events:
+        if (result and type(event) in (PreviewChunk, BodyChunk) and
+                type(result[-1]) is type(event)):
+            result[-1] = type(event)(result[-1].data + event.data)
+        else:
+            result.append(event)
+    return result
+
+
+def kinds(events):
+    return [type(event) for event in events]
+
+
+def test_respmod():
+    parser = RequestParser()
+    events = parser.feed(respmod_request)
+    assert kinds(events) == [RequestHead, EncapsulatedHeaders,
+                             BodyChunk, BodyChunk, EndOfMessage]
+    icap_request = events[0].icap_request
+    assert icap_request.method == 'RESPMOD'
+    assert icap_request.abs_path == '/satisf'
+    assert events[1].http_request.uri == '/origin-resource'
+    assert events[1].http_response.status_code == 200
+    assert icap_request.http_response is events[1].http_response
+    assert events[2:4] == [BodyChunk(b'This is data that was returned'),
+                           BodyChunk(b' by an origin server.')]
+    assert icap_request.eof
+    assert icap_request.body_bytes_read == 51
+    parser.close()
+
+
+def test_respmod_bytewise():
+    events = bytewise(RequestParser(), respmod_request)
+    assert kinds(events)[:2] == [RequestHead, EncapsulatedHeaders]
+    assert merged(events[2:]) == [
+        BodyChunk(b'This is data that was returned by an origin server.'),
+        EndOfMessage()]
+
+
+def test_preview_continue():
+    preview, rest = body.split(b'\r\n15')
+    data = respmod_head.replace(b'{}', b'Preview: 30\r\n') + preview
+    parser = RequestParser()
+    events = bytewise(parser, data + b'\r\n0\r\n\r\n')
+    assert merged(events[2:]) == [
+        PreviewChunk(b'This is data that was returned'), PreviewEnd(False)]
+    icap_request = events[0].icap_request
+    assert icap_request.preview_chunks
+    assert parser.feed(b'15' + rest) == []
+
+    parser.continue_after_preview()
+    assert icap_request.continued
+    assert parser.feed(b'') == [BodyChunk(b' by an origin server.'),
+                                EndOfMessage()]
+    assert icap_request.body_bytes_read == 51
+
+
+def test_preview_answered():
+    preview = respmod_head.replace(b'{}', b'Preview: 30\r\n') + (
+        b'1e\r\n'
+        b'This is data that was returned\r\n'
+        b'0\r\n'
+        b'\r\n'
+    )
+    parser = RequestParser()
+    events = parser.feed(preview + options_request)
+    assert kinds(events)[-1] is PreviewEnd
+
+    parser.next_request()
+    events = parser.feed(b'')
+    assert kinds(events) == [RequestHead, EncapsulatedHeaders, EndOfMessage]
+    assert events[0].icap_request.method == 'OPTIONS'
+    parser.close()
+
+
+def test_preview_ieof():
+    data = respmod_head.replace(b'{}', b'Preview: 1024\r\n') + body.replace(
+        b'0\r\n\r\n', b'0; ieof\r\n\r\n')
+    events = bytewise(RequestParser(), data)
+    assert merged(events[2:]) == [
+        PreviewChunk(b'This is data that was returned by an origin server.'),
+        PreviewEnd(True), EndOfMessage()]
+    assert events[0].icap_request.eof
+
+
+def test_pipelined():
+    parser = RequestParser()
+    events = parser.feed(options_request + respmod_request + options_request)
+    assert kinds(events).count(EndOfMessage) == 3
+
+
+@pytest.mark.parametrize('filename', [
+    '4.8.3_ICAP_Request_Modification_Example_2',
+    '4.8.3_ICAP_Request_Modification_Example_3',
+    '4.10.3_ICAP_OPTIONS_Example_5',
+])
+def test_rfc_examples(filename):
+    request, _ = read_example('test/rfc_examples/' + filename)
+    events = bytewise(RequestParser(), bytes(request))
+    assert kinds(events)[:2] == [RequestHead, EncapsulatedHeaders]
+    assert kinds(events)[-1] is EndOfMessage
+
+
+def test_section_offset_checked_early():
+    data = respmod_request.replace(b'res-hdr=137', b'res-hdr=140')
+    parser = RequestParser()
+    # the request headers end at 137, before the whole section arrived
+    head = data.index(b'HTTP/1.1 200 OK')
+    with pytest.raises(BadComposition):
+        parser.feed(data[:head])
+
+
+def test_body_offset():
+    data = respmod_request.replace(b'res-body=296', b'res-body=290')
+    with pytest.raises(BadComposition):
+        RequestParser().feed(data)
+
+
+@pytest.mark.parametrize('chunks', [b'zz\r\n', b'3\r\nabcX\r\n',
+                                    b'3; ieof\r\nabc\r\n', b'1' * 2000])
+def test_chunk_errors(chunks):
+    data = respmod_head.replace(b'{}', b'') + chunks
+    with pytest.raises(ChunkError):
+        RequestParser().feed(data)
+
+
+def test_ieof_after_preview():
+    data = respmod_head.replace(b'{}', b'') + b'0; ieof\r\n\r\n'
+    with pytest.raises(ChunkError):
+        RequestParser().feed(data)
+
+
+def test_request_too_long():
+    with pytest.raises(RequestURITooLong):
+        RequestParser().feed(b'OPTIONS icap://' + b'x' * 70000)
+
+
+def test_incomplete():
+    parser = RequestParser()
+    parser.feed(respmod_request[:-3])
+    with pytest.raises(IncompleteRequest):
+        parser.close()
@@ -1,8 +1,10 @@
 from __future__ import print_function, unicode_literals
-from six import BytesIO
+from six import BytesIO, binary_type
 import pytest
 from icapservice.response import BadComposition, RequestURITooLong
-from icapservice.request import ICAPRequest, ChunkError, MAX_REQUEST_LEN
+from icapservice.content import decoders, encoders
+from icapservice.request import (ICAPRequest, ChunkReader, ChunkError, IEOF,
+                                 MAX_REQUEST_LEN)
 
 
 respmod_request = (
@@ -162,3 +164,187 @@ def test_max_request_len():
     rfile = BytesIO(format_request_line('a' * MAX_REQUEST_LEN))
     with pytest.raises(RequestURITooLong):
         ICAPRequest.parse(rfile)
+
+
+def test_discard_skips_remaining_chunks():
+    rfile = BytesIO(respmod_request.format(296) + b'NEXT')
+    request = ICAPRequest.parse(rfile)
+    assert request.discard()
+    assert request.eof
+    assert list(request.chunks) == []
+    assert rfile.read() == b'NEXT'
+
+
+def test_discard_after_partial_read():
+    body = b'3\r\nabc\r\n4\r\ndefg\r\n0\r\n\r\n'
+    rfile = BytesIO(respmod_request.format(296).split(b'33\r\n')[0] + body + b'NEXT')
+    request = ICAPRequest.parse(rfile)
+    assert next(request.chunks) == b'abc'
+    assert request.discard()
+    assert rfile.read() == b'NEXT'
+
+
+def test_discard_over_limit():
+    request = ICAPRequest.parse(BytesIO(respmod_request.format(296)))
+    assert not request.discard(max_bytes=10)
+    assert not request.eof
+
+
+def test_discard_waiting_for_continue():
+    continued = []
+    def continue_after_preview():
+        continued.append(True)
+    rfile = BytesIO(respmod_request_with_preview.format('', '', '\r', ''))
+    request = ICAPRequest.parse(rfile, continue_after_preview)
+    assert request.discard()
+    assert continued == []
+
+
+def test_allow_204():
+    rfile = BytesIO(respmod_request.format(296).replace(
+        b'Host: icap.example.org\r\n',
+        b'Host: icap.example.org\r\nAllow: trailers, 204\r\n'))
+    request = ICAPRequest.parse(rfile)
+    assert request.allow_204
+    assert request.can_respond_204
+    assert request.unmodified().status_code == 204
+
+
+def test_unmodified_without_allow_204():
+    request = ICAPRequest.parse(BytesIO(respmod_request.format(296)))
+    assert not request.allow_204
+    assert not request.can_respond_204
+    response = request.unmodified()
+    assert response.status_code == 200
+    assert response.http_response is request.http_response
+    assert list(response.chunks) == [
+        b'This is data that was returned by an origin server.']
+
+
+def test_modify_http_response_leaves_original():
+    request = ICAPRequest.parse(BytesIO(respmod_request.format(296)))
+    original = binary_type(request.http_response)
+    http_response, chunks = request.modify_http_response(decode=False)
+    http_response['Via'] = '1.0 icap.example.org'
+    assert 'content-length' not in http_response
+    assert request.http_response['content-length'] == '51'
+    assert binary_type(request.http_response) == original
+    assert binary_type(http_response).endswith(
+        b'Via: 1.0 icap.example.org\r\n\r\n')
+
+
+def test_unmodified_headers_passed_through():
+    data = respmod_request.format(297).replace(
+        b'Content-Type: text/html\r\n', b'content-type:text/html  \r\n')
+    request = ICAPRequest.parse(BytesIO(data))
+    response = request.unmodified()
+    assert b'content-type:text/html  \r\n' in response.header_bytes([])
+    # the headers were never parsed
+    with pytest.raises(AttributeError):
+        object.__getattribute__(request.http_response, '_fields')
+    assert request.http_response['Content-Type'] == 'text/html'
+
+
+def test_encode_body_from_accept_encoding():
+    request = ICAPRequest.parse(BytesIO(respmod_request.format(296)))
+    http_response, chunks = request.modify_http_response()
+    assert request.body_encoding() == 'gzip'
+    chunks = request.encode_body(http_response, chunks, level=1)
+    assert http_response['content-encoding'] == 'gzip'
+    assert http_response['vary'] == 'Accept-Encoding'
+    assert b''.join(decoders['gzip'](chunks)) == (
+        b'This is data that was returned by an origin server.')
+
+
+def test_encode_body_keeps_original_encoding():
+    body = b'gzipped data'
+    compressed = b''.join(encoders['gzip']([body]))
+    data = respmod_request.format(320).replace(
+        b'Content-Length: 51\r\n',
+        b'Content-Encoding: gzip\r\nContent-Length: %d\r\n' % len(compressed)
+    ).replace(b'33\r\nThis is data that was returned by an origin server.',
+              b'%x\r\n' % len(compressed) + compressed)
+    request = ICAPRequest.parse(BytesIO(data))
+    http_response, chunks = request.modify_http_response()
+    chunks = request.encode_body(http_response, chunks, encoding=None)
+    assert http_response['content-encoding'] == 'gzip'
+    assert 'vary' not in http_response
+    assert b''.join(decoders['gzip'](chunks)) == body
+
+
+def test_can_respond_204_in_preview():
+    rfile = BytesIO(respmod_request_with_preview.format('', '', '\r', ''))
+    request = ICAPRequest.parse(rfile, lambda: None)
+    assert request.can_respond_204
+    request.continue_after_preview()
+    assert not request.can_respond_204
+
+
+def chunked_body(*chunks):
+    return b''.join(b'%x\r\n' % len(chunk) + chunk + b'\r\n'
+                    for chunk in chunks) + b'0\r\n\r\n'
+
+
+def test_chunk_reader_views():
+    rfile = BytesIO(chunked_body(b'abc', b'defgh') + b'NEXT')
+    reader = ChunkReader(rfile, buffer_size=8)
+    chunks = [chunk.tobytes() for chunk in reader]
+    assert chunks == [b'abc', b'defgh']
+    assert rfile.read() == b'NEXT'
+
+
+def test_chunk_reader_splits_large_chunks():
+    rfile = BytesIO(chunked_body(b'a' * 20, b'b' * 6) + b'NEXT')
+    chunks = list(ChunkReader(rfile, buffer_size=8, copy=True))
+    assert chunks == [b'a' * 8, b'a' * 8, b'a' * 4, b'b' * 6]
+    assert rfile.read() == b'NEXT'
+
+
+def test_chunk_reader_ieof():
+    rfile = BytesIO(b'3\r\nabc\r\n0; ieof\r\n\r\n')
+    chunks = list(ChunkReader(rfile, copy=True))
+    assert chunks == [b'abc', IEOF]
+
+
+def test_chunk_reader_errors():
+    with pytest.raises(ChunkError):
+        list(ChunkReader(BytesIO(b'3\r\nabcX\r\n0\r\n\r\n')))
+    with pytest.raises(ChunkError):
+        list(ChunkReader(BytesIO(b'10\r\nabc')))
+
+
+def test_body_views():
+    body = chunked_body(b'This is data', b' that was returned')
+    rfile = BytesIO(respmod_request.format(296).split(b'33\r\n')[0] + body)
+    request = ICAPRequest.parse(rfile)
+    chunks = [bytes(bytearray(chunk)) for chunk in request.body_views()]
+    assert chunks == [b'This is data', b' that was returned']
+    assert request.eof
+    assert request.body_bytes_read == 30
+
+
+def test_discard_after_partial_body_views():
+    body = chunked_body(b'a' * 20, b'b' * 6)
+    head = respmod_request.format(296).split(b'33\r\n')[0]
+    for max_bytes, discarded in ((None, True), (18, True), (17, False)):
+        rfile = BytesIO(head + body + b'NEXT')
+        request = ICAPRequest.parse(rfile)
+        views = request.body_views(buffer_size=8)
+        assert next(views).tobytes() == b'a' * 8
+        # 12 bytes of the first chunk and 6 of the second are left
+        assert request.discard(max_bytes) == discarded
+        if discarded:
+            assert rfile.read() == b'NEXT'
+
+
+def test_modify_stacked_encoding():
+    body = b''.join(encoders['br']([b''.join(encoders['gzip']([b'data']))]))
+    data = respmod_request.format(304).replace(
+        b'Content-Length: 51\r\n',
+        b'Content-Encoding: gzip, br\r\n'
+    ).replace(b'33\r\nThis is data that was returned by an origin server.',
+              b'%x\r\n' % len(body) + body)
+    request = ICAPRequest.parse(BytesIO(data))
+    http_response, chunks = request.modify_http_response()
+    assert b''.join(chunks) == b'data'
+    assert request.body_encoding() == 'br'
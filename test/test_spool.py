@@ -0,0 +1,64 @@
+from __future__ import print_function
+import mmap
+from six import BytesIO
+import pytest
+from icapservice.spool import SpooledBody
+from icapservice.request import ICAPRequest
+from test_request import respmod_request
+
+
+def test_small_body_in_memory():
+    body = SpooledBody.from_chunks([b'abc', b'def'], max_size=10)
+    assert not body.on_disk
+    assert len(body) == 6
+    assert body.map() == b'abcdef'
+    assert list(body.chunks(4)) == [b'abcd', b'ef']
+
+
+def test_large_body_on_disk(tmpdir):
+    chunks = [b'%05d' % i for i in range(1000)]
+    body = SpooledBody.from_chunks(chunks, max_size=1000, dir=str(tmpdir))
+    assert body.on_disk
+    assert len(body) == 5000
+    mapped = body.map()
+    assert isinstance(mapped, mmap.mmap)
+    assert mapped[:10] == b'0000000001'
+    assert mapped.find(b'00999') == 4995
+    # iterating twice reads the body from the start each time
+    assert b''.join(body) == b''.join(chunks)
+    assert b''.join(body.chunks(3)) == b''.join(chunks)
+    body.close()
+
+
+def test_write_after_partial_read():
+    body = SpooledBody(max_size=4)
+    body.write(b'abcdef')
+    chunks = body.chunks(2)
+    assert next(chunks) == b'ab'
+    body.write(b'gh')
+    assert b''.join(body) == b'abcdefgh'
+
+
+def test_empty_body_on_disk():
+    with SpooledBody(max_size=0) as body:
+        body.rollover()
+        assert body.map() == b''
+        assert list(body) == []
+
+
+def test_failed_chunks_close_body():
+    def chunks():
+        yield b'abc'
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        SpooledBody.from_chunks(chunks())
+
+
+def test_request_spool():
+    request = ICAPRequest.parse(BytesIO(respmod_request.format(296)))
+    body = request.spool(max_size=16)
+    assert body.on_disk
+    assert body.map()[:] == (
+        b'This is data that was returned by an origin server.')
+    assert request.eof
@@ -0,0 +1,133 @@
+from six import BytesIO
+from icapservice import ICAPService, NoModificationsNeeded, OK
+from icapservice.request import ICAPRequest
+from icapservice.content import DecodeLimitExceeded
+from icapservice.verdicts import VerdictCache, verdict_key
+from mocksocket import MockSocket
+
+
+def respmod_request(uri=b'/logo.png', validators=b'ETag: "abc"\r\n',
+                    host=b'www.example.net'):
+    req_hdr = b'GET ' + uri + b' HTTP/1.1\r\nHost: ' + host + b'\r\n\r\n'
+    res_hdr = b'HTTP/1.1 200 OK\r\nContent-Length: 4\r\n' + validators + b'\r\n'
+    return (
+        b'RESPMOD icap://icap.example.net/scan ICAP/1.0\r\n'
+        b'Host: icap.example.net\r\n'
+        b'Preview: 0\r\n'
+        b'Encapsulated: req-hdr=0, res-hdr=%d, res-body=%d\r\n'
+        b'\r\n' % (len(req_hdr), len(req_hdr) + len(res_hdr)) +
+        req_hdr + res_hdr + b'0\r\n\r\n'
+    )
+
+
+def parse(request_bytes):
+    return ICAPRequest.parse(BytesIO(request_bytes), lambda: None)
+
+
+def test_verdict_key():
+    key = verdict_key(parse(respmod_request()))
+    assert key[-4:] == (200, '"abc"', None, '4')
+    assert key != verdict_key(parse(respmod_request(b'/other.png')))
+    assert key != verdict_key(parse(respmod_request(
+        validators=b'ETag: "def"\r\n')))
+    assert verdict_key(parse(respmod_request(validators=b''))) is None
+
+
+def test_host_in_key():
+    key = verdict_key(parse(respmod_request()))
+    assert key == verdict_key(parse(respmod_request(host=b'WWW.example.net')))
+    other = parse(respmod_request(host=b'evil.example'))
+    assert key != verdict_key(other)
+    cache = VerdictCache()
+    cache.store(parse(respmod_request()), NoModificationsNeeded(), 'istag')
+    assert cache.lookup(other, 'istag') is None
+
+
+def test_lookup_and_store():
+    cache = VerdictCache()
+    request = parse(respmod_request())
+    assert cache.lookup(request, 'istag') is None
+    cache.store(request, NoModificationsNeeded(), 'istag')
+    assert cache.lookup(request, 'istag').status_code == 204
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_only_204_stored():
+    cache = VerdictCache()
+    request = parse(respmod_request())
+    cache.store(request, OK(), 'istag')
+    assert len(cache) == 0
+
+
+def test_istag_change_clears():
+    cache = VerdictCache()
+    request = parse(respmod_request())
+    cache.store(request, NoModificationsNeeded(), 'old')
+    assert cache.lookup(request, 'new') is None
+    assert len(cache) == 0
+
+
+def test_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('icapservice.verdicts.clock', lambda: now[0])
+    cache = VerdictCache(ttl=10)
+    request = parse(respmod_request())
+    cache.store(request, NoModificationsNeeded(), 'istag')
+    now[0] += 5
+    # a response from the cache does not extend the ttl
+    cache.store(request, cache.lookup(request, 'istag'), 'istag')
+    now[0] += 6
+    assert cache.lookup(request, 'istag') is None
+
+
+def test_lru_eviction():
+    cache = VerdictCache(max_entries=2)
+    requests = [parse(respmod_request(b'/%d.png' % i)) for i in range(3)]
+    cache.store(requests[0], NoModificationsNeeded(), 'istag')
+    cache.store(requests[1], NoModificationsNeeded(), 'istag')
+    assert cache.lookup(requests[0], 'istag') is not None
+    cache.store(requests[2], NoModificationsNeeded(), 'istag')
+    assert cache.lookup(requests[1], 'istag') is None
+    assert cache.lookup(requests[0], 'istag') is not None
+    assert cache.lookup(requests[2], 'istag') is not None
+
+
+class Scanner(ICAPService):
+
+    abs_path = '/scan'
+    scanned = 0
+
+    def RESPMOD(self, icap_request):
+        Scanner.scanned += 1
+        return NoModificationsNeeded()
+
+
+def test_handler_serves_cached_verdict():
+    Scanner.scanned = 0
+    service = Scanner()
+    service.verdict_cache = VerdictCache()
+    socket = MockSocket(respmod_request() * 3)
+    service.icap_handler_class()(socket, object(), object())
+    response = socket.wfile.value
+    assert response.count(b'ICAP/1.0 204 No modifications needed\r\n') == 3
+    assert Scanner.scanned == 1
+    assert service.verdict_cache.hits == 2
+
+
+class Undecodable(Scanner):
+
+    def RESPMOD(self, icap_request):
+        Scanner.scanned += 1
+        raise DecodeLimitExceeded('body decodes to more than 4 bytes')
+
+
+def test_decode_error_not_cached():
+    Scanner.scanned = 0
+    service = Undecodable()
+    service.verdict_cache = VerdictCache()
+    socket = MockSocket(respmod_request() * 2)
+    service.icap_handler_class()(socket, object(), object())
+    response = socket.wfile.value
+    assert response.count(b'ICAP/1.0 204 No modifications needed\r\n') == 2
+    assert Scanner.scanned == 2
+    assert len(service.verdict_cache) == 0
@@ -0,0 +1,131 @@
+import ssl
+import socket
+from contextlib import closing
+from icapservice import writer as writer_module
+from icapservice.writer import ResponseWriter, coalesce
+
+
+class CountingWfile(object):
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+
+class PartialSendmsgSocket(object):
+    """ Accepts at most `limit` bytes per `sendmsg` call. """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.calls = 0
+        self.sent = b''
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        data = b''.join(b.tobytes() for b in buffers)[:self.limit]
+        self.sent += data
+        return len(data)
+
+
+def test_chunks_are_batched():
+    wfile = CountingWfile()
+    writer = ResponseWriter(object(), wfile)
+    writer.write(b'HEADER\r\n\r\n')
+    for chunk in (b'a', b'bc', b'd' * 16):
+        writer.write_chunk(chunk)
+    writer.write_final_chunk()
+    writer.flush()
+    assert wfile.writes == [b'HEADER\r\n\r\n'
+                            b'1\r\na\r\n'
+                            b'2\r\nbc\r\n'
+                            b'10\r\n' + b'd' * 16 + b'\r\n'
+                            b'0\r\n\r\n']
+
+
+def test_zero_buffer_size_writes_each_chunk():
+    wfile = CountingWfile()
+    writer = ResponseWriter(object(), wfile, buffer_size=0)
+    writer.write_chunk(b'a')
+    writer.write_chunk(b'b')
+    assert wfile.writes == [b'1\r\na\r\n', b'1\r\nb\r\n']
+
+
+class UnsupportedSendmsgSocket(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def sendmsg(self, buffers):
+        raise NotImplementedError()
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+
+def test_sendmsg_not_implemented():
+    sock = UnsupportedSendmsgSocket()
+    writer = ResponseWriter(sock, CountingWfile(), buffer_size=0)
+    writer.write_chunk(b'hello')
+    writer.write_final_chunk()
+    assert sock.sent == [b'5\r\nhello\r\n', b'0\r\n\r\n']
+
+
+def test_tls_socket_uses_sendall():
+    context = ssl.create_default_context()
+    with closing(context.wrap_socket(socket.socket(),
+                                     server_hostname='icap.example.net',
+                                     do_handshake_on_connect=False)) as sock:
+        writer = ResponseWriter(sock, CountingWfile())
+        assert writer.sendmsg is None
+        assert writer.sendall == sock.sendall
+
+
+def test_sendmsg_partial_sends():
+    sock = PartialSendmsgSocket(limit=3)
+    writer = ResponseWriter(sock, CountingWfile())
+    writer.write_chunk(b'hello')
+    writer.write_final_chunk()
+    writer.flush()
+    assert sock.sent == b'5\r\nhello\r\n0\r\n\r\n'
+    assert sock.calls == 5
+
+
+def test_coalesce_by_size():
+    chunks = [b'', b'a', b'', b'bc', b'd', b'ef', b'g']
+    # the first chunk is not held back
+    assert list(coalesce(chunks, min_size=3)) == [b'a', b'bcd', b'efg']
+
+
+def test_coalesce_large_chunk_not_copied():
+    chunk = b'x' * 10
+    coalesced, = coalesce([chunk], min_size=3)
+    assert coalesced is chunk
+
+
+def test_coalesce_by_delay(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(writer_module, 'clock', lambda: now[0])
+
+    def slow_chunks():
+        yield b'a'
+        yield b'b'
+        now[0] += 0.2
+        yield b'c'
+        yield b'd'
+
+    chunks = coalesce(slow_chunks(), min_size=100, max_delay=0.1)
+    assert list(chunks) == [b'a', b'bc', b'd']
+
+
+def test_writer_flushes_after_delay(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(writer_module, 'clock', lambda: now[0])
+    wfile = CountingWfile()
+    writer = ResponseWriter(object(), wfile, max_delay=0.1)
+    writer.write_chunk(b'a')
+    assert wfile.writes == []
+    now[0] += 0.2
+    writer.write_chunk(b'b')
+    assert wfile.writes == [b'1\r\na\r\n1\r\nb\r\n']